@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+import wfd_capcache
+import wfd_capture
+import wfd_core
+import wfd_media
+import wfd_metrics
+import wfd_options
+import wfd_profile
+import wfd_rtcp
+import wfd_session
+import wfd_trace
+import wfd_uibc
+from wfd_server import WfdServer
+
+
+logger = logging.getLogger('AsyncWfdServer')
+
+
+class AsyncUibcProtocol(asyncio.Protocol):
+    # asyncio sets TCP_NODELAY on its TCP transports already.
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.transport = None
+        self.channel = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.channel = wfd_uibc.UibcChannel(
+            self.dispatcher, transport.get_extra_info('peername')[0])
+
+    def data_received(self, data):
+        try:
+            self.channel.data_received(data)
+        except wfd_uibc.UibcError as e:
+            logger.info('%s UIBC failed: %s', self.channel.peer, e)
+            self.transport.close()
+
+
+class AsyncWfdServer(object):
+    DEFAULT_BACKLOG = 1024
+    DEFAULT_READ_TIMEOUT = None
+    DEFAULT_MAX_SESSIONS = 10000
+
+    def __init__(self, backlog=DEFAULT_BACKLOG,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_sessions=DEFAULT_MAX_SESSIONS,
+                 session_timeout=wfd_session.DEFAULT_TIMEOUT,
+                 media=None, broadcast=False, uibc_port=None,
+                 rate_controller=None, capabilities=None, pipeline=False):
+        self.backlog = backlog
+        self.read_timeout = read_timeout
+        self.max_sessions = max_sessions
+        self.session_manager = wfd_session.SessionManager(session_timeout)
+        self.media = media
+        self.broadcast = broadcast
+        self.rate_controller = rate_controller
+        self.uibc_port = uibc_port
+        self.uibc = wfd_uibc.UibcDispatcher()
+        self.capabilities = capabilities
+        self.pipeline = pipeline
+        self.source = None
+        self.sessions = set()
+        self.server = None
+        self.uibc_server = None
+        self.ticker = None
+
+    async def serve_port(self, port, host=''):
+        self.server = await asyncio.start_server(
+            self._serve_client, host or None, port,
+            backlog=self.backlog, reuse_address=True)
+        self.ticker = asyncio.ensure_future(self._tick_sessions())
+        wfd_profile.schedule_reports(asyncio.get_running_loop().call_later)
+        if self.media is not None:
+            loop = asyncio.get_running_loop()
+            self.source = wfd_media.open_source(
+                self.media, loop.call_later, self.broadcast,
+                self.rate_controller, loop)
+        logger.info('Listening on port %d', port)
+        if self.uibc_port is not None:
+            self.uibc_server = await asyncio.get_running_loop().create_server(
+                lambda: AsyncUibcProtocol(self.uibc), host or None,
+                self.uibc_port, reuse_address=True)
+            logger.info('UIBC on port %d', self.uibc_port)
+
+    async def shutdown(self):
+        if self.server is not None:
+            self.server.close()
+        if self.uibc_server is not None:
+            self.uibc_server.close()
+        if self.ticker is not None:
+            self.ticker.cancel()
+        for task in list(self.sessions):
+            task.cancel()
+        await asyncio.gather(*self.sessions, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        if self.capabilities is not None:
+            self.capabilities.save()
+            logger.info('Capability cache: %s', wfd_capcache.format_report(
+                self.capabilities.report()))
+        logger.info('Server stopped')
+
+    async def _serve_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        if len(self.sessions) >= self.max_sessions:
+            logger.warning('Rejecting %s: %d sessions active',
+                           address, len(self.sessions))
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self.sessions.add(task)
+        session = WfdServer()
+        session.trace = wfd_trace.session_trace(address)
+        session.capture = wfd_capture.session_capture(address)
+        session.metrics = wfd_metrics.SessionMetrics()
+        session.profile = wfd_profile.session_profile(address)
+
+        def keepalive(session_id):
+            try:
+                session.send_keepalive(session_id)
+            except wfd_core.WfdProtocolError as e:
+                logger.info('%s failed: %s', address, e)
+                task.cancel()
+                return
+            writer.write(session.data_to_send())
+
+        def expire(session_id):
+            logger.info('%s session %s timed out', address, session_id)
+            task.cancel()
+
+        session_id = self.session_manager.open(keepalive, expire)
+        session.session_id = session_id
+        session.session_timeout = self.session_manager.timeout
+        session.media = self.source
+        session.uibc_port = self.uibc_port
+        session.capabilities = self.capabilities
+        session.pipeline = self.pipeline
+        session.peer = address[0]
+        try:
+            await self._serve_session(session, session_id, reader, writer)
+        except asyncio.TimeoutError:
+            logger.info('%s timed out', address)
+            session.trace.dump()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.info('%s failed: %s', address, e)
+            session.trace.dump()
+        finally:
+            self.session_manager.close(session_id)
+            self.sessions.discard(task)
+            session.stream_stop()
+            session.metrics.close()
+            session.close()
+            writer.close()
+        logger.debug('%s disconnected', address)
+
+    async def _tick_sessions(self):
+        while True:
+            await asyncio.sleep(self.session_manager.wheel.tick)
+            self.session_manager.tick()
+
+    async def _serve_session(self, session, session_id, reader, writer):
+        # Reads are bounded by read_timeout and cut short by the session's
+        # request deadline, which expire() turns into an RtspTimeout.
+        session.connection_made()
+        while True:
+            writer.write(session.data_to_send())
+            await writer.drain()
+            if session.closing:
+                return
+            timeout = self.read_timeout
+            deadline = session.next_deadline()
+            request_due = deadline is not None and (
+                timeout is None or deadline - session.clock() < timeout)
+            if request_due:
+                timeout = max(0.0, deadline - session.clock())
+            try:
+                data = await asyncio.wait_for(reader.read(4096), timeout)
+            except asyncio.TimeoutError:
+                if not request_due:
+                    raise
+                session.expire()
+                continue
+            if not data:
+                raise Exception('Connection closed by peer')
+            self.session_manager.touch(session_id)
+            session.receive_data(data)
+
+
+async def serve(server, port):
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    await server.serve_port(port)
+    await stopped.wait()
+    await server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='asyncio WFD test server')
+    wfd_options.add_server_arguments(parser)
+    parser.add_argument('--backlog', type=int,
+                        default=AsyncWfdServer.DEFAULT_BACKLOG)
+    parser.add_argument('--read-timeout', type=float,
+                        default=AsyncWfdServer.DEFAULT_READ_TIMEOUT)
+    parser.add_argument('--max-sessions', type=int,
+                        default=AsyncWfdServer.DEFAULT_MAX_SESSIONS)
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)s\t[%(name)s]\t%(message)s')
+    logger.info('WFD test server v0.3 - powered by asyncio')
+    if args.metrics_port:
+        wfd_metrics.serve_metrics(args.metrics_port)
+    if args.trace:
+        wfd_trace.enable(args.trace)
+        wfd_trace.install_signal_handler()
+    if args.capture:
+        wfd_capture.enable(args.capture)
+    if args.profile:
+        wfd_profile.enable(args.profile, args.profile_interval)
+        wfd_profile.install_signal_handler()
+    media = wfd_media.TsFile(args.media) if args.media else None
+    capabilities = None
+    if args.capability_cache:
+        capabilities = wfd_capcache.CapabilityCache(
+            args.capability_cache, args.capability_ttl, args.capability_file)
+        logger.info('%d cached sinks loaded', capabilities.load())
+    server = AsyncWfdServer(args.backlog, args.read_timeout,
+                            args.max_sessions, args.session_timeout, media,
+                            args.broadcast, args.uibc_port,
+                            wfd_rtcp.LossRateController
+                            if args.rate_control else None, capabilities,
+                            args.pipeline)
+    asyncio.run(serve(server, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import array
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import rtsp
+import wfd_media
+import wfd_sim
+from wfd_client import WfdClient
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVERS = {
+    'wfd_server': [sys.executable, os.path.join(HERE, 'wfd_server.py')],
+    'twisted_wfd_server': [sys.executable, os.path.join(HERE, 'twisted_wfd_server.py')],
+    'asyncio_wfd_server': [sys.executable, os.path.join(HERE, 'asyncio_wfd_server.py')],
+}
+BODY_SIZES = (0, 256, 4096)
+PIPELINE_DEPTHS = (1, 8, 64)
+# Bytes per RtspParser.feed() call for split input: the worst case and a
+# typical TCP segment.
+SPLIT_SIZES = (1, 1448)
+SPLIT_DEPTH = 8
+RTP_BLOCK_SIZES = (7, 64, 512)
+
+
+def measure(function, rounds=50, min_round_time=0.002):
+    iterations = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        if time.perf_counter() - started >= min_round_time:
+            break
+        iterations *= 2
+
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        samples.append((time.perf_counter() - started) / iterations)
+    return samples
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'ops_per_sec': len(samples) / sum(samples),
+        'p50_us': 1e6 * samples[len(samples) // 2],
+        'p99_us': 1e6 * samples[min(len(samples) - 1, int(0.99 * len(samples)))],
+    }
+
+
+def _request(size):
+    return rtsp.RtspRequest(
+        'SET_PARAMETER', url='rtsp://localhost/wfd1.0', headers={'CSeq': 1},
+        content=rtsp.RtspContent('text/parameters', 'x' * size) if size else None)
+
+
+def _response(size):
+    return rtsp.RtspResponse(
+        headers={'CSeq': 1},
+        content=rtsp.RtspContent('text/parameters', 'x' * size) if size else None)
+
+
+def _parse_all(parse, string):
+    while string:
+        message, length = parse(string)
+        if not message:
+            break
+        string = string[length:]
+
+
+def _feed(chunks):
+    parser = rtsp.RtspParser()
+    for chunk in chunks:
+        for _ in parser.feed(chunk):
+            pass
+
+
+def _feed_frames(data):
+    for _ in rtsp.RtspParser().feed_frames(data):
+        pass
+
+
+def parser_benchmarks():
+    # The incremental parser the servers use, on pipelined messages fed at
+    # once and on a pipelined stream fed a few bytes at a time.
+    results = {}
+    for size in BODY_SIZES:
+        request = _request(size).to_bytes()
+        for depth in PIPELINE_DEPTHS:
+            data = request * depth
+            suffix = '[body={0},depth={1}]'.format(size, depth)
+            results['RtspParser.feed' + suffix] = measure(
+                lambda: _feed((data,)))
+            results['RtspParser.feed_frames' + suffix] = measure(
+                lambda: _feed_frames(data))
+        data = request * SPLIT_DEPTH
+        for split in SPLIT_SIZES:
+            chunks = [data[i:i + split] for i in range(0, len(data), split)]
+            results['RtspParser.feed[body={0},depth={1},split={2}]'.format(
+                size, SPLIT_DEPTH, split)] = measure(
+                    lambda: _feed(chunks), rounds=20 if split == 1 else 50)
+    return results
+
+
+def micro_benchmarks():
+    results = {}
+    for size in BODY_SIZES:
+        request, response = _request(size), _response(size)
+        for depth in PIPELINE_DEPTHS:
+            requests = str(request) * depth
+            responses = str(response) * depth
+            suffix = '[body={0},depth={1}]'.format(size, depth)
+            results['request_from_string' + suffix] = measure(
+                lambda: _parse_all(rtsp.request_from_string, requests))
+            results['response_from_string' + suffix] = measure(
+                lambda: _parse_all(rtsp.response_from_string, responses))
+            results['message_from_string' + suffix] = measure(
+                lambda: _parse_all(rtsp.message_from_string, requests))
+        results['RtspMessage.__str__[body={0}]'.format(size)] = measure(
+            lambda: str(request))
+    for pipeline in (True, False):
+        results['core_session[pipeline={0}]'.format(pipeline)] = measure(
+            lambda: wfd_sim.simulate_session(pipeline=pipeline), rounds=20)
+    return results
+
+
+def _pack_headers(header, count):
+    for i in range(count):
+        wfd_media.RTP_HEADER.pack_into(
+            header, 0, wfd_media.RTP_VERSION, wfd_media.RTP_MP2T_PAYLOAD_TYPE,
+            i & 0xFFFF, (i * 3000) & 0xFFFFFFFF, 0x12345678)
+
+
+def rtp_benchmarks():
+    results = {}
+    header = bytearray(wfd_media.RTP_HEADER.size)
+    for count in RTP_BLOCK_SIZES:
+        timestamps = array.array('q', range(0, count * 3000, 3000))
+        suffix = '[packets={0}]'.format(count)
+        results['rtp_headers.per_packet' + suffix] = measure(
+            lambda: _pack_headers(header, count))
+        block = wfd_media.RtpHeaderBlock(count, vectorized=False)
+        results['rtp_headers.struct_block' + suffix] = measure(
+            lambda: block.fill(0x12345678, 0, timestamps))
+        if wfd_media.numpy is not None:
+            vectorized = wfd_media.RtpHeaderBlock(count, vectorized=True,
+                                                  threshold=0)
+            results['rtp_headers.numpy_block' + suffix] = measure(
+                lambda: vectorized.fill(0x12345678, 0, timestamps))
+    return results
+
+
+def _free_port():
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise Exception('Server on port {0} did not start'.format(port))
+
+
+def macro_benchmarks(handshakes=200):
+    results = {}
+    for name, command in sorted(SERVERS.items()):
+        port = _free_port()
+        server = subprocess.Popen(command + [str(port)],
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_port(port)
+            samples = []
+            for _ in range(handshakes):
+                started = time.perf_counter()
+                WfdClient().connect('127.0.0.1', port)
+                samples.append(time.perf_counter() - started)
+            results['handshake[{0}]'.format(name)] = samples
+        except Exception as e:
+            print('Skipping {0}: {1}'.format(name, e), file=sys.stderr)
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def compare(baseline, current, threshold):
+    regressions = []
+    for name, result in sorted(current.items()):
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result['ops_per_sec'] < reference['ops_per_sec'] * (1 - threshold):
+            regressions.append('{0}: ops/s {1:.1f} -> {2:.1f}'.format(
+                name, reference['ops_per_sec'], result['ops_per_sec']))
+        if result['p99_us'] > reference['p99_us'] * (1 + threshold):
+            regressions.append('{0}: p99 {1:.1f}us -> {2:.1f}us'.format(
+                name, reference['p99_us'], result['p99_us']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='rtsp.py and handshake benchmarks')
+    parser.add_argument('--group', choices=('micro', 'rtp', 'macro', 'all'), default='all')
+    parser.add_argument('--handshakes', type=int, default=200,
+                        help='handshakes per server in the macro group')
+    parser.add_argument('--save', metavar='FILE', help='write results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed relative regression (default 0.10)')
+    args = parser.parse_args()
+
+    samples = {}
+    if args.group in ('micro', 'all'):
+        samples.update(micro_benchmarks())
+        samples.update(parser_benchmarks())
+    if args.group in ('rtp', 'micro', 'all'):
+        samples.update(rtp_benchmarks())
+    if args.group in ('macro', 'all'):
+        samples.update(macro_benchmarks(args.handshakes))
+    results = {name: summarize(values) for name, values in samples.items()}
+
+    for name, result in sorted(results.items()):
+        print('{0:55} {1:14.1f} ops/s  p99 {2:10.1f}us'.format(
+            name, result['ops_per_sec'], result['p99_us']))
+
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), results, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,100 +1,268 @@
+import collections
+import sys
+
 VERSION = "RTSP/1.0"
 DEFAULT_SERVER_PORT = 7236
+DEFAULT_MAX_HEADER_SIZE = 8192
+DEFAULT_MAX_CONTENT_LENGTH = 65536
 
 def message_from_string(string):
-    if string.startswith('RTSP'):
-        return response_from_string(string)
-    else:
-        return request_from_string(string)
+  parser = RtspParser()
+  for message in parser.feed(string.encode('ascii')):
+    return (message, parser.consumed)
+  return (None, 0)
 
 def request_from_string(string):
-  if "\r\n\r\n" not in string:
-    return (None, 0)
-
-  length = string.find("\r\n\r\n") + 4
-  message = string.split("\r\n\r\n")
-
-  lines = message[0].split("\r\n")
-
-  status_line=lines[0]
-  header_pairs = [line.split(": ") for line in lines[1:]]
-  headers = {split[0]: split[1] for split in header_pairs if len(split) > 1}
-  content = None
-
-  if len(message) == 2 and message[1]:
-    content_length = int(headers["Content-Length"])
-    content = RtspContent(headers["Content-Type"], message[1][:content_length])
-    length += content_length
-
-  method, url, version = status_line.split(" ")
-
-  return (RtspRequest(method, url, headers, content), length)
-
+  return message_from_string(string)
 
 def response_from_string(string):
-  if "\r\n\r\n" not in string:
-    return (None, 0)
+  return message_from_string(string)
 
-  length = string.find("\r\n\r\n") + 4
-  message = string.split("\r\n\r\n")
 
-  lines = message[0].split("\r\n")
+class RtspParseError(Exception):
+  pass
 
-  status_line=lines[0]
-  header_pairs = [line.split(": ") for line in lines[1:]]
-  headers = {split[0]: split[1] for split in header_pairs if len(split) > 1}
-  content = None
 
-  if len(message) == 2 and message[1]:
-    content_length = int(headers["Content-Length"])
-    content = RtspContent(headers["Content-Type"], message[1][:content_length])
-    length += content_length
+# Header names are stored in their canonical, interned spelling when known
+# and as first seen otherwise. CSeq and Content-Length values are integers.
+COMMON_HEADERS = ("CSeq", "Content-Length", "Content-Type", "Session",
+                  "Transport", "Public", "Require", "Date", "Server",
+                  "User-Agent", "Unsupported")
+INTEGER_HEADERS = frozenset(("CSeq", "Content-Length"))
+_canonical_names = {}
+for _name in COMMON_HEADERS:
+  _canonical_names[_name] = _canonical_names[_name.lower()] = sys.intern(_name)
 
-  version, status = status_line.split(" ")[:2]
 
-  return (RtspResponse(int(status), headers, content), length)
+def canonical_header(name):
+  return _canonical_names.get(name) or _canonical_names.get(name.lower(), name)
+
+
+class RtspHeaders(dict):
+  # Reads with the stored spelling run at plain dict speed; any other
+  # spelling is resolved case-insensitively on a miss.
+  __slots__ = ()
+
+  def __init__(self, headers=None, **fields):
+    if headers or fields:
+      self.update(headers, **fields)
+
+  def _key(self, name):
+    key = _canonical_names.get(name) or _canonical_names.get(name.lower())
+    if key is not None:
+      return key
+    if dict.__contains__(self, name):
+      return name
+    lower = name.lower()
+    for stored in self:
+      if stored.lower() == lower:
+        return stored
+    return name
+
+  def __missing__(self, name):
+    key = self._key(name)
+    if key != name and dict.__contains__(self, key):
+      return dict.__getitem__(self, key)
+    raise KeyError(name)
+
+  def __contains__(self, name):
+    return dict.__contains__(self, name) or dict.__contains__(self, self._key(name))
+
+  def get(self, name, default=None):
+    if dict.__contains__(self, name):
+      return dict.__getitem__(self, name)
+    return dict.get(self, self._key(name), default)
+
+  def __setitem__(self, name, value):
+    key = self._key(name)
+    if key in INTEGER_HEADERS:
+      value = int(value)
+    dict.__setitem__(self, key, value)
+
+  def __delitem__(self, name):
+    dict.__delitem__(self, self._key(name))
+
+  def pop(self, name, *default):
+    return dict.pop(self, self._key(name), *default)
+
+  def setdefault(self, name, default=None):
+    if name not in self:
+      self[name] = default
+    return self[name]
+
+  def update(self, headers=None, **fields):
+    if headers:
+      if hasattr(headers, "items"):
+        headers = headers.items()
+      for name, value in headers:
+        self[name] = value
+    for name, value in fields.items():
+      self[name] = value
+
+  def copy(self):
+    return RtspHeaders(self)
+
+  def __repr__(self):
+    return "RtspHeaders({0})".format(dict.__repr__(self))
+
+
+_merge = dict.update
+
+
+def _decode(data):
+  try:
+    return str(data, 'ascii')
+  except UnicodeDecodeError as e:
+    raise RtspParseError("Non-ASCII byte at offset {0}".format(e.start))
+
+
+class RtspParser(object):
+
+  def __init__(self, max_header_size=DEFAULT_MAX_HEADER_SIZE,
+               max_content_length=DEFAULT_MAX_CONTENT_LENGTH):
+    self.max_header_size = max_header_size
+    self.max_content_length = max_content_length
+    self.buffer = bytearray()
+    self.cursor = 0
+    self.consumed = 0
+    self._scan = 0
+
+  def feed(self, data):
+    self.buffer += data
+    return self.messages()
+
+  def messages(self):
+    while True:
+      message = self._next_message()
+      if message is None:
+        break
+      yield message
+    self._compact()
+
+  def feed_frames(self, data):
+    self.buffer += data
+    return self.frames()
+
+  def frames(self):
+    # Like messages(), but yields (message, raw bytes of the message).
+    while True:
+      start = self.cursor
+      message = self._next_message()
+      if message is None:
+        break
+      yield message, bytes(self.buffer[start:self.cursor])
+    self._compact()
+
+  def _next_message(self):
+    header_end = self.buffer.find(b"\r\n\r\n", max(self.cursor, self._scan))
+    if header_end < 0:
+      if len(self.buffer) - self.cursor > self.max_header_size:
+        raise RtspParseError("Header exceeds {0} bytes".format(self.max_header_size))
+      self._scan = max(self.cursor, len(self.buffer) - 3)
+      return None
+    if header_end - self.cursor > self.max_header_size:
+      raise RtspParseError("Header exceeds {0} bytes".format(self.max_header_size))
+
+    with memoryview(self.buffer) as view:
+      lines = _decode(view[self.cursor:header_end]).split("\r\n")
+      items = {}
+      canonical = _canonical_names.get
+      for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+          name = name.strip()
+          items[canonical(name) or canonical(name.lower(), name)] = value.strip()
+      for name in INTEGER_HEADERS:
+        value = items.get(name)
+        if value is not None:
+          try:
+            items[name] = int(value)
+          except ValueError:
+            raise RtspParseError("Bad {0}: {1}".format(name, value))
+      content_length = items.get("Content-Length", 0)
+      headers = RtspHeaders.__new__(RtspHeaders)
+      _merge(headers, items)
+      if not 0 <= content_length <= self.max_content_length:
+        raise RtspParseError("Content-Length {0} out of range".format(content_length))
+
+      body_start = header_end + 4
+      body_end = body_start + content_length
+      if body_end > len(self.buffer):
+        self._scan = header_end
+        return None
+
+      content = None
+      if body_end > body_start:
+        content = _decode(view[body_start:body_end])
+
+    self.consumed += body_end - self.cursor
+    self.cursor = self._scan = body_end
+
+    status_line = lines[0].split(" ")
+    try:
+      if status_line[0].startswith('RTSP'):
+        message = RtspResponse._parsed(headers, content)
+        message.status = int(status_line[1])
+      else:
+        message = RtspRequest._parsed(headers, content)
+        message.method, message.url, version = status_line
+    except (ValueError, IndexError):
+      raise RtspParseError("Bad start line: {0}".format(lines[0]))
+    return message
+
+  def _compact(self):
+    if self.cursor:
+      del self.buffer[:self.cursor]
+      self._scan = max(0, self._scan - self.cursor)
+      self.cursor = 0
 
 
 class RtspMessage(object):
+  __slots__ = ("version", "headers", "content")
 
-  def __init__(self, headers={}, content=None):
+  def __init__(self, headers=None, content=None):
     self.version = VERSION
-    self.headers = headers
+    self.headers = RtspHeaders(headers)
     self.set_content(content)
 
+  @classmethod
+  def _parsed(cls, headers, content):
+    # Skips __init__ and adopts the headers the parser built.
+    message = cls.__new__(cls)
+    message.version = VERSION
+    message.headers = headers
+    message.content = content
+    return message
+
   def set_content(self, content):
     if content:
       self.content = content.data
-      self.headers["Content-Type"] = content.type
+      if content.type is not None:
+        self.headers["Content-Type"] = content.type
       self.headers["Content-Length"] = len(content.data)
     else:
       self.content = None
 
   @property
   def cseq(self):
-      return int(self.headers['CSeq'])
+      return self.headers['CSeq']
 
   @cseq.setter
   def cseq(self, value):
       self.headers['CSeq'] = str(value)
 
-  def __str__(self):
-    lines = []
-    lines.append(self._get_status_line())
-
-    for header_name in self.headers.keys():
-      lines.append("{0}: {1}".format(header_name, self.headers[header_name]))
-
-    lines.append("")
+  def to_bytes(self, **fields):
+    self.headers.update(fields)
+    return _serialize(self._get_status_line(), self.headers, self.content)
 
-    lines.append(self.content if self.content else "")
-
-    return "\r\n".join(lines)
+  def __str__(self):
+    return self.to_bytes().decode("ascii")
 
 
 class RtspRequest(RtspMessage):
+  __slots__ = ("method", "url")
 
-  def __init__(self, method, url="*", headers={}, content=None):
+  def __init__(self, method, url="*", headers=None, content=None):
     super(RtspRequest, self).__init__(headers, content)
     self.method = method
     self.url = url
@@ -104,6 +272,7 @@ class RtspRequest(RtspMessage):
 
 
 class RtspResponse(RtspMessage):
+  __slots__ = ("status",)
   STATUSES = {
       100: 'Continue',
       200: 'OK',
@@ -152,7 +321,7 @@ class RtspResponse(RtspMessage):
       551: 'Option not supported',
   }
 
-  def __init__(self, status=200, headers={}, content=None):
+  def __init__(self, status=200, headers=None, content=None):
     super(RtspResponse, self).__init__(headers, content)
     self.status = status
 
@@ -161,62 +330,60 @@ class RtspResponse(RtspMessage):
 
 
 class RtspContent(object):
+  __slots__ = ("type", "data")
 
   def __init__(self, type, data):
     self.type = type
     self.data = data
 
 
-class RtspEndpoint(object):
-
-  def __init__(self, socket, receiver):
-    self.socket = socket
-    self.receiver = receiver
-    self.request_cseq = 0
-    self.buffer = ""
-
-  def send_request(self, request):
-    request.headers["CSeq"] = self.request_cseq
-    self._send(request)
-
-    print("Waiting for response...")
-
-    response, length = response_from_string(self.buffer)
-    if not response:
-      self._recv()
-      response, length = response_from_string(self.buffer)
-    if not response:
-      raise Exception("Response not received")
-    self.buffer = self.buffer[length:]
-
-    if int(response.headers["CSeq"]) != self.request_cseq:
-      raise Exception("Bad CSeq in received response.")
-    self.request_cseq += 1
-    self.receiver.process_response(response, request.method)
-
-  def wait_for_request(self):
-    print("Waiting for request...")
-
-    request, length = request_from_string(self.buffer)
-    if not request:
-      self._recv()
-      request, length = request_from_string(self.buffer)
-    if not request:
-      raise Exception("Request not received")
-    self.buffer = self.buffer[length:]
-
-    response = self.receiver.process_request(request)
-    response.headers["CSeq"] = request.headers["CSeq"]
-    self._send(response)
-
-  def teardown(self):
-    self.socket.close()
-
-  def _recv(self):
-    data = self.socket.recv(2048)
-    self.buffer += data.decode('ascii')
-    print("BUFFER: '{0}'".format(self.buffer))
-
-  def _send(self, data):
-    self.socket.send(str(data).encode("ascii"))
-    print("SEND:'{0}'".format(str(data)))
+class RtspTemplate(object):
+
+  def __init__(self, message, fields=("CSeq",)):
+    self.method = getattr(message, "method", None)
+    self.status = getattr(message, "status", None)
+
+    headers = dict(message.headers.items())
+    for index, field in enumerate(fields):
+      headers[field] = "\0{0}\0".format(index)
+    chunks = _serialize(message._get_status_line(), headers, message.content).split(b"\0")
+
+    self.literals = chunks[0::2]
+    self.fields = [fields[int(index)] for index in chunks[1::2]]
+
+  def to_bytes(self, **fields):
+    literals = iter(self.literals)
+    parts = [next(literals)]
+    for field, literal in zip(self.fields, literals):
+      parts.append(str(fields[field]).encode("ascii"))
+      parts.append(literal)
+    return b"".join(parts)
+
+
+# Keys include per-sink bodies and ports, so the least recently used
+# templates are dropped past MAX_TEMPLATES.
+MAX_TEMPLATES = 1024
+_templates = collections.OrderedDict()
+
+def cached_template(key, factory, fields=("CSeq",)):
+  template = _templates.get(key)
+  if template is None:
+    template = _templates[key] = RtspTemplate(factory(), fields)
+    if len(_templates) > MAX_TEMPLATES:
+      _templates.popitem(last=False)
+  else:
+    _templates.move_to_end(key)
+  return template
+
+def _serialize(status_line, headers, content):
+  parts = [status_line, "\r\n"]
+  for name, value in headers.items():
+    parts += (name, ": ", str(value), "\r\n")
+  parts.append("\r\n")
+  if content:
+    parts.append(content)
+  return "".join(parts).encode("ascii")
+
+
+class RtspTimeout(Exception):
+  pass
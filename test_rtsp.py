@@ -0,0 +1,119 @@
+import unittest
+import rtsp
+
+
+OPTIONS = (b"OPTIONS * RTSP/1.0\r\n"
+           b"CSeq: 1\r\n"
+           b"Require: org.wfa.wfd1.0\r\n\r\n")
+GET_PARAMETER = (b"GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\n"
+                 b"CSeq: 2\r\n"
+                 b"Content-Type: text/parameters\r\n"
+                 b"Content-Length: 19\r\n\r\n"
+                 b"wfd_video_formats\r\n")
+RESPONSE = (b"RTSP/1.0 200 OK\r\n"
+            b"CSeq: 1\r\n"
+            b"Public: org.wfa.wfd1.0, GET_PARAMETER, SET_PARAMETER\r\n\r\n")
+
+
+class RtspParserTest(unittest.TestCase):
+
+  def feed(self, *chunks, **limits):
+    parser = rtsp.RtspParser(**limits)
+    messages = []
+    for chunk in chunks:
+      messages.extend(parser.feed(chunk))
+    return parser, messages
+
+  def assertParseError(self, *chunks, **limits):
+    with self.assertRaises(rtsp.RtspParseError):
+      self.feed(*chunks, **limits)
+
+  def test_request(self):
+    _, (message,) = self.feed(OPTIONS)
+    self.assertIsInstance(message, rtsp.RtspRequest)
+    self.assertEqual(message.method, "OPTIONS")
+    self.assertEqual(message.url, "*")
+    self.assertEqual(message.cseq, 1)
+    self.assertEqual(message.headers["require"], "org.wfa.wfd1.0")
+    self.assertIsNone(message.content)
+
+  def test_response(self):
+    _, (message,) = self.feed(RESPONSE)
+    self.assertIsInstance(message, rtsp.RtspResponse)
+    self.assertEqual(message.status, 200)
+    self.assertEqual(message.cseq, 1)
+
+  def test_body(self):
+    _, (message,) = self.feed(GET_PARAMETER)
+    self.assertEqual(message.headers["Content-Length"], 19)
+    self.assertEqual(message.content, "wfd_video_formats\r\n")
+
+  def test_split_at_every_byte(self):
+    data = OPTIONS + GET_PARAMETER
+    parser, messages = self.feed(*[data[i:i + 1] for i in range(len(data))])
+    self.assertEqual([m.method for m in messages], ["OPTIONS", "GET_PARAMETER"])
+    self.assertEqual(messages[1].content, "wfd_video_formats\r\n")
+    self.assertEqual(parser.consumed, len(data))
+
+  def test_split_inside_terminator_and_body(self):
+    split = GET_PARAMETER.index(b"\r\n\r\n") + 2
+    parser, messages = self.feed(GET_PARAMETER[:split], GET_PARAMETER[split:-5])
+    self.assertEqual(messages, [])
+    self.assertEqual(len(list(parser.feed(GET_PARAMETER[-5:]))), 1)
+
+  def test_pipelined(self):
+    _, messages = self.feed(OPTIONS + GET_PARAMETER + RESPONSE)
+    self.assertEqual([m.cseq for m in messages], [1, 2, 1])
+    self.assertIsInstance(messages[2], rtsp.RtspResponse)
+
+  def test_frames(self):
+    parser = rtsp.RtspParser()
+    frames = [frame for _, frame in parser.feed_frames(OPTIONS + RESPONSE)]
+    self.assertEqual(frames, [OPTIONS, RESPONSE])
+
+  def test_round_trip(self):
+    request = rtsp.RtspRequest(
+      "SET_PARAMETER", "rtsp://localhost/wfd1.0",
+      content=rtsp.RtspContent("text/parameters", "wfd_trigger_method: SETUP\r\n"))
+    _, (message,) = self.feed(request.to_bytes(CSeq=7))
+    self.assertEqual(message.method, "SET_PARAMETER")
+    self.assertEqual(message.cseq, 7)
+    self.assertEqual(message.content, "wfd_trigger_method: SETUP\r\n")
+
+  def test_bad_start_line(self):
+    self.assertParseError(b"OPTIONS\r\nCSeq: 1\r\n\r\n")
+    self.assertParseError(b"RTSP/1.0 OK\r\nCSeq: 1\r\n\r\n")
+
+  def test_bad_integer_header(self):
+    self.assertParseError(b"OPTIONS * RTSP/1.0\r\nCSeq: one\r\n\r\n")
+    self.assertParseError(
+      b"OPTIONS * RTSP/1.0\r\nCSeq: 1\r\nContent-Length: -1\r\n\r\n")
+
+  def test_non_ascii(self):
+    self.assertParseError(b"OPTIONS * RTSP/1.0\r\nCSeq: \xff\r\n\r\n")
+
+  def test_header_limit(self):
+    self.assertParseError(b"OPTIONS * RTSP/1.0\r\n" + b"X: y\r\n" * 20,
+                          max_header_size=64)
+    self.assertParseError(OPTIONS, max_header_size=16)
+
+  def test_content_limit(self):
+    self.assertParseError(GET_PARAMETER, max_content_length=18)
+
+
+class RtspTemplateTest(unittest.TestCase):
+
+  def test_fields(self):
+    template = rtsp.RtspTemplate(rtsp.RtspResponse())
+    self.assertEqual(template.to_bytes(CSeq=3),
+                     b"RTSP/1.0 200 OK\r\nCSeq: 3\r\n\r\n")
+
+  def test_cache_is_bounded(self):
+    for key in range(rtsp.MAX_TEMPLATES + 10):
+      rtsp.cached_template(("test", key), rtsp.RtspResponse)
+    self.assertLessEqual(len(rtsp._templates), rtsp.MAX_TEMPLATES)
+    self.assertNotIn(("test", 0), rtsp._templates)
+
+
+if __name__ == "__main__":
+  unittest.main()
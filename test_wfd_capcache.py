@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import unittest
+import wfd_capcache
+import wfd_core
+import wfd_sim
+
+
+BODY = wfd_core.SinkCore.GET_PARAMETER.format(1028)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def session(capabilities, rtp_port=1028, peer='sim'):
+    pair = wfd_sim.SimPair(wfd_sim.SimClock(), rtp_port=rtp_port,
+                           capabilities=capabilities)
+    pair.source.peer = peer
+    pair.start()
+    while not pair.done:
+        if not pair.step():
+            raise AssertionError('Stalled at {0}/{1}'.format(
+                pair.source.state, pair.sink.state))
+    pair.close()
+    return pair
+
+
+class KeyTest(unittest.TestCase):
+
+    def test_line_order_ignored(self):
+        lines = BODY.splitlines(True)
+        self.assertEqual(wfd_capcache.key('sim', BODY),
+                         wfd_capcache.key('sim', ''.join(reversed(lines))))
+
+    def test_parts(self):
+        keys = {wfd_capcache.key('sim', BODY),
+                wfd_capcache.key('other', BODY),
+                wfd_capcache.key('sim', BODY, 7239),
+                wfd_capcache.key('sim',
+                                 wfd_core.SinkCore.GET_PARAMETER.format(1030))}
+        self.assertEqual(len(keys), 4)
+
+
+class CapabilityCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = wfd_capcache.CapabilityCache(2, 60.0, clock=self.clock)
+
+    def put(self, key):
+        return self.cache.put(key, BODY, {}, 'm4', 0.001, 0.01)
+
+    def test_lru(self):
+        self.put('a')
+        self.put('b')
+        self.assertIsNotNone(self.cache.get('a'))
+        self.put('c')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.report()['evicted'], 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_ttl(self):
+        self.put('a')
+        self.clock.now += 61.0
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.report()['expired'], 1)
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache.path = os.path.join(directory, 'capabilities.json')
+        self.put('a')
+        self.cache.save()
+        cache = wfd_capcache.CapabilityCache(path=self.cache.path,
+                                             clock=self.clock)
+        self.assertEqual(cache.load(), 1)
+        entry = cache.get('a')
+        self.assertEqual((entry.set_parameter, entry.m4_seconds), ('m4', 0.01))
+        self.assertEqual(entry.sink_parameters['wfd_client_rtp_ports'].port0,
+                         1028)
+
+
+class SourceCoreTest(unittest.TestCase):
+
+    def test_reconnect_hits(self):
+        cache = wfd_capcache.CapabilityCache()
+        first = session(cache)
+        second = session(cache)
+        self.assertIsNone(wfd_sim.check(first, 1))
+        self.assertIsNone(wfd_sim.check(second, 1))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(second.source.set_parameter,
+                         first.source.set_parameter)
+
+    def test_sinks_sharing_an_address(self):
+        # Two sinks behind one address, say a NAT, each with its own RTP
+        # port; neither may get an M4 negotiated for the other.
+        cache = wfd_capcache.CapabilityCache()
+        for rtp_port in (1028, 1030, 1028, 1030):
+            pair = session(cache, rtp_port)
+            self.assertIsNone(wfd_sim.check(pair, 1))
+            self.assertEqual(pair.sink.negotiated_parameters[
+                'wfd_client_rtp_ports'].port0, rtp_port)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_timed_by_core_clock(self):
+        # wfd_sim's clock never moves, so neither do the recorded costs.
+        cache = wfd_capcache.CapabilityCache()
+        session(cache)
+        entry, = cache.entries.values()
+        self.assertEqual((entry.negotiate_seconds, entry.m4_seconds),
+                         (0.0, 0.0))
+
+    def test_changed_sink_misses(self):
+        cache = wfd_capcache.CapabilityCache()
+        session(cache, 1028)
+        pair = session(cache, 1030)
+        self.assertEqual(pair.source.sink_rtp_port, 1030)
+        self.assertEqual(cache.hits, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import unittest
+import rtsp
+import wfd_core
+from rtsp import RtspContent
+
+
+def setup_request(transport, cseq=5):
+    return ('SETUP rtsp://localhost/wfd1.0/streamid=0 RTSP/1.0\r\n'
+            'CSeq: {0}\r\nTransport: {1}\r\n\r\n'.format(cseq, transport)
+            ).encode('ascii')
+
+
+def play_request(cseq=6):
+    return ('PLAY rtsp://localhost/wfd1.0/streamid=0 RTSP/1.0\r\n'
+            'CSeq: {0}\r\n\r\n'.format(cseq)).encode('ascii')
+
+
+def response(cseq, status=200, content=None):
+    return rtsp.RtspResponse(status, content=content).to_bytes(CSeq=cseq)
+
+
+def responses(core):
+    return list(rtsp.RtspParser().feed(core.data_to_send()))
+
+
+class SetupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = wfd_core.SourceCore()
+        self.source.state = wfd_core.SETUP
+
+    def test_client_ports(self):
+        for transport, expected in (
+                ('RTP/AVP/UDP;unicast;client_port=1028', (1028, 1029)),
+                ('RTP/AVP/UDP;unicast; client_port=1028-1040', (1028, 1040)),
+                ('RTP/AVP/UDP;unicast', None),
+                ('RTP/AVP/UDP;unicast;client_port=abc', None),
+                ('RTP/AVP/UDP;unicast;client_port=1028-', None),
+                ('RTP/AVP/UDP;unicast;client_port=1-2-3', None),
+                ('RTP/AVP/UDP;unicast;client_port=0', None),
+                ('RTP/AVP/UDP;unicast;client_port=65535', None)):
+            self.assertEqual(wfd_core.client_ports(transport), expected,
+                             transport)
+
+    def test_setup(self):
+        self.source.receive_data(
+            setup_request('RTP/AVP/UDP;unicast;client_port=1028'))
+        response, = responses(self.source)
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.headers['Session'].endswith(';timeout=30'))
+        self.assertEqual(self.source.sink_rtp_port, 1028)
+        self.assertEqual(self.source.state, wfd_core.PAUSE)
+
+    def test_bad_transport_refused(self):
+        self.source.receive_data(
+            setup_request('RTP/AVP/UDP;unicast;client_port=abc'))
+        response, = responses(self.source)
+        self.assertEqual((response.status, response.cseq), (461, 5))
+        self.assertEqual(self.source.state, wfd_core.SETUP)
+        self.source.receive_data(
+            setup_request('RTP/AVP/UDP;unicast;client_port=1030', 6))
+        self.assertEqual(responses(self.source)[0].status, 200)
+        self.assertEqual(self.source.sink_rtp_port, 1030)
+
+
+class ReceiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = wfd_core.SourceCore()
+        self.source.state = wfd_core.SETUP
+        self.data = (setup_request('RTP/AVP/UDP;unicast;client_port=1028') +
+                     play_request())
+
+    def assertAnswered(self):
+        self.assertEqual([(r.status, r.cseq) for r in responses(self.source)],
+                         [(200, 5), (200, 6)])
+        self.assertEqual(self.source.state, wfd_core.PLAY)
+
+    def test_pipelined_in_order(self):
+        self.source.receive_data(self.data)
+        self.assertAnswered()
+
+    def test_split_at_every_byte(self):
+        for i in range(len(self.data)):
+            self.source.receive_data(self.data[i:i + 1])
+        self.assertAnswered()
+
+    def test_out_of_state_answered(self):
+        self.source.receive_data(play_request(5))
+        response, = responses(self.source)
+        self.assertEqual((response.status, response.cseq), (455, 5))
+        self.assertEqual(self.source.state, wfd_core.SETUP)
+
+    def test_header_limit(self):
+        data = b'OPTIONS * RTSP/1.0\r\nCSeq: 1\r\nX: ' + b'x' * (
+            self.source.MAX_HEADER_SIZE)
+        with self.assertRaises(rtsp.RtspParseError):
+            for i in range(0, len(data), 1024):
+                self.source.receive_data(data[i:i + 1024])
+
+    def test_content_limit(self):
+        with self.assertRaises(rtsp.RtspParseError):
+            self.source.receive_data(
+                'OPTIONS * RTSP/1.0\r\nCSeq: 1\r\nContent-Length: {0}\r\n'
+                '\r\n'.format(self.source.MAX_CONTENT_LENGTH + 1).encode())
+
+    def test_message_without_cseq(self):
+        with self.assertRaises(rtsp.RtspParseError):
+            self.source.receive_data(b'OPTIONS * RTSP/1.0\r\n\r\n')
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sink = wfd_core.SinkCore(clock=self.clock)
+        self.sink.state = wfd_core.PAUSE
+
+    def request(self, timeout=None):
+        return self.sink.request(self.sink.PAUSE_TEMPLATE, timeout,
+                                 notify=False)
+
+    def test_matched_by_cseq(self):
+        first, second = self.request(), self.request()
+        self.sink.receive_data(response(1, 406) + response(0))
+        self.assertEqual(first.result(0).status, 200)
+        self.assertEqual(second.result(0).status, 406)
+        self.assertEqual(self.sink.pending, {})
+
+    def test_request_while_pending(self):
+        future = self.request()
+        self.sink.data_to_send()
+        self.sink.receive_data(
+            b'GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\n'
+            b'CSeq: 9\r\n\r\n' + response(0))
+        answer, = responses(self.sink)
+        self.assertEqual((answer.status, answer.cseq), (200, 9))
+        self.assertTrue(future.done())
+
+    def test_timeout(self):
+        slow, fast = self.request(5.0), self.request(1.0)
+        self.assertEqual(self.sink.next_deadline(), 1001.0)
+        self.clock.now += 1.0
+        self.sink.expire()
+        with self.assertRaises(rtsp.RtspTimeout):
+            fast.result(0)
+        self.assertFalse(slow.done())
+        # The late response is dropped, another CSeq is not.
+        self.sink.receive_data(response(1))
+        with self.assertRaises(wfd_core.WfdProtocolError):
+            self.sink.receive_data(response(7))
+
+    def test_limit(self):
+        self.sink.max_pending_requests = 2
+        self.request()
+        self.request()
+        with self.assertRaises(wfd_core.WfdProtocolError):
+            self.request()
+
+
+class PipelineTest(unittest.TestCase):
+
+    def m3_answered(self, pipeline):
+        source = wfd_core.SourceCore()
+        source.pipeline = pipeline
+        source.state = wfd_core.GET_PARAMETERS
+        cseq = source.send_request(source.GET_PARAMETER_TEMPLATE)
+        source.data_to_send()
+        source.receive_data(response(cseq, content=RtspContent(
+            'text/parameters', wfd_core.SinkCore.GET_PARAMETER.format(1028))))
+        return source, responses(source)
+
+    def test_waits_for_m4(self):
+        source, (m4,) = self.m3_answered(False)
+        self.assertNotIn('wfd_trigger_method', m4.content)
+        source.receive_data(response(m4.cseq))
+        m5, = responses(source)
+        self.assertIn('wfd_trigger_method: SETUP', m5.content)
+
+    def test_pipelined(self):
+        source, (m4, m5) = self.m3_answered(True)
+        self.assertEqual(m5.cseq, m4.cseq + 1)
+        self.assertIn('wfd_trigger_method: SETUP', m5.content)
+        # SETUP may overtake the M5 response.
+        source.receive_data(response(m4.cseq) + setup_request(
+            'RTP/AVP/UDP;unicast;client_port=1028', 3) + response(m5.cseq))
+        self.assertEqual(responses(source)[0].status, 200)
+        self.assertEqual(source.state, wfd_core.PAUSE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import os
+import socket
+import threading
+import unittest
+import rtsp
+import wfd_client
+import wfd_core
+import wfd_loop
+
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Protocol(object):
+
+    def __init__(self):
+        self.data = b''
+        self.lost = []
+
+    def data_received(self, data):
+        self.data += data
+
+    def connection_lost(self, error):
+        self.lost.append(error)
+
+
+class EventLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.loop = wfd_loop.EventLoop(self.clock)
+        self.addCleanup(self.loop.close)
+
+    def test_timers(self):
+        calls = []
+        self.loop.call_later(2.0, calls.append, 'second')
+        self.loop.call_later(1.0, calls.append, 'first')
+        self.loop.call_later(1.0, calls.append, 'cancelled').cancel()
+        self.loop.call_later(3.0, calls.append, 'later')
+        self.clock.now += 2.0
+        self.loop.run_once(0)
+        self.assertEqual(calls, ['first', 'second'])
+
+    def test_add_reader(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        calls = []
+        self.loop.add_reader(a, lambda: calls.append(a.recv(16)))
+        b.send(b'x')
+        self.loop.run_once(1.0)
+        self.assertEqual(calls, [b'x'])
+        self.loop.remove_reader(a)
+        b.send(b'y')
+        self.loop.run_once(0)
+        self.assertEqual(calls, [b'x'])
+
+
+class ConnectionTest(EventLoopTest):
+
+    def connection(self, read_timeout=None):
+        sock, self.peer = socket.socketpair()
+        self.addCleanup(self.peer.close)
+        self.protocol = Protocol()
+        return wfd_loop.Connection(self.loop, sock, self.protocol,
+                                   read_timeout)
+
+    def test_writes_coalesced(self):
+        connection = self.connection()
+        connection.write(b'ab')
+        connection.write(b'cd')
+        self.assertEqual(connection.output, [b'ab', b'cd'])
+        self.loop.run_once(1.0)
+        self.assertEqual(self.peer.recv(16), b'abcd')
+        self.assertEqual(connection.output, [])
+
+    def test_close_flushes_output(self):
+        connection = self.connection()
+        connection.write(b'bye')
+        connection.close()
+        self.assertFalse(connection.closed)
+        self.loop.run_once(1.0)
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.protocol.lost, [None])
+        self.assertEqual(self.peer.recv(16), b'bye')
+
+    def test_read_deadline(self):
+        connection = self.connection(1.0)
+        self.clock.now += 0.5
+        self.peer.send(b'x')
+        self.loop.run_once(1.0)
+        self.assertEqual(self.protocol.data, b'x')
+        self.clock.now += 0.5
+        self.loop.run_once(0)
+        self.assertFalse(connection.closed)
+        self.clock.now += 0.5
+        self.loop.run_once(0)
+        self.assertTrue(connection.closed)
+        error, = self.protocol.lost
+        self.assertIsInstance(error, rtsp.RtspTimeout)
+
+    def test_peer_closed(self):
+        connection = self.connection()
+        self.peer.close()
+        self.loop.run_once(1.0)
+        self.assertTrue(connection.closed)
+        self.assertEqual(len(self.protocol.lost), 1)
+
+
+class ListenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = wfd_loop.EventLoop()
+        self.addCleanup(self.loop.close)
+        self.accepted = []
+        self.listener = wfd_loop.listen(
+            self.loop, 0, lambda sock, address: self.accepted.append(sock),
+            '127.0.0.1')
+        self.addCleanup(self.listener.close)
+
+    def connect(self):
+        client = socket.create_connection(self.listener.getsockname())
+        self.addCleanup(client.close)
+
+    def accept(self, count):
+        for _ in range(10):
+            if len(self.accepted) >= count:
+                break
+            self.loop.run_once(0.5)
+        for sock in self.accepted:
+            sock.close()
+        return len(self.accepted)
+
+    def test_accept(self):
+        self.connect()
+        self.connect()
+        self.assertEqual(self.accept(2), 2)
+
+    @unittest.skipIf(resource is None, 'needs RLIMIT_NOFILE')
+    def test_backs_off_out_of_descriptors(self):
+        self.connect()
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE,
+                        (soft, hard))
+        # Descriptors are allocated lowest first, so capping the limit at the
+        # lowest free one makes accept() fail with EMFILE.
+        free = os.dup(0)
+        os.close(free)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (free, hard))
+        self.loop.run_once(1.0)
+        self.assertEqual(self.accepted, [])
+        self.assertNotIn(self.listener, self.loop.selector.get_map())
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        self.assertEqual(self.accept(1), 1)
+
+
+class RtspEndpointTest(unittest.TestCase):
+
+    def serve(self):
+        # A SourceCore on its own endpoint and thread, answering one sink.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.source = wfd_core.SourceCore()
+        self.errors = []
+
+        def run():
+            sock, _ = listener.accept()
+            endpoint = wfd_loop.RtspEndpoint(sock, self.source)
+            try:
+                endpoint.start()
+                endpoint.run_until(lambda: self.source.closing)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                endpoint.teardown()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 5.0)
+        return listener.getsockname()[1]
+
+    def test_round_trip(self):
+        port = self.serve()
+        client = wfd_client.WfdClient(1030)
+        endpoint = client.open('127.0.0.1', port)
+        self.assertEqual(client.state, wfd_core.PAUSE)
+        self.assertEqual(client.negotiated_parameters[
+            'wfd_client_rtp_ports'].port0, 1030)
+        response = endpoint.send_request(client.PLAY_TEMPLATE)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(client.state, wfd_core.PLAY)
+        future = endpoint.request(client.TEARDOWN_TEMPLATE)
+        endpoint.wait(future)
+        self.assertEqual(client.state, wfd_core.CLOSED)
+        endpoint.teardown()
+        self.assertEqual(self.errors, [])
+
+    def test_timeout_fails_the_future(self):
+        silent, sock = socket.socketpair()
+        self.addCleanup(silent.close)
+        endpoint = wfd_loop.RtspEndpoint(sock, wfd_core.SinkCore())
+        self.addCleanup(endpoint.teardown)
+        future = endpoint.request(wfd_core.SinkCore.PLAY_TEMPLATE, 0.05)
+        with self.assertRaises(rtsp.RtspTimeout):
+            endpoint.wait(future)
+        self.assertTrue(silent.recv(4096).startswith(b'PLAY '))
+
+
+if __name__ == '__main__':
+    unittest.main()
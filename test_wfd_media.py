@@ -0,0 +1,239 @@
+import os
+import socket
+import struct
+import tempfile
+import unittest
+import wfd_media
+
+
+CHUNKS = 100
+PCR_EVERY = 5                 # chunks
+ACCESS_POINT_EVERY = 20       # chunks
+CHUNK_SECONDS = 0.01
+
+
+def ts_packet(index, pcr=None, random_access=False):
+    header = bytes((wfd_media.TS_SYNC_BYTE, 0x01, 0x00))
+    if pcr is None and not random_access:
+        return header + bytes((0x10 | index & 0x0F,)) + bytes(184)
+    flags = (0x10 if pcr is not None else 0) | (0x40 if random_access else 0)
+    field = bytes((183, flags))
+    if pcr is not None:
+        base = int(pcr * 90000)
+        field += struct.pack('>IH', base >> 1, (base & 1) << 15 | 0x7E00)
+    return header + bytes((0x30 | index & 0x0F,)) + field.ljust(184, b'\xff')
+
+
+def write_ts(path):
+    # CHUNKS RTP payloads CHUNK_SECONDS apart, a PCR opening every
+    # PCR_EVERY of them and a random access point every ACCESS_POINT_EVERY.
+    with open(path, 'wb') as f:
+        for chunk in range(CHUNKS):
+            for packet in range(wfd_media.TS_PACKETS_PER_RTP):
+                index = chunk * wfd_media.TS_PACKETS_PER_RTP + packet
+                first = packet == 0
+                f.write(ts_packet(
+                    index,
+                    chunk * CHUNK_SECONDS
+                    if first and chunk % PCR_EVERY == 0 else None,
+                    first and chunk % ACCESS_POINT_EVERY == 10))
+
+
+class Scheduler(object):
+    # call_later that runs nothing until told to.
+
+    def __init__(self):
+        self.calls = []
+
+    def call_later(self, delay, callback):
+        call = Call(delay, callback)
+        self.calls.append(call)
+        return call
+
+
+class Call(object):
+
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BlockedSocket(object):
+    # A sink that never drains its socket buffer.
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        raise BlockingIOError()
+
+    def close(self):
+        pass
+
+
+class MediaTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        fd, cls.path = tempfile.mkstemp(suffix='.ts')
+        os.close(fd)
+        write_ts(cls.path)
+        cls.ts_file = wfd_media.TsFile(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts_file.close()
+        os.remove(cls.path)
+
+    def receiver(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(1.0)
+        return sock
+
+    def receive(self, sock, count):
+        return [sock.recv(2048) for _ in range(count)]
+
+
+class TsFileTest(MediaTestCase):
+
+    def test_times_follow_pcr(self):
+        self.assertEqual(self.ts_file.chunks, CHUNKS)
+        for index in (0, 3, 50, CHUNKS - 1):
+            self.assertAlmostEqual(self.ts_file.times[index],
+                                   index * CHUNK_SECONDS, places=4)
+        self.assertEqual(self.ts_file.rtp_times[50],
+                         int(self.ts_file.times[50] * 90000))
+
+    def test_access_points(self):
+        self.assertEqual([i for i in range(CHUNKS)
+                          if self.ts_file.access_points[i]],
+                         list(range(10, CHUNKS, ACCESS_POINT_EVERY)))
+
+
+class RtpHeaderBlockTest(unittest.TestCase):
+
+    @unittest.skipIf(wfd_media.numpy is None, 'needs NumPy')
+    def test_vectorized_matches_struct(self):
+        timestamps = wfd_media.array.array('q', range(0, 64 * 3000, 3000))
+        headers = []
+        for vectorized in (True, False):
+            block = wfd_media.RtpHeaderBlock(vectorized=vectorized,
+                                             threshold=1)
+            headers.append([bytes(h) for h in
+                            block.fill(0xDEADBEEF, 0xFFF0, timestamps, 7)])
+        self.assertEqual(headers[0], headers[1])
+
+    def test_fields(self):
+        block = wfd_media.RtpHeaderBlock(4)
+        header, last = block.fill(0x1234, 0xFFFF, wfd_media.array.array(
+            'q', (90000, 93000)), 1)
+        self.assertEqual(wfd_media.RTP_HEADER.unpack(header),
+                         (0x80, 33, 0xFFFF, 90001, 0x1234))
+        self.assertEqual(wfd_media.RTP_HEADER.unpack(last)[2:4], (0, 93001))
+
+
+class RtpTsSenderTest(MediaTestCase):
+
+    def test_pump_sends_due_payloads(self):
+        sock = self.receiver()
+        sender = wfd_media.RtpTsSender(self.ts_file, sock.getsockname(),
+                                       ssrc=0x1234, batch_interval=0.0)
+        self.addCleanup(sender.close)
+        sender.play(100.0)
+        delay = sender.pump(100.0 + 2.5 * CHUNK_SECONDS)
+        self.assertAlmostEqual(delay, CHUNK_SECONDS / 2, places=4)
+        packets = self.receive(sock, 3)
+        sequences = [wfd_media.RTP_HEADER.unpack_from(p)[2] for p in packets]
+        self.assertEqual([(s - sequences[0]) & 0xFFFF for s in sequences],
+                         [0, 1, 2])
+        for index, packet in enumerate(packets):
+            self.assertEqual(wfd_media.RTP_HEADER.unpack_from(packet)[4],
+                             0x1234)
+            self.assertEqual(packet[wfd_media.RTP_HEADER.size:],
+                             bytes(self.ts_file.payload(index)))
+        sender.pause()
+        self.assertIsNone(sender.pump(200.0))
+
+    def test_thinning_keeps_access_points(self):
+        sender = wfd_media.RtpTsSender(self.ts_file, ('127.0.0.1', 9))
+        self.addCleanup(sender.close)
+        kept = sender._thin(0, CHUNKS, 0.25)
+        self.assertEqual(sender.thinned, CHUNKS - len(kept))
+        self.assertLess(len(kept), CHUNKS // 2)
+        self.assertTrue(set(range(10, CHUNKS, ACCESS_POINT_EVERY)) <= set(kept))
+
+
+class MediaStreamTest(MediaTestCase):
+
+    def test_play_pause_stop(self):
+        scheduler = Scheduler()
+        source = wfd_media.open_source(self.ts_file, scheduler.call_later)
+        stream = source.open(self.receiver().getsockname())
+        stream.play()
+        stream.play()
+        self.assertEqual(len(scheduler.calls), 1)
+        stream.pause()
+        self.assertTrue(scheduler.calls[0].cancelled)
+        self.assertEqual(stream.stop()['packets'], 0)
+
+
+class BroadcastTest(MediaTestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.scheduler = Scheduler()
+        self.broadcast = wfd_media.Broadcast(
+            self.ts_file, self.scheduler.call_later, ring_size=32,
+            batch_interval=0.0, clock=lambda: self.now)
+        self.addCleanup(self.release)
+
+    def release(self):
+        # The ring's payload views keep the file mapped.
+        for payload in self.broadcast.payloads:
+            if payload is not None:
+                payload.release()
+
+    def subscribe(self):
+        sock = self.receiver()
+        subscriber = self.broadcast.open(sock.getsockname())
+        self.addCleanup(subscriber.stop)
+        subscriber.play()
+        return sock, subscriber
+
+    def run_until(self, now):
+        self.now = now
+        self.scheduler.calls.pop().callback()
+
+    def run_chunks(self, first, last):
+        for chunk in range(first, last + 1):
+            self.run_until(chunk * CHUNK_SECONDS)
+
+    def test_joins_at_access_point(self):
+        sock, subscriber = self.subscribe()
+        self.run_until(5 * CHUNK_SECONDS)
+        self.assertEqual(subscriber.packets, 0)
+        self.run_until(12 * CHUNK_SECONDS)
+        self.assertEqual(subscriber.packets, 3)
+        first = self.receive(sock, 1)[0]
+        self.assertEqual(first[wfd_media.RTP_HEADER.size:],
+                         bytes(self.ts_file.payload(10)))
+
+    def test_subscriber_a_ring_behind_dropped(self):
+        _, subscriber = self.subscribe()
+        _, slow = self.subscribe()
+        slow.socket.close()
+        slow.socket = BlockedSocket()
+        self.run_chunks(10, 40)
+        self.assertFalse(slow.dropped)
+        self.run_chunks(41, 50)
+        self.assertTrue(slow.dropped)
+        self.assertFalse(subscriber.dropped)
+        self.assertNotIn(slow, self.broadcast.subscribers)
+        self.assertEqual(subscriber.packets, 41)
+
+
+if __name__ == '__main__':
+    unittest.main()
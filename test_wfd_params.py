@@ -0,0 +1,123 @@
+import unittest
+import wfd_core
+import wfd_params
+
+
+SINK_BODY = wfd_core.SinkCore.GET_PARAMETER.format(1028)
+# The sink body without its wfd_video_formats line, which comes last.
+SINK_BASE = SINK_BODY[:SINK_BODY.index('wfd_video_formats')]
+URL = 'rtsp://localhost/wfd1.0/streamid=0 none'
+
+
+def video_formats(cea=0, vesa=0, hh=0, level=0x10):
+    return 'wfd_video_formats: 00 00 01 {0:02X} {1:08X} {2:08X} {3:08X} ' \
+           '00 0000 0000 00 none none\r\n'.format(level, cea, vesa, hh)
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_sink_body(self):
+        parameters = wfd_params.parse_parameters(SINK_BODY)
+        self.assertEqual(parameters['wfd_client_rtp_ports'],
+                         wfd_params.ClientRtpPorts('RTP/AVP/UDP;unicast',
+                                                   1028, 0, 'play'))
+        self.assertEqual(parameters['wfd_audio_codecs'],
+                         (wfd_params.AudioCodec('LPCM', 3, 0),))
+        codec, = parameters['wfd_video_formats'].codecs
+        self.assertEqual((codec.profile, codec.level, codec.cea),
+                         (0x01, 0x01, 0x21))
+        self.assertIsNone(codec.max_hres)
+        uibc = parameters['wfd_uibc_capability']
+        self.assertEqual(uibc.input_categories, ('GENERIC',))
+        self.assertEqual(uibc.generic, ('Mouse', 'SingleTouch'))
+        self.assertIsNone(uibc.port)
+        self.assertEqual(parameters['wfd_content_protection'], 'none')
+
+    def test_format_round_trip(self):
+        parameters = wfd_params.parse_parameters(SINK_BODY)
+        again = wfd_params.parse_parameters(
+            wfd_params.format_parameters(parameters))
+        self.assertEqual(dict(again), dict(parameters))
+
+    def test_none_values(self):
+        parameters = wfd_params.parse_parameters(
+            'wfd_video_formats: none\r\nwfd_audio_codecs: none\r\n'
+            'wfd_uibc_capability: none\r\n')
+        self.assertIsNone(parameters['wfd_video_formats'])
+        self.assertEqual(parameters['wfd_audio_codecs'], ())
+        self.assertIsNone(parameters['wfd_uibc_capability'])
+
+    def test_bad_values(self):
+        for body in ('wfd_client_rtp_ports: RTP/AVP/UDP;unicast x 0 '
+                     'mode=play\r\n',
+                     'wfd_audio_codecs: LPCM\r\n',
+                     'wfd_video_formats: 00 00 01 zz\r\n'):
+            with self.assertRaises(wfd_params.WfdProtocolError):
+                wfd_params.parse_parameters(body)
+
+
+class NegotiateTest(unittest.TestCase):
+
+    def negotiate(self, body, uibc_port=None):
+        return wfd_params.parse_parameters(
+            wfd_params.negotiate(body, URL, uibc_port))
+
+    def test_sink_body(self):
+        parameters = self.negotiate(SINK_BODY)
+        self.assertEqual(parameters['wfd_presentation_URL'], URL)
+        self.assertEqual(parameters['wfd_client_rtp_ports'].port0, 1028)
+        self.assertEqual(parameters['wfd_audio_codecs'],
+                         (wfd_params.AudioCodec('LPCM', wfd_params.LPCM_48_KHZ,
+                                                0),))
+        formats = parameters['wfd_video_formats']
+        self.assertEqual(formats.codecs[0].cea, 0x20)
+        self.assertEqual(wfd_params.video_resolution(formats), (1280, 720, 30))
+        self.assertNotIn('wfd_uibc_capability', parameters)
+
+    def test_highest_pixel_rate_within_level(self):
+        for cea, level, expected in ((0x1FFFF, 0x10, (1920, 1080, 60)),
+                                     (0x8040, 0x10, (1280, 720, 60)),
+                                     (0x1FFFF, 0x01, (1280, 720, 30))):
+            parameters = self.negotiate(
+                SINK_BASE + video_formats(cea, level=level))
+            self.assertEqual(wfd_params.video_resolution(
+                parameters['wfd_video_formats']), expected)
+
+    def test_uibc(self):
+        parameters = self.negotiate(SINK_BODY, uibc_port=7239)
+        self.assertEqual(parameters['wfd_uibc_capability'],
+                         wfd_params.UibcCapability(('GENERIC',),
+                                                   ('Mouse', 'SingleTouch'),
+                                                   (), 7239))
+        self.assertEqual(parameters['wfd_uibc_setting'], 'enable')
+
+    def test_no_common_format(self):
+        with self.assertRaises(wfd_params.WfdProtocolError):
+            wfd_params.negotiate(SINK_BODY.replace('LPCM', 'XYZ'), URL)
+        with self.assertRaises(wfd_params.WfdProtocolError):
+            wfd_params.negotiate(
+                SINK_BODY.replace('01 01 00000021', '02 01 00000021'), URL)
+
+    def test_missing_rtp_ports(self):
+        body = ''.join(line + '\r\n' for line in SINK_BODY.split('\r\n')
+                       if line and not line.startswith('wfd_client_rtp_ports'))
+        with self.assertRaises(wfd_params.WfdProtocolError):
+            wfd_params.negotiate(body, URL)
+
+    def test_lower_video_mode(self):
+        sink = wfd_params.parse_parameters(video_formats(0x1FFFF))
+        formats = self.negotiate(
+            SINK_BASE + video_formats(0x1FFFF))['wfd_video_formats']
+        seen = [wfd_params.video_resolution(formats)]
+        while formats is not None:
+            formats = wfd_params.lower_video_mode(
+                formats, sink['wfd_video_formats'])
+            if formats is not None:
+                seen.append(wfd_params.video_resolution(formats))
+        rates = [width * height * rate for width, height, rate in seen]
+        self.assertEqual(rates, sorted(rates, reverse=True))
+        self.assertEqual(seen[-1], (640, 480, 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
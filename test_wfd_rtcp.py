@@ -0,0 +1,166 @@
+import select
+import socket
+import unittest
+import wfd_params
+import wfd_rtcp
+import wfd_sim
+
+
+def block(ssrc=0x1234, fraction_lost=0.25, cumulative_lost=10):
+    return wfd_rtcp.ReportBlock(ssrc, fraction_lost, cumulative_lost,
+                                highest_sequence=70000, jitter=90,
+                                last_sr=0xABCD1234, delay_since_last_sr=65536)
+
+
+class ParseReportBlocksTest(unittest.TestCase):
+
+    def test_receiver_report(self):
+        parsed, = wfd_rtcp.parse_report_blocks(
+            wfd_rtcp.build_receiver_report(0x99, [block()]))
+        self.assertEqual(parsed.ssrc, 0x1234)
+        self.assertEqual(parsed.fraction_lost, 0.25)
+        self.assertEqual(parsed.cumulative_lost, 10)
+        self.assertEqual(parsed.highest_sequence, 70000)
+        self.assertEqual(parsed.jitter, 90)
+        self.assertEqual(parsed.last_sr, 0xABCD1234)
+        self.assertEqual(parsed.delay_since_last_sr, 65536)
+
+    def test_negative_cumulative_lost(self):
+        # Duplicates can push the 24-bit signed count below zero.
+        parsed, = wfd_rtcp.parse_report_blocks(
+            wfd_rtcp.build_receiver_report(0x99, [block(cumulative_lost=-3)]))
+        self.assertEqual(parsed.cumulative_lost, -3)
+
+    def test_compound_packet(self):
+        data = (wfd_rtcp.build_sender_report(0x99, 1000.0, 0, 10, 1880) +
+                wfd_rtcp.build_receiver_report(0x99, [block(1), block(2)]) +
+                wfd_rtcp.build_receiver_report(0x98, []))
+        self.assertEqual([b.ssrc for b in wfd_rtcp.parse_report_blocks(data)],
+                         [1, 2])
+
+    def test_sender_report_without_blocks(self):
+        self.assertEqual(wfd_rtcp.parse_report_blocks(
+            wfd_rtcp.build_sender_report(0x99, 1000.0, 0, 10, 1880)), [])
+
+    def test_other_packet_types_skipped(self):
+        sdes = bytes((0x81, 202, 0, 1)) + b'\x00\x00\x00\x99'
+        data = sdes + wfd_rtcp.build_receiver_report(0x99, [block()])
+        self.assertEqual(len(wfd_rtcp.parse_report_blocks(data)), 1)
+
+    def test_malformed(self):
+        report = wfd_rtcp.build_receiver_report(0x99, [block()])
+        for data in (b'\x40' + report[1:],      # version 1
+                     report[:-4],               # shorter than its length
+                     report[:1] + b'\xc9\x00\x01' + report[4:8]):
+            with self.assertRaises(ValueError):
+                wfd_rtcp.parse_report_blocks(data)
+
+    def test_middle_ntp_bits(self):
+        msw, lsw = wfd_rtcp.ntp_time(1000.5)
+        self.assertEqual(lsw, 1 << 31)
+        self.assertEqual(wfd_rtcp.ntp_middle(1000.5),
+                         (msw & 0xFFFF) << 16 | 0x8000)
+
+
+class Readers(object):
+    # add_reader() and remove_reader() that leave the reading to the test.
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def add_reader(self, sock, callback):
+        self.callbacks[sock] = callback
+
+    def remove_reader(self, sock):
+        del self.callbacks[sock]
+
+
+class RtcpSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = self.socket()
+        self.readers = Readers()
+        self.session = wfd_rtcp.RtcpSession(
+            self.socket(), self.sink.getsockname(), 0x1234,
+            readers=self.readers)
+        self.addCleanup(self.session.socket.close)
+
+    def socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        return sock
+
+    def report(self, reporter=0x99, ssrc=0x1234, sock=None):
+        (sock or self.sink).sendto(
+            wfd_rtcp.build_receiver_report(reporter, [block(ssrc)]),
+            self.session.socket.getsockname())
+        select.select([self.session.socket], [], [], 1.0)
+        self.readers.callbacks[self.session.socket]()
+
+    def test_read_through_readers(self):
+        self.report()
+        self.assertEqual(self.session.stats.reports, 1)
+        self.session.close()
+        self.assertEqual(self.readers.callbacks, {})
+
+    def test_poll_leaves_reads_to_readers(self):
+        self.sink.sendto(wfd_rtcp.build_receiver_report(0x99, [block()]),
+                         self.session.socket.getsockname())
+        select.select([self.session.socket], [], [], 1.0)
+        self.session.poll(0.0, 0, 0, 0)
+        self.assertEqual(self.session.stats.reports, 0)
+
+    def test_other_stream_ignored(self):
+        self.report(ssrc=0x4321)
+        self.assertEqual(self.session.stats.reports, 0)
+        self.assertEqual(self.session.foreign_packets, 0)
+
+    def test_other_host_dropped(self):
+        self.session.address = ('127.0.0.2', self.session.address[1])
+        self.report()
+        self.assertEqual(self.session.stats.reports, 0)
+        self.assertEqual(self.session.foreign_packets, 1)
+
+    def test_other_reporter_dropped(self):
+        self.report(0x99)
+        self.report(0x98, sock=self.socket())
+        self.report(0x99)
+        self.assertEqual(self.session.sink_ssrc, 0x99)
+        self.assertEqual(self.session.stats.reports, 2)
+        self.assertEqual(self.session.foreign_packets, 1)
+
+
+class Rtcp(object):
+    on_lower_mode = None
+
+
+class Stream(object):
+
+    def __init__(self):
+        self.rtcp = Rtcp()
+
+
+class LowerVideoModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = wfd_sim.simulate_session().source
+        self.source.stream = Stream()
+        self.source.stream.rtcp.on_lower_mode = self.source._lower_video_mode
+        self.messages = []
+        self.source.log = self.messages.append
+
+    def lower(self):
+        self.source.stream.rtcp.on_lower_mode()
+        return wfd_params.video_resolution(self.source.video_mode)
+
+    def test_steps_down_and_stays_at_lowest(self):
+        # The simulated sink offers 1280x720p30 and 640x480p60 only.
+        self.assertEqual(self.lower(), (640, 480, 60))
+        self.assertEqual(self.lower(), (640, 480, 60))
+        self.assertIsNone(self.source.stream.rtcp.on_lower_mode)
+        self.assertEqual(len(self.messages), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+import wfd_session
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = wfd_session.TimerWheel(tick=1.0, slots=8, now=0.0)
+        self.fired = []
+
+    def schedule(self, delay):
+        return self.wheel.schedule(delay, lambda: self.fired.append(delay))
+
+    def test_fires_after_delay(self):
+        self.schedule(3)
+        self.assertEqual(self.wheel.advance(2.5), 0)
+        self.assertEqual(self.wheel.advance(3.0), 1)
+        self.assertEqual(self.fired, [3])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_multiple_of_wheel_size_on_time(self):
+        # A delay of exactly one or two revolutions lands on the current
+        # slot and must not wait one more.
+        for delay in (8, 16, 20):
+            self.schedule(delay)
+        for now in range(1, 21):
+            self.wheel.advance(now)
+            self.assertEqual(self.fired, [d for d in (8, 16, 20) if d <= now])
+
+    def test_cancel(self):
+        timer = self.schedule(2)
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.wheel.advance(10.0)
+        self.assertEqual(self.fired, [])
+
+    def test_shortest_delay_one_tick(self):
+        self.schedule(0)
+        self.wheel.advance(1.0)
+        self.assertEqual(self.fired, [0])
+
+
+class SessionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.manager = wfd_session.SessionManager(
+            timeout=10, keepalive_interval=4, tick=1.0, clock=self.clock)
+        self.keepalives = []
+        self.expired = []
+
+    def open(self):
+        return self.manager.open(self.keepalives.append, self.expired.append)
+
+    def advance(self, seconds):
+        for _ in range(seconds):
+            self.clock.now += 1.0
+            self.manager.tick()
+
+    def test_unique_ids(self):
+        self.assertEqual(len({self.open() for _ in range(100)}), 100)
+
+    def test_keepalive_and_expiry(self):
+        session_id = self.open()
+        self.advance(9)
+        self.assertEqual(self.keepalives, [session_id, session_id])
+        self.assertEqual(self.expired, [])
+        self.advance(1)
+        self.assertEqual(self.expired, [session_id])
+        self.assertNotIn(session_id, self.manager.sessions)
+        self.assertEqual(len(self.manager.wheel), 0)
+
+    def test_touch_postpones_expiry(self):
+        session_id = self.open()
+        self.advance(6)
+        self.manager.touch(session_id)
+        self.advance(9)
+        self.assertEqual(self.expired, [])
+        self.advance(1)
+        self.assertEqual(self.expired, [session_id])
+
+    def test_close(self):
+        session_id = self.open()
+        self.manager.close(session_id)
+        self.assertEqual(len(self.manager.wheel), 0)
+        self.advance(20)
+        self.assertEqual((self.keepalives, self.expired), ([], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
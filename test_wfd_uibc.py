@@ -0,0 +1,88 @@
+import struct
+import unittest
+import wfd_uibc
+from wfd_uibc import InputEvent
+
+
+EVENTS = [
+    InputEvent(wfd_uibc.TOUCH_DOWN, ((0, 100, 200),), 1234),
+    InputEvent(wfd_uibc.TOUCH_MOVE, ((0, 110, 210), (1, 300, 400)), None),
+    InputEvent(wfd_uibc.KEY_DOWN, (0x41, 0), None),
+    InputEvent(wfd_uibc.ZOOM, (640, 360, 1, 128), 7),
+    InputEvent(wfd_uibc.VERTICAL_SCROLL, -3, None),
+    InputEvent(wfd_uibc.ROTATE, (-1, 64), None),
+]
+
+
+class DecodeEventsTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = wfd_uibc.encode_events(EVENTS)
+        self.assertEqual(wfd_uibc.decode_events(data), (EVENTS, len(data)))
+
+    def test_timestamp_flag(self):
+        flags, _ = wfd_uibc.HEADER.unpack_from(
+            wfd_uibc.encode_event(EVENTS[0]))
+        self.assertEqual(flags, wfd_uibc.TIMESTAMP_FLAG)
+
+    def test_incomplete_packet_left(self):
+        data = wfd_uibc.encode_events(EVENTS[:2])
+        first = len(wfd_uibc.encode_event(EVENTS[0]))
+        for end in range(first, len(data)):
+            self.assertEqual(wfd_uibc.decode_events(data[:end]),
+                             (EVENTS[:1], first))
+
+    def test_offset(self):
+        data = b'xx' + wfd_uibc.encode_event(EVENTS[2])
+        self.assertEqual(wfd_uibc.decode_events(data, 2),
+                         ([EVENTS[2]], len(data)))
+
+    def test_hidc_skipped(self):
+        hidc = wfd_uibc.HEADER.pack(wfd_uibc.HIDC, 8) + b'\x00' * 4
+        data = hidc + wfd_uibc.encode_event(EVENTS[2])
+        self.assertEqual(wfd_uibc.decode_events(data)[0], [EVENTS[2]])
+
+    def test_unknown_event_kept_raw(self):
+        body = b'\x01\x02'
+        data = (wfd_uibc.HEADER.pack(wfd_uibc.GENERIC, 9) +
+                wfd_uibc.GENERIC_HEADER.pack(20, len(body)) + body)
+        self.assertEqual(wfd_uibc.decode_events(data)[0],
+                         [InputEvent(20, body, None)])
+
+    def test_decoder(self):
+        decoder = wfd_uibc.UibcDecoder()
+        data = wfd_uibc.encode_events(EVENTS)
+        events = []
+        for i in range(len(data)):
+            events.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual(events, EVENTS)
+
+    def assertUibcError(self, data):
+        with self.assertRaises(wfd_uibc.UibcError):
+            wfd_uibc.decode_events(data)
+
+    def test_unsupported_version(self):
+        data = wfd_uibc.encode_event(EVENTS[2])
+        self.assertUibcError(struct.pack('!H', 0x2000) + data[2:])
+
+    def test_bad_length(self):
+        self.assertUibcError(wfd_uibc.HEADER.pack(wfd_uibc.GENERIC, 4))
+
+    def test_body_past_packet(self):
+        self.assertUibcError(wfd_uibc.HEADER.pack(wfd_uibc.GENERIC, 7) +
+                             wfd_uibc.GENERIC_HEADER.pack(wfd_uibc.KEY_DOWN, 5))
+
+    def test_truncated_pointers(self):
+        body = b'\x03' + wfd_uibc.POINTER.pack(0, 1, 2)
+        self.assertUibcError(
+            wfd_uibc.HEADER.pack(wfd_uibc.GENERIC, 7 + len(body)) +
+            wfd_uibc.GENERIC_HEADER.pack(wfd_uibc.TOUCH_DOWN, len(body)) + body)
+
+    def test_truncated_event(self):
+        self.assertUibcError(
+            wfd_uibc.HEADER.pack(wfd_uibc.GENERIC, 8) +
+            wfd_uibc.GENERIC_HEADER.pack(wfd_uibc.KEY_DOWN, 1) + b'\x00')
+
+
+if __name__ == '__main__':
+    unittest.main()
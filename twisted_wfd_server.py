@@ -1,211 +1,428 @@
 import rtsp
+import wfd_capcache
+import wfd_capture
+import wfd_core
+import wfd_media
+import wfd_metrics
+import wfd_options
+import wfd_profile
+import wfd_rtcp
+import wfd_session
+import wfd_trace
+import wfd_uibc
+import argparse
 import logging
+import multiprocessing
+import queue
+import signal
+import socket
 import sys
 from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer, IReadDescriptor
+from twisted.internet.task import LoopingCall
+from twisted.internet.error import ConnectionDone
 from twisted.internet.protocol import ServerFactory, Protocol
+from zope.interface import implementer
 
 
 _default_log_handler = logging.StreamHandler(stream=sys.stdout)
 _default_log_handler.setFormatter(logging.Formatter(
         '%(asctime)s\t[%(name)s]\t%(message)s'))
 
+_protocol_logger = logging.Logger('WfdProtocol', logging.INFO)
+_protocol_logger.addHandler(_default_log_handler)
 
-class WfdServerState(object):
-    Initial = 'Initial'
-    Handshake = 'Handshake'
-    Trigger = 'Trigger'
-    Play = 'Play'
-    Pause = 'Pause'
-
-    HandshakeOptions = 'HandshakeOptions'
-    HandshakeGetParameters = 'HandshakeGetParameters'
-    HandshakeSetParameters = 'HandshakeSetParameters'
-    HandshakeSetup = 'HandshakeSetup'
-
-
-class WfdProtocol(Protocol):
-    OPTIONS_RESPONSE_PUBLIC = "org.wfa.wfd1.0, GET_PARAMETER, SET_PARAMETER"
-    OPTIONS_REQUEST_REQUIRE = "org.wfa.wfd1.0"
-    GET_PARAMETER = (
-        "wfd_video_formats\r\n"
-        "wfd_audio_codecs\r\n"
-        "wfd_client_rtp_ports\r\n"
-        "wfd_content_protection\r\n"
-        "wfd_uibc_capability\r\n")
-    SET_PARAMETER = (
-        "wfd_video_formats: "
-        "00 00 01 01 00000020 00000000 00000000 00 0000 0000 00 none none\r\n"
-        "wfd_audio_codecs: LPCM 00000002 00\r\n"
-        "wfd_presentation_URL: rtsp://172.16.222.110/wfd1.0/streamid=0 none\r\n"
-        "wfd_client_rtp_ports: RTP/AVP/UDP;unicast {0} 0 mode=play\r\n")
-    TRIGGER_SETUP = "wfd_trigger_method: SETUP\r\n"
-    TRIGGER_PLAY = "wfd_trigger_method: PLAY\r\n"
-    TRIGGER_PAUSE = "wfd_trigger_method: PAUSE\r\n"
-    TRIGGER_TEARDOWN = "wfd_trigger_method: TEARDOWN\r\n"
-    DEFAULT_URL = 'rtsp://localhost/wfd1.0'
-
-    cseq = 0
+
+@implementer(IPushProducer)
+class WfdProtocol(Protocol, wfd_core.SourceCore):
+    # Twisted frontend of the source session: the core does the protocol,
+    # this class moves its bytes and runs its request deadline on a timer.
+    # It is the streaming producer of its own transport: while a sink does
+    # not read, the transport pauses it, which stops reading the sink's
+    # requests and holds keepalives instead of growing the write buffer.
+
+    def __init__(self):
+        wfd_core.SourceCore.__init__(self)
 
     def connectionMade(self):
         self.name = 'WfdClient:{0}:{1}'.format(self.transport.getPeer().host,
                                                self.transport.getPeer().port)
-        self.logger = logging.Logger(self.name, logging.DEBUG)
-        self.logger.addHandler(_default_log_handler)
-        self.logger.debug('Connection made')
-        self.cseq = 0
-        self.pendingRequests = {}
-        self.messageHandlers = {
-                rtsp.RtspRequest: self._handleRequest,
-                rtsp.RtspResponse: self._handleResponse,
-            }
-        self.requestHandlers = {
-                'OPTIONS': self._handleOptionsRequest,
-                'SETUP': self._handleSetupRequest,
-                'PLAY': self._handleRequestPositive,
-                'PAUSE': self._handleRequestPositive,
-                'TEARDOWN': self._handleTeardownRequest,
-            }
-
-        self.state = WfdServerState.Handshake
-        self.handshakeState = WfdServerState.HandshakeOptions
-
-        self._sendRequest(rtsp.RtspRequest(
-            'OPTIONS',
-            headers={'Require': self.OPTIONS_REQUEST_REQUIRE}),
-            responseHandler=self._flushResponse)
+        self.logger = _protocol_logger
+        self.logger.debug('%s: Connection made', self.name)
+        self.trace = wfd_trace.session_trace(self.name)
+        self.capture = wfd_capture.session_capture(self.name)
+        self.metrics = wfd_metrics.SessionMetrics()
+        self.profile = wfd_profile.session_profile(self.name)
+        self.media = self.factory.media
+        self.deadline = None
+        self.paused = False
+        self.uibc_port = self.factory.uibcPort
+        self.max_pending_requests = self.factory.maxPendingRequests
+        self.capabilities = self.factory.capabilities
+        self.pipeline = self.factory.pipeline
+        self.peer = self.transport.getPeer().host
+        self.session_timeout = self.factory.sessions.timeout
+        self.sessionId = self.session_id = self.factory.sessions.open(
+            self._sendKeepalive, self._expireSession)
+        self.transport.registerProducer(self, True)
+        self._drive(self.connection_made)
 
     def dataReceived(self, data):
-        self.logger.debug('Data received:\n'+data)
-        string = data.decode('ascii')
-        while True:
-            message, length = rtsp.message_from_string(string)
-            if not message:
-                break
-            self.messageHandlers[message.__class__](message)
-            string = string[length:]
+        self.factory.sessions.touch(self.sessionId)
+        self._drive(self.receive_data, data)
 
     def connectionLost(self, reason):
-        self.logger.debug('Connection lost')
-
-    def _sendRequest(self, request, responseHandler):
-        request.cseq = self.cseq
-        self._sendMessage(request)
-        self.pendingRequests[self.cseq] = (request, responseHandler)
-        self.cseq += 1
-
-    def _sendMessage(self, rtspMessage):
-        data = str(rtspMessage)
-        self.transport.write(data.encode('ascii'))
-        self.logger.debug('Data sent:\n' + data)
-
-    def _handleRequest(self, request):
-        self.logger.debug('Handling request {0}:{1}'.format(request.method, request.headers['CSeq']))
-        handler = self._unhandledRequest
-        if request.method in self.requestHandlers.keys():
-            handler = self.requestHandlers[request.method]
-        for response in handler(request):
-            response.cseq = request.cseq
-            self._sendMessage(response)
-
-    def _handleResponse(self, response):
-        self.logger.debug('Handling response {0}'.format(response.cseq))
-        request, responseHandler = self.pendingRequests[response.cseq]
-        del self.pendingRequests[response.cseq]
-        responseHandler(request, response)
-
-    def _handleOptionsRequest(self, request):
-        if self.state is not WfdServerState.Handshake:
-            raise Exception('{0} request not expected at state {1}'.format(request.method, self.state))
-        if self.handshakeState is not WfdServerState.HandshakeOptions:
-            raise Exception('{0} request not expected at state {1}'.format(request.method, self.handshakeState))
-
-        yield rtsp.RtspResponse(headers={
-                'Public': self.OPTIONS_RESPONSE_PUBLIC,
-            })
-
-        self._sendRequest(
-            rtsp.RtspRequest('GET_PARAMETER',
-                url=self.DEFAULT_URL,
-                content=rtsp.RtspContent('text/parameters',
-                                         self.GET_PARAMETER)),
-            self._handleGetParameterResponse)
-
-        self.handshakeState = WfdServerState.HandshakeGetParameters
-
-    def _handleSetupRequest(self, request):
-        if self.state is not WfdServerState.Handshake:
-            raise Exception('{0} request not expected at state {1}'.format(request.method, self.state))
-        if self.handshakeState is not WfdServerState.HandshakeSetup:
-            raise Exception('{0} request not expected at state {1}'.format(request.method, self.handshakeState))
-
-        yield rtsp.RtspResponse(headers={
-                'Transport': request.headers['Transport'],
-                'Session': '01234567',
-            })
-
-        self.state = WfdServerState.Pause
-
-    def _handleTeardownRequest(self, request):
-        yield rtsp.RtspResponse()
-        self.transport.loseConnection()
-
-    def _handleGetParameterResponse(self, request, response):
-        # TODO: should perform some parsing here
-        self.sink_rtp_port = 1028 
-
-        self._sendRequest(
-            rtsp.RtspRequest('SET_PARAMETER',
-                url=self.DEFAULT_URL,
-                content=rtsp.RtspContent('text/parameters',
-                                         self.SET_PARAMETER)),
-            self._handleSetParameterResponse)
-
-    def _handleSetParameterResponse(self, request, response):
-        self._sendRequest(
-            rtsp.RtspRequest('SET_PARAMETER',
-                url=self.DEFAULT_URL,
-                content=rtsp.RtspContent('text/parameters',
-                                         self.TRIGGER_SETUP)),
-            self._flushResponse)
-
-        self.handshakeState = WfdServerState.HandshakeSetup
-
-    def _unhandledRequest(self, request):
-        yield rtsp.RtspResponse(status=406)
-
-    def _handleRequestPositive(self, request):
-        yield rtsp.RtspResponse()
-
-    def _flushResponse(self, request, response):
+        self.logger.debug('%s: Connection lost', self.name)
+        if not reason.check(ConnectionDone):
+            self.trace.dump()
+        self.stream_stop()
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.close()
+        self.factory.sessions.close(self.sessionId)
+        self.metrics.close()
+
+    def pauseProducing(self):
+        self.logger.debug('%s: Sink not reading, pausing', self.name)
+        self.paused = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
         pass
 
+    def _drive(self, step, *args):
+        # Runs one step of the core and writes out whatever it queued, all
+        # the messages of the step in one vectored write.
+        try:
+            step(*args)
+        except rtsp.RtspTimeout as e:
+            self.logger.info('%s: %s', self.name, e)
+            self.trace.dump()
+            self.transport.loseConnection()
+        except (rtsp.RtspParseError, wfd_core.WfdProtocolError) as e:
+            self.logger.info('%s: Dropping connection: %s', self.name, e)
+            self.trace.dump()
+            self.transport.loseConnection()
+        chunks = self.chunks_to_send()
+        if chunks:
+            self.transport.writeSequence(chunks)
+        if self.closing:
+            self.transport.loseConnection()
+        self._armDeadline()
+
+    def _armDeadline(self):
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
+        deadline = self.next_deadline()
+        if deadline is not None:
+            self.deadline = reactor.callLater(
+                max(0.0, deadline - self.clock()), self._drive, self.expire)
+
+    def _sendKeepalive(self, sessionId):
+        if not self.paused:
+            self._drive(self.send_keepalive, sessionId)
+
+    def _expireSession(self, sessionId):
+        self.logger.info('%s: Session %s timed out', self.name, sessionId)
+        self.transport.abortConnection()
+
+    def log(self, message):
+        self.logger.info('%s: %s', self.name, message)
+
+
+class UibcProtocol(Protocol):
+
+    def connectionMade(self):
+        self.transport.setTcpNoDelay(True)
+        self.channel = wfd_uibc.UibcChannel(self.factory.dispatcher,
+                                            self.transport.getPeer().host)
+
+    def dataReceived(self, data):
+        try:
+            self.channel.data_received(data)
+        except wfd_uibc.UibcError as e:
+            _protocol_logger.info('%s: UIBC failed: %s', self.channel.peer, e)
+            self.transport.loseConnection()
+
+
+class UibcFactory(ServerFactory):
+
+    protocol = UibcProtocol
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+
 
 class WfdServerFactory(ServerFactory):
 
     protocol = WfdProtocol
 
-    def __init__(self, port=rtsp.DEFAULT_SERVER_PORT):
+    def __init__(self, port=rtsp.DEFAULT_SERVER_PORT,
+                 sessionTimeout=wfd_session.DEFAULT_TIMEOUT, media=None,
+                 uibcPort=None,
+                 maxPendingRequests=wfd_core.SourceCore.MAX_PENDING_REQUESTS,
+                 capabilities=None, pipeline=False):
         self.port = port
+        self.capabilities = capabilities
+        self.pipeline = pipeline
+        self.media = media
+        self.uibcPort = uibcPort
+        self.maxPendingRequests = maxPendingRequests
+        self.uibc = wfd_uibc.UibcDispatcher()
         self.clients = []
+        self.sessions = wfd_session.SessionManager(sessionTimeout)
+        self.sessionTicker = LoopingCall(self.sessions.tick)
         self.logger = logging.Logger('WfdServer:{0}'.format(port), logging.DEBUG)
         self.logger.addHandler(_default_log_handler)
 
     def startFactory(self):
         self.logger.info('Start listening on port {0}'.format(self.port))
+        self.sessionTicker.start(self.sessions.wheel.tick, now=False)
         ServerFactory.startFactory(self)
 
+    def stopFactory(self):
+        if self.sessionTicker.running:
+            self.sessionTicker.stop()
+        ServerFactory.stopFactory(self)
+
     def buildProtocol(self, addr):
-        self.logger.info('Client connected: '+repr(addr))
+        self.logger.info('Client connected: %r', addr)
         return ServerFactory.buildProtocol(self, addr)
 
 
+def listenReusePort(port, factory, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    try:
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        sock.close()
+
+
+@implementer(IReadDescriptor)
+class SocketReader(object):
+
+    def __init__(self, sock, callback):
+        self.socket = sock
+        self.callback = callback
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def doRead(self):
+        self.callback()
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return 'SocketReader'
+
+
+class ReactorReaders(object):
+    # asyncio's add_reader() and remove_reader() on the reactor, which is
+    # what wfd_media reads RTCP sockets through.
+
+    def __init__(self):
+        self.readers = {}
+
+    def add_reader(self, sock, callback):
+        self.readers[sock] = SocketReader(sock, callback)
+        reactor.addReader(self.readers[sock])
+
+    def remove_reader(self, sock):
+        reactor.removeReader(self.readers.pop(sock))
+
+
+def openMedia(path, broadcast, rateControl=False):
+    if not path:
+        return None
+    return wfd_media.open_source(
+        wfd_media.TsFile(path), reactor.callLater, broadcast,
+        wfd_rtcp.LossRateController if rateControl else None,
+        ReactorReaders())
+
+
+def openCapabilities(size, ttl, path):
+    # The cache is saved when the reactor stops.
+    if not size:
+        return None
+    capabilities = wfd_capcache.CapabilityCache(size, ttl, path)
+    capabilities.load()
+
+    def save():
+        capabilities.save()
+        _protocol_logger.info('Capability cache: %s',
+                              wfd_capcache.format_report(capabilities.report()))
+
+    reactor.addSystemEventTrigger('before', 'shutdown', save)
+    return capabilities
+
+
+def enableProfile(path, interval):
+    wfd_profile.enable(path, interval)
+    wfd_profile.install_signal_handler()
+    wfd_profile.schedule_reports(reactor.callLater)
+
+
+def runWorker(index, port, statsQueue, trace, reportInterval, sessionTimeout,
+              mediaPath, broadcast, capturePath, uibcPort, rateControl,
+              maxPendingRequests, capabilitySize, capabilityTtl,
+              capabilityPath, profilePath, profileInterval, pipeline):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if trace:
+        wfd_trace.enable(trace)
+        wfd_trace.install_signal_handler()
+    if capturePath:
+        wfd_capture.enable(wfd_capture.worker_path(capturePath, index))
+    if profilePath:
+        enableProfile(wfd_capture.worker_path(profilePath, index),
+                      profileInterval)
+
+    def report():
+        statsQueue.put((index, wfd_metrics.REGISTRY.snapshot()))
+
+    wfdFactory = WfdServerFactory(port, sessionTimeout,
+                                  openMedia(mediaPath, broadcast, rateControl),
+                                  uibcPort, maxPendingRequests,
+                                  openCapabilities(
+                                      capabilitySize, capabilityTtl,
+                                      capabilityPath and wfd_capture.worker_path(
+                                          capabilityPath, index)),
+                                  pipeline)
+    listenReusePort(port, wfdFactory)
+    if uibcPort is not None:
+        listenReusePort(uibcPort, UibcFactory(wfdFactory.uibc))
+    LoopingCall(report).start(reportInterval)
+    reactor.run()
+
+
+def superviseWorkers(workers, port, trace, sessionTimeout, mediaPath=None,
+                     broadcast=False, capturePath=None, uibcPort=None,
+                     rateControl=False,
+                     maxPendingRequests=wfd_core.SourceCore.MAX_PENDING_REQUESTS,
+                     capabilitySize=None, capabilityTtl=wfd_capcache.DEFAULT_TTL,
+                     capabilityPath=None, profilePath=None,
+                     profileInterval=wfd_profile.DEFAULT_INTERVAL,
+                     pipeline=False, reportInterval=1.0):
+    logger = logging.Logger('SUPERVISOR', level=logging.DEBUG)
+    logger.addHandler(_default_log_handler)
+    context = multiprocessing.get_context('spawn')
+    statsQueue = context.Queue()
+    workerSessions = wfd_metrics.REGISTRY.register(wfd_metrics.Gauge(
+        'wfd_worker_sessions', 'Connected sinks per worker process.',
+        labels=('worker',)))
+    processes = {}
+    latest = {}
+    retired = {}
+    stopping = []
+
+    def start(index):
+        process = context.Process(
+            target=runWorker,
+            args=(index, port, statsQueue, trace, reportInterval,
+                  sessionTimeout, mediaPath, broadcast, capturePath,
+                  uibcPort, rateControl, maxPendingRequests,
+                  capabilitySize, capabilityTtl, capabilityPath,
+                  profilePath, profileInterval, pipeline))
+        process.daemon = True
+        process.start()
+        processes[index] = process
+        logger.info('Worker %d started with pid %d', index, process.pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(workers):
+        start(index)
+
+    while not stopping:
+        try:
+            index, snapshot = statsQueue.get(timeout=reportInterval)
+            latest[index] = snapshot
+        except queue.Empty:
+            pass
+        except (EOFError, OSError, InterruptedError):
+            continue
+
+        for index, process in list(processes.items()):
+            if not process.is_alive():
+                logger.info('Worker %d exited with code %s, restarting',
+                            index, process.exitcode)
+                if index in latest:
+                    retired = wfd_metrics.REGISTRY.combine(
+                        [retired, latest.pop(index)], gauges=False)
+                start(index)
+
+        wfd_metrics.REGISTRY.load(wfd_metrics.REGISTRY.combine(
+            [retired] + list(latest.values())))
+        for index in processes:
+            sessions = latest.get(index, {}).get(
+                wfd_metrics.ACTIVE_SESSIONS.name, {}).get((), 0)
+            workerSessions.set(sessions, str(index))
+
+    logger.info('Stopping %d workers', len(processes))
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join()
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Twisted WFD test server')
+    wfd_options.add_server_arguments(parser, workers=True)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run N reactor processes sharing the port '
+                             'through SO_REUSEPORT')
+    parser.add_argument('--max-pending', type=int,
+                        default=wfd_core.SourceCore.MAX_PENDING_REQUESTS,
+                        help='drop a sink with more unanswered requests')
+    args = parser.parse_args()
+
     logger = logging.Logger('MAIN', level=logging.DEBUG)
     logger.addHandler(_default_log_handler)
     logger.info('Test WFD Server v0.2 - powered by Twisted')
 
-    wfdFactory = WfdServerFactory()
+    if args.metrics_port:
+        wfd_metrics.serve_metrics(args.metrics_port)
+    if args.workers:
+        superviseWorkers(args.workers, args.port, args.trace,
+                         args.session_timeout, args.media, args.broadcast,
+                         args.capture, args.uibc_port, args.rate_control,
+                         args.max_pending, args.capability_cache,
+                         args.capability_ttl, args.capability_file,
+                         args.profile, args.profile_interval,
+                         args.pipeline)
+        return
+    if args.trace:
+        wfd_trace.enable(args.trace)
+        wfd_trace.install_signal_handler()
+    if args.capture:
+        wfd_capture.enable(args.capture)
+    if args.profile:
+        enableProfile(args.profile, args.profile_interval)
+    wfdFactory = WfdServerFactory(args.port, args.session_timeout,
+                                  openMedia(args.media, args.broadcast,
+                                            args.rate_control),
+                                  args.uibc_port, args.max_pending,
+                                  openCapabilities(args.capability_cache,
+                                                   args.capability_ttl,
+                                                   args.capability_file),
+                                  args.pipeline)
     reactor.listenTCP(wfdFactory.port, wfdFactory)
+    if args.uibc_port is not None:
+        reactor.listenTCP(args.uibc_port, UibcFactory(wfdFactory.uibc))
     reactor.run()
 
 
@@ -0,0 +1,151 @@
+import collections
+import hashlib
+import json
+import os
+import time
+import wfd_metrics
+import wfd_params
+
+
+# Remembers what each sink answered to M3 and the M4 the source derived
+# from it, so a sink that reconnects, after a Wi-Fi roam say, skips the
+# parsing and negotiation and gets M4 and the SETUP trigger back to back.
+# Entries are keyed by key(): the sink's address, fingerprint() of the M3
+# reply and the source's own UIBC port, so nothing is looked up before the
+# reply is in, and sinks sharing an address or changing what they offer
+# each get their own entry. Only an M4 the sink accepted is stored.
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 3600.0
+FILE_VERSION = 3
+
+
+def key(peer, body, uibc_port=None):
+    return '{0}|{1}|{2}'.format(peer, uibc_port, fingerprint(body))
+
+
+def fingerprint(body):
+    lines = sorted(line.strip() for line in (body or '').splitlines()
+                   if line.strip())
+    return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+class CachedCapabilities(object):
+    __slots__ = ('body', 'sink_parameters', 'set_parameter',
+                 'negotiate_seconds', 'm4_seconds', 'stored')
+
+    def __init__(self, body, sink_parameters, set_parameter,
+                 negotiate_seconds, m4_seconds, stored):
+        self.body = body
+        self.sink_parameters = sink_parameters
+        self.set_parameter = set_parameter
+        # What the miss cost: parsing and negotiation, and the M4 round
+        # trip a hit no longer waits for before triggering SETUP.
+        self.negotiate_seconds = negotiate_seconds
+        self.m4_seconds = m4_seconds
+        self.stored = stored
+
+
+class CapabilityCache(object):
+    # Bounded LRU with a TTL, optionally loaded from and saved to path.
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL, path=None,
+                 clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.saved_seconds = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.clock() - entry.stored > self.ttl:
+            del self.entries[key]
+            self.expired += 1
+            wfd_metrics.CAPABILITY_CACHE_LOOKUPS.inc(1, 'expired')
+            entry = None
+        if entry is None:
+            self.misses += 1
+            wfd_metrics.CAPABILITY_CACHE_LOOKUPS.inc(1, 'miss')
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        wfd_metrics.CAPABILITY_CACHE_LOOKUPS.inc(1, 'hit')
+        return entry
+
+    def put(self, key, body, sink_parameters, set_parameter,
+            negotiate_seconds, m4_seconds):
+        entry = CachedCapabilities(body, sink_parameters, set_parameter,
+                                   negotiate_seconds, m4_seconds, self.clock())
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+        return entry
+
+    def saved(self, seconds):
+        self.saved_seconds += seconds
+        wfd_metrics.CAPABILITY_CACHE_SAVED_SECONDS.inc(seconds)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'hit_ratio': self.hits / float(lookups) if lookups else 0.0,
+            'saved_seconds': self.saved_seconds,
+        }
+
+    def load(self):
+        # Missing or unreadable files start an empty cache.
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if data.get('version') != FILE_VERSION:
+            return 0
+        now = self.clock()
+        for record in data.get('entries', ()):
+            if now - record['stored'] > self.ttl:
+                continue
+            entry = CachedCapabilities(
+                record['body'], wfd_params.parse_parameters(record['body']),
+                record['set_parameter'], record['negotiate_seconds'],
+                record['m4_seconds'], record['stored'])
+            self.entries[record['key']] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return len(self.entries)
+
+    def save(self):
+        # Written to a temporary file first so a crash leaves the old one.
+        if self.path is None:
+            return
+        records = [{'key': key, 'body': entry.body,
+                    'set_parameter': entry.set_parameter,
+                    'negotiate_seconds': entry.negotiate_seconds,
+                    'm4_seconds': entry.m4_seconds, 'stored': entry.stored}
+                   for key, entry in self.entries.items()]
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'version': FILE_VERSION, 'entries': records}, f)
+        os.replace(temporary, self.path)
+
+
+def format_report(report):
+    return ('{entries} sinks cached, {hits} hits, {misses} misses '
+            '({expired} expired), {saved_seconds:.3f}s saved'.format(**report))
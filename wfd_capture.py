@@ -0,0 +1,142 @@
+import atexit
+import itertools
+import struct
+import threading
+import time
+
+
+# A capture file is a sequence of segments, one per process that appended
+# to it. Each segment starts with MAGIC and is followed by records: a
+# RECORD header and then `length` bytes of data. OPENED carries the peer
+# name, RECEIVED and SENT carry one whole RTSP message each.
+MAGIC = b'WFDCAP1\n'
+RECORD = struct.Struct('!IdIB')
+OPENED, RECEIVED, SENT, CLOSED = range(4)
+KINDS = ('opened', 'received', 'sent', 'closed')
+
+_log = None
+
+
+class NullCapture(object):
+    enabled = False
+
+    def received(self, data):
+        pass
+
+    def sent(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_CAPTURE = NullCapture()
+
+
+class SessionCapture(object):
+    enabled = True
+
+    def __init__(self, log, session, name):
+        self.log = log
+        self.session = session
+        log.write(session, OPENED, str(name).encode('utf-8'))
+
+    def received(self, data):
+        self.log.write(self.session, RECEIVED, data)
+
+    def sent(self, data):
+        self.log.write(self.session, SENT, data)
+
+    def close(self):
+        self.log.write(self.session, CLOSED, b'')
+        self.log.flush()
+
+
+class CaptureLog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.file.write(MAGIC)
+        self.sessions = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def session(self, name):
+        return SessionCapture(self, next(self.sessions), name)
+
+    def write(self, session, kind, data):
+        header = RECORD.pack(len(data), time.monotonic(), session, kind)
+        with self.lock:
+            self.file.write(header)
+            self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def enable(path):
+    global _log
+    _log = CaptureLog(path)
+    atexit.register(_log.close)
+
+
+def session_capture(name):
+    if _log is None:
+        return NULL_CAPTURE
+    return _log.session(name)
+
+
+def worker_path(path, index):
+    return '{0}.{1}'.format(path, index)
+
+
+def read_records(path):
+    # Yields (segment, timestamp, session, kind, data); a record cut short
+    # by a crash ends the file.
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    segment = -1
+    while offset < len(data):
+        if data.startswith(MAGIC, offset):
+            segment += 1
+            offset += len(MAGIC)
+            continue
+        if segment < 0 or offset + RECORD.size > len(data):
+            break
+        length, timestamp, session, kind = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        yield segment, timestamp, session, kind, data[offset:offset + length]
+        offset += length
+
+
+class CapturedSession(object):
+
+    def __init__(self, key, name, started):
+        self.key = key
+        self.name = name
+        self.started = started
+        self.records = []
+        self.complete = False
+
+
+def read_sessions(path):
+    sessions = {}
+    for segment, timestamp, session, kind, data in read_records(path):
+        key = (path, segment, session)
+        if kind == OPENED:
+            sessions[key] = CapturedSession(key, data.decode('utf-8'), timestamp)
+        elif key in sessions:
+            if kind == CLOSED:
+                sessions[key].complete = True
+            else:
+                sessions[key].records.append(
+                    (timestamp - sessions[key].started, kind, data))
+    return list(sessions.values())
@@ -1,59 +1,65 @@
 import socket
+import wfd_core
+import wfd_loop
+import wfd_uibc
 from rtsp import * 
 
 
-class WfdClient:
-  GET_PARAMETER = ("wfd_audio_codecs: LPCM 00000003 00\r\n"
-                   "wfd_client_rtp_ports: RTP/AVP/UDP;unicast 1028 0 mode=play\r\n"
-                   "wfd_content_protection: none\r\n"
-                   "wfd_uibc_capability: none\r\n"
-                   "wfd_video_formats: 00 00 01 01 00000021 00000000 00000000 00 0000 0000 00 none none\r\n")
-  SET_PARAMETER = ("wfd_video_formats: 00 00 01 01 00000020 00000000 00000000 00 0000 0000 00 none none\r\n"
-                   "wfd_audio_codecs: LPCM 00000002 00\r\n"
-                   "wfd_presentation_URL: rtsp://172.16.222.110/wfd1.0/streamid=0 none\r\n"
-                   "wfd_client_rtp_ports: RTP/AVP/UDP;unicast {0} 0 mode=play\r\n")
-  TRANSPORT="RTP/AVP/UDP;unicast;client_port={0}"
-  TRIGGER_SETUP="wfd_trigger_method: SETUP\r\n"
-  TRIGGER_PLAY="wfd_trigger_method: PLAY\r\n"
-  TRIGGER_PAUSE="wfd_trigger_method: PAUSE\r\n"
-  TRIGGER_TEARDOWN="wfd_trigger_method: TEARDOWN\r\n"
-  URL="rtsp://localhost/wfd1.0"
+class WfdClient(wfd_core.SinkCore):
+  DEFAULT_TIMEOUT = 10
 
-  def __init__(self):
-    self.rtp_port = 1028
+  def __init__(self, rtp_port=1028, uibc_events=0):
+    wfd_core.SinkCore.__init__(self, rtp_port)
+    self.uibc_events = uibc_events
+    self.address = None
+    self.loop = None
 
-  def connect(self, address, port):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((address, port))
+  def connect(self, address, port, play_pause_cycles=1, think_time=0, timeout=DEFAULT_TIMEOUT):
+    loop = wfd_loop.EventLoop()
+    result = []
+    self.start(loop, address, port, play_pause_cycles, think_time,
+              lambda client, error: result.append(error), timeout)
+    loop.run(until=lambda: result)
+    loop.close()
+    if result[0] is not None:
+      raise result[0]
 
-    endpoint = RtspEndpoint(client_socket, self)
-    endpoint.wait_for_request() # M1
-    endpoint.send_request(RtspRequest("OPTIONS", headers={"Require": "org.wfa.wfd1.0"})) # M2
-    endpoint.wait_for_request() # M3
-    endpoint.wait_for_request() # M4
-    endpoint.wait_for_request() # M5
-    endpoint.send_request(RtspRequest("SETUP", headers={"Transport": self.TRANSPORT.format(self.rtp_port)})) # M6
-    endpoint.send_request(RtspRequest("PLAY")) # M7
-    endpoint.send_request(RtspRequest("PAUSE")) # M7
-    endpoint.send_request(RtspRequest("TEARDOWN")) # M7
-    endpoint.teardown()
+  def start(self, loop, address, port, play_pause_cycles=1, think_time=0, on_done=None, timeout=DEFAULT_TIMEOUT):
+    # Runs the session on a shared loop; on_done(client, error) follows.
+    self.address = address
+    self.loop = loop
+    self.script = wfd_core.sink_script(play_pause_cycles, think_time)
+    self.request_timeout = timeout
+    connection = wfd_loop.CoreConnection(loop, wfd_loop.connect(address, port), self, timeout, timeout)
+    connection.start(on_done)
+    return connection
 
-  def process_request(self, request):
-    if request.method == "OPTIONS":
-      return RtspResponse(200, headers={"Public": "org.wfa.wfd1.0, GET_PARAMETER, SET_PARAMETER"})
-    elif request.method == "GET_PARAMETER":
-      return RtspResponse(200, content=RtspContent("text/parameters", self.GET_PARAMETER))
-    elif request.method == "SET_PARAMETER":
-      if "wfd_trigger_method" in request.content:
-        method = request.content.split(": ")[1]
-        return RtspResponse(200)
-      else:
-        return RtspResponse(content=RtspContent("text/parameters", self.SET_PARAMETER))
-    raise Exception("Unexpected request!")
+  def open(self, address, port, timeout=DEFAULT_TIMEOUT):
+    # Connects and returns a wfd_loop.RtspEndpoint once SETUP is answered,
+    # for scripts that send PLAY, PAUSE and TEARDOWN one at a time.
+    self.address = address
+    self.script = iter(())
+    self.request_timeout = timeout
+    endpoint = wfd_loop.RtspEndpoint(socket.create_connection((address, port), timeout), self)
+    endpoint.start()
+    endpoint.run_until(lambda: self.state == wfd_core.PAUSE)
+    return endpoint
 
-  def process_response(self, response, method):
-    if response.status != 200:
-      raise Exception("Reponse has error code {0}".format(response.status))
+  def completed(self, method):
+    if method == "PLAY" and self.uibc_events:
+      self._send_input()
+      self.uibc_events = 0
+
+  def _send_input(self):
+    # One batch of pointer moves, stamped now, on the negotiated UIBC port.
+    uibc = self.negotiated_parameters.get("wfd_uibc_capability")
+    if uibc is None or uibc.port is None:
+      return
+    sender = wfd_uibc.UibcSender(self.loop, self.address, uibc.port)
+    stamp = wfd_uibc.timestamp()
+    sender.send([wfd_uibc.InputEvent(wfd_uibc.TOUCH_MOVE, ((0, i, i),), stamp)
+                 for i in range(self.uibc_events)])
+    sender.close()
 
 
 def main():
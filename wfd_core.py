@@ -0,0 +1,709 @@
+import concurrent.futures
+import time
+import rtsp
+import wfd_capcache
+import wfd_capture
+import wfd_media
+import wfd_params
+import wfd_profile
+import wfd_session
+import wfd_trace
+from rtsp import RtspContent, RtspRequest, RtspResponse, RtspTemplate, cached_template
+
+
+# Session states, shared by source and sink and reported as metrics states.
+INITIAL = 'Initial'
+OPTIONS = 'HandshakeOptions'
+GET_PARAMETERS = 'HandshakeGetParameters'
+SET_PARAMETERS = 'HandshakeSetParameters'
+SETUP = 'HandshakeSetup'
+PAUSE = 'Pause'
+PLAY = 'Play'
+CLOSED = 'Closed'
+
+METHODS = frozenset(('OPTIONS', 'GET_PARAMETER', 'SET_PARAMETER', 'SETUP',
+                     'PLAY', 'PAUSE', 'TEARDOWN'))
+
+
+WfdProtocolError = wfd_params.WfdProtocolError
+
+
+class Pending(object):
+    __slots__ = ('method', 'sent', 'deadline', 'notify', 'future')
+
+    def __init__(self, method, sent, deadline, notify, future=None):
+        self.method = method
+        self.sent = sent
+        self.deadline = deadline
+        self.notify = notify
+        self.future = future
+
+
+class WfdCore(object):
+    # One RTSP session without any I/O. receive_data() parses the peer's
+    # bytes and dispatches every message through REQUEST_HANDLERS or
+    # RESPONSE_HANDLERS, keyed (state, method) and naming a method; for a
+    # response the method is that of the request it answers. Whatever the
+    # session has to send piles up until data_to_send().
+    #
+    # A frontend calls connection_made() first. Time only comes from clock:
+    # the frontend calls expire() once next_deadline() has passed and
+    # resume() once a delay set by the session has. closing means the
+    # connection should be closed after the pending output.
+
+    REQUEST_HANDLERS = {}
+    RESPONSE_HANDLERS = {}
+    REQUEST_TIMEOUT = None
+    MAX_PENDING_REQUESTS = None
+    MAX_HEADER_SIZE = rtsp.DEFAULT_MAX_HEADER_SIZE
+    MAX_CONTENT_LENGTH = rtsp.DEFAULT_MAX_CONTENT_LENGTH
+
+    OK_RESPONSE_TEMPLATE = RtspTemplate(RtspResponse())
+    NOT_ACCEPTABLE_RESPONSE_TEMPLATE = RtspTemplate(RtspResponse(406))
+    METHOD_NOT_VALID_RESPONSE_TEMPLATE = RtspTemplate(RtspResponse(455))
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.parser = rtsp.RtspParser(self.MAX_HEADER_SIZE,
+                                      self.MAX_CONTENT_LENGTH)
+        self.output = []
+        self.cseq = 0
+        self.pending = {}
+        self.expired = set()
+        self.request_timeout = self.REQUEST_TIMEOUT
+        self.max_pending_requests = self.MAX_PENDING_REQUESTS
+        self.delay = None
+        self.closing = False
+        self.metrics = None
+        self.trace = wfd_trace.NULL_TRACE
+        self.capture = wfd_capture.NULL_CAPTURE
+        self.profile = wfd_profile.NULL_PROFILE
+        self._state = INITIAL
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+        if self.metrics:
+            self.metrics.transition(state)
+
+    def connection_made(self):
+        pass
+
+    def resume(self):
+        self.delay = None
+
+    def receive_data(self, data):
+        if self.trace.enabled:
+            self.trace.event('recv', data)
+        if self.metrics:
+            self.metrics.data_received(len(data))
+        self.profile.begin()
+        try:
+            if self.capture.enabled:
+                for message, frame in self.parser.feed_frames(data):
+                    self.capture.received(frame)
+                    self._dispatch(message)
+            else:
+                for message in self.parser.feed(data):
+                    self._dispatch(message)
+        except rtsp.RtspParseError:
+            if self.metrics:
+                self.metrics.parse_error()
+            raise
+        finally:
+            self.profile.end()
+
+    def data_to_send(self):
+        return b''.join(self.chunks_to_send())
+
+    def chunks_to_send(self):
+        # The queued messages as a list, for vectored writes.
+        chunks = self.output
+        self.output = []
+        return chunks
+
+    def send_request(self, request, timeout=None, notify=True, **fields):
+        # Responses are matched by CSeq, so several requests can be
+        # outstanding. A timeout of 0 waits forever, None uses
+        # request_timeout; without notify the response is not dispatched.
+        # Past max_pending_requests the peer is taken to have stopped
+        # reading and WfdProtocolError is raised.
+        if (self.max_pending_requests is not None and
+                len(self.pending) >= self.max_pending_requests):
+            raise WfdProtocolError('{0} requests outstanding'.format(
+                len(self.pending)))
+        self.profile.begin()
+        cseq = self.cseq
+        self.cseq += 1
+        if timeout is None:
+            timeout = self.request_timeout
+        sent = self.clock()
+        self.pending[cseq] = Pending(request.method, sent,
+                                     sent + timeout if timeout else None,
+                                     notify)
+        self._send(request, CSeq=cseq, **fields)
+        self.profile.end()
+        return cseq
+
+    def request(self, request, timeout=None, notify=True, **fields):
+        # send_request() returning a concurrent.futures.Future for the
+        # response instead of the CSeq. The future fails with what the
+        # response handler raised, or with RtspTimeout when expire() finds
+        # it overdue, which then does not raise; close() cancels it.
+        cseq = self.send_request(request, timeout, notify, **fields)
+        future = self.pending[cseq].future = concurrent.futures.Future()
+        return future
+
+    def next_deadline(self):
+        deadline = None
+        for pending in self.pending.values():
+            if pending.deadline is not None and (
+                    deadline is None or pending.deadline < deadline):
+                deadline = pending.deadline
+        return deadline
+
+    def expire(self):
+        # Raises RtspTimeout for an overdue request; a late response to it
+        # is dropped.
+        now = self.clock()
+        for cseq, pending in list(self.pending.items()):
+            if pending.deadline is not None and pending.deadline <= now:
+                del self.pending[cseq]
+                self.expired.add(cseq)
+                error = rtsp.RtspTimeout('No response to {0} (CSeq {1})'.format(
+                    pending.method, cseq))
+                if pending.future is None:
+                    raise error
+                pending.future.set_exception(error)
+
+    def close(self):
+        for pending in self.pending.values():
+            if pending.future is not None:
+                pending.future.cancel()
+        self.pending.clear()
+        self.capture.close()
+        self.profile.close()
+
+    def _dispatch(self, message):
+        # Requests are answered and responses matched by CSeq.
+        if 'CSeq' not in message.headers:
+            raise rtsp.RtspParseError('Message without CSeq')
+        if self.profile.enabled:
+            started = wfd_profile.traced()
+            name = self._message_name(message)
+        if isinstance(message, RtspResponse):
+            self._process_response(message)
+        else:
+            self._process_request(message)
+        if self.profile.enabled:
+            self.profile.message(name, started)
+
+    def _message_name(self, message):
+        if isinstance(message, RtspResponse):
+            pending = self.pending.get(message.cseq)
+            return '{0} response'.format(pending.method if pending else 'unexpected')
+        return '{0} request'.format(message.method)
+
+    def _process_request(self, request):
+        name = self.REQUEST_HANDLERS.get((self._state, request.method))
+        if name is not None:
+            response = getattr(self, name)(request)
+        elif request.method in METHODS:
+            # A peer out of step is answered, not disconnected; it decides
+            # whether to go on.
+            response = self.METHOD_NOT_VALID_RESPONSE_TEMPLATE
+        else:
+            response = self.NOT_ACCEPTABLE_RESPONSE_TEMPLATE
+        if response is not None:
+            self._respond(request, response)
+
+    def _respond(self, request, response):
+        self._send(response, CSeq=request.headers['CSeq'])
+
+    def _process_response(self, response):
+        pending = self.pending.pop(response.cseq, None)
+        if pending is None:
+            if response.cseq in self.expired:
+                self.expired.discard(response.cseq)
+                return
+            raise WfdProtocolError('Unexpected response CSeq {0}'.format(
+                response.cseq))
+        if self.metrics:
+            self.metrics.request_completed(pending.method,
+                                           self.clock() - pending.sent)
+        if pending.future is None:
+            self._handle_response(pending, response)
+            return
+        try:
+            self._handle_response(pending, response)
+        except Exception as e:
+            pending.future.set_exception(e)
+            raise
+        pending.future.set_result(response)
+
+    def _handle_response(self, pending, response):
+        if not pending.notify:
+            return
+        if response.status != 200:
+            raise WfdProtocolError('{0} failed with status {1}'.format(
+                pending.method, response.status))
+        name = self.RESPONSE_HANDLERS.get((self._state, pending.method))
+        if name is None:
+            raise WfdProtocolError('{0} response not expected at state {1}'.format(
+                pending.method, self._state))
+        getattr(self, name)(response)
+
+    def _send(self, message, **fields):
+        data = message.to_bytes(**fields)
+        self.output.append(data)
+        if self.metrics:
+            self.metrics.data_sent(len(data))
+        if self.trace.enabled:
+            self.trace.event('send', data)
+        if self.capture.enabled:
+            self.capture.sent(data)
+
+
+def client_ports(transport):
+    # The RTP and RTCP ports of a Transport header's client_port=, RTCP one
+    # above RTP unless given; None if missing or not valid ports.
+    for param in transport.split(";"):
+        param = param.strip()
+        if param.startswith("client_port="):
+            try:
+                ports = [int(port) for port in
+                         param[len("client_port="):].split("-")]
+            except ValueError:
+                return None
+            if len(ports) == 1:
+                ports.append(ports[0] + 1)
+            if len(ports) != 2 or not all(0 < port < 65536 for port in ports):
+                return None
+            return tuple(ports)
+    return None
+
+
+class SourceCore(WfdCore):
+    # Source side of M1-M7 and the session after it. With a wfd_media
+    # source in media, the stream_* methods stream it to peer, the sink's
+    # address; stream_setup() returns Transport parameters to add to the
+    # SETUP response. Frontends override log() to see stream reports.
+
+    OPTIONS_RESPONSE_PUBLIC = "org.wfa.wfd1.0, GET_PARAMETER, SET_PARAMETER"
+    OPTIONS_REQUEST_REQUIRE = "org.wfa.wfd1.0"
+    GET_PARAMETER = (
+        "wfd_video_formats\r\n"
+        "wfd_audio_codecs\r\n"
+        "wfd_client_rtp_ports\r\n"
+        "wfd_content_protection\r\n"
+        "wfd_uibc_capability\r\n")
+    PRESENTATION_URL = "rtsp://172.16.222.110/wfd1.0/streamid=0 none"
+    TRIGGER_SETUP = "wfd_trigger_method: SETUP\r\n"
+    TRIGGER_PLAY = "wfd_trigger_method: PLAY\r\n"
+    TRIGGER_PAUSE = "wfd_trigger_method: PAUSE\r\n"
+    TRIGGER_TEARDOWN = "wfd_trigger_method: TEARDOWN\r\n"
+    URL = "rtsp://localhost/wfd1.0"
+    SESSION_TIMEOUT = wfd_session.DEFAULT_TIMEOUT
+    REQUEST_TIMEOUT = 10
+    MAX_PENDING_REQUESTS = 16
+
+    OPTIONS_REQUEST_TEMPLATE = RtspTemplate(RtspRequest(
+        "OPTIONS",
+        headers={"Require": OPTIONS_REQUEST_REQUIRE}))
+    GET_PARAMETER_TEMPLATE = RtspTemplate(RtspRequest(
+        "GET_PARAMETER",
+        url=URL,
+        content=RtspContent("text/parameters", GET_PARAMETER)))
+    TRIGGER_SETUP_TEMPLATE = RtspTemplate(RtspRequest(
+        "SET_PARAMETER",
+        url=URL,
+        content=RtspContent("text/parameters", TRIGGER_SETUP)))
+    OPTIONS_RESPONSE_TEMPLATE = RtspTemplate(RtspResponse(
+        headers={"Public": OPTIONS_RESPONSE_PUBLIC}))
+    KEEPALIVE_TEMPLATE = RtspTemplate(
+        RtspRequest("GET_PARAMETER", url=URL), fields=("CSeq", "Session"))
+    UNSUPPORTED_TRANSPORT_RESPONSE_TEMPLATE = RtspTemplate(RtspResponse(461))
+
+    REQUEST_HANDLERS = {
+        (OPTIONS, 'OPTIONS'): '_options_request',
+        (SET_PARAMETERS, 'SETUP'): '_setup_request',
+        (SETUP, 'SETUP'): '_setup_request',
+        (PAUSE, 'PLAY'): '_play_request',
+        (PLAY, 'PLAY'): '_play_request',
+        (PAUSE, 'PAUSE'): '_pause_request',
+        (PLAY, 'PAUSE'): '_pause_request',
+        (PAUSE, 'TEARDOWN'): '_teardown_request',
+        (PLAY, 'TEARDOWN'): '_teardown_request',
+        (PAUSE, 'SET_PARAMETER'): '_set_parameter_request',
+        (PLAY, 'SET_PARAMETER'): '_set_parameter_request',
+    }
+    RESPONSE_HANDLERS = {
+        (OPTIONS, 'OPTIONS'): '_options_response',
+        (GET_PARAMETERS, 'GET_PARAMETER'): '_get_parameter_response',
+        (SET_PARAMETERS, 'SET_PARAMETER'): '_set_parameter_response',
+        # With M4 and M5 pipelined, SETUP may overtake the M5 response.
+        (PAUSE, 'SET_PARAMETER'): '_set_parameter_response',
+        (PLAY, 'SET_PARAMETER'): '_set_parameter_response',
+    }
+
+    def __init__(self, clock=time.monotonic):
+        super(SourceCore, self).__init__(clock)
+        self.session_id = None
+        self.session_timeout = self.SESSION_TIMEOUT
+        self.uibc_port = None
+        self.sink_parameters = None
+        self.sink_rtp_port = None
+        self.set_parameter = None
+        self.options_answered = False
+        self.options_received = False
+        self.trigger_cseq = None
+        # Send M4 and M5 back to back instead of waiting for each response;
+        # off by default since some sinks cannot take SETUP before M4 is
+        # answered.
+        self.pipeline = False
+        # A wfd_capcache.CapabilityCache shared between sessions, and the
+        # sink's address to key it by.
+        self.capabilities = None
+        self.peer = None
+        self.capability_key = None
+        self.sink_body = None
+        self.negotiate_seconds = None
+        self.m4_cseq = None
+        self.m4_sent = None
+        self.media = None
+        self.stream = None
+        self.video_mode = None
+
+    @property
+    def session_established(self):
+        return self._state in (PAUSE, PLAY)
+
+    def connection_made(self):
+        self.state = OPTIONS
+        self.send_request(self.OPTIONS_REQUEST_TEMPLATE)
+
+    def send_keepalive(self, session_id):
+        # Nobody waits for the response; a silent sink is left to the
+        # session timeout.
+        if self.session_established:
+            self.send_request(self.KEEPALIVE_TEMPLATE, timeout=0,
+                              notify=False, Session=session_id)
+
+    def log(self, message):
+        pass
+
+    def stream_setup(self, rtp_port, rtcp_port):
+        if self.media is None or self.stream is not None:
+            return ''
+        self._open_stream(rtcp_port)
+        return ';server_port={0}-{1}'.format(self.stream.port,
+                                             self.stream.port + 1)
+
+    def stream_play(self):
+        if self.media is not None:
+            if self.stream is None:
+                self._open_stream(self.sink_rtp_port + 1)
+            self.stream.play()
+
+    def stream_pause(self):
+        if self.stream is not None:
+            self.stream.pause()
+
+    def stream_stop(self):
+        if self.stream is not None:
+            self.log('Stream to {0}:{1}: {2}'.format(
+                self.peer, self.sink_rtp_port,
+                wfd_media.format_report(self.stream.stop())))
+            self.stream = None
+
+    @property
+    def rtcp_stats(self):
+        # Loss, jitter and RTT the sink reports over RTCP, or None.
+        if self.stream is None or self.stream.rtcp is None:
+            return None
+        return self.stream.rtcp.stats
+
+    def _open_stream(self, rtcp_port):
+        self.stream = self.media.open((self.peer, self.sink_rtp_port),
+                                      (self.peer, rtcp_port))
+        if self.stream.rtcp is not None:
+            self.stream.rtcp.on_lower_mode = self._lower_video_mode
+
+    def _lower_video_mode(self):
+        # The TS file cannot be re-encoded, so the mode the rate controller
+        # asks for is only recorded and reported.
+        negotiated = wfd_params.parse_parameters(self.set_parameter)
+        sink = self.sink_parameters.get('wfd_video_formats')
+        if not negotiated.get('wfd_video_formats') or not sink:
+            return
+        video_mode = wfd_params.lower_video_mode(
+            self.video_mode or negotiated['wfd_video_formats'], sink)
+        if video_mode is None:
+            # Already the lowest mode the sink offers; stop asking.
+            self.stream.rtcp.on_lower_mode = None
+            return
+        self.video_mode = video_mode
+        self.log('Stream to {0}:{1}: lower video mode {2}x{3}p{4} '
+                 'requested'.format(self.peer, self.sink_rtp_port,
+                                    *wfd_params.video_resolution(video_mode)))
+
+    def _options_request(self, request):
+        self._respond(request, self.OPTIONS_RESPONSE_TEMPLATE)
+        self.options_received = True
+        self._options_done()
+
+    def _options_response(self, response):
+        self.options_answered = True
+        self._options_done()
+
+    def _options_done(self):
+        if self.options_answered and self.options_received:
+            self.state = GET_PARAMETERS
+            self.send_request(self.GET_PARAMETER_TEMPLATE)
+
+    def _get_parameter_response(self, response):
+        # The cache is only consulted with the M3 reply in hand, so an M4
+        # never carries another sink's RTP ports.
+        entry = None
+        if self.capabilities is not None and self.peer is not None:
+            self.capability_key = wfd_capcache.key(
+                self.peer, response.content, self.uibc_port)
+            entry = self.capabilities.get(self.capability_key)
+        if entry is not None:
+            self.sink_parameters = entry.sink_parameters
+            self.set_parameter = entry.set_parameter
+            # The sink accepted this M4 before, so SETUP is triggered
+            # without waiting for the response.
+            self.capabilities.saved(entry.negotiate_seconds + (
+                0.0 if self.pipeline else entry.m4_seconds))
+        else:
+            started = self.clock()
+            self.sink_body = response.content
+            self.sink_parameters = wfd_params.parse_parameters(response.content)
+            self.set_parameter = wfd_params.negotiate(
+                response.content, self.PRESENTATION_URL, self.uibc_port)
+            self.negotiate_seconds = self.clock() - started
+        self.sink_rtp_port = self.sink_parameters["wfd_client_rtp_ports"].port0
+        self.state = SET_PARAMETERS
+        self.m4_sent = self.clock()
+        self.m4_cseq = self.send_request(
+            self._set_parameter_template(self.set_parameter))
+        if self.pipeline or entry is not None:
+            self._trigger_setup()
+
+    def _set_parameter_response(self, response):
+        if response.cseq == self.m4_cseq and self.negotiate_seconds is not None:
+            self._store_capabilities()
+        if response.cseq == self.trigger_cseq:
+            if self._state == SET_PARAMETERS:
+                self.state = SETUP
+        elif self.trigger_cseq is None:
+            self._trigger_setup()
+
+    def _store_capabilities(self):
+        if self.capability_key is not None:
+            self.capabilities.put(self.capability_key, self.sink_body,
+                                  self.sink_parameters, self.set_parameter,
+                                  self.negotiate_seconds,
+                                  self.clock() - self.m4_sent)
+
+    def _trigger_setup(self):
+        self.trigger_cseq = self.send_request(self.TRIGGER_SETUP_TEMPLATE)
+
+    def _set_parameter_template(self, content):
+        return cached_template(
+            ("SET_PARAMETER", self.URL, content),
+            lambda: RtspRequest(
+                "SET_PARAMETER",
+                url=self.URL,
+                content=RtspContent("text/parameters", content)))
+
+    def _setup_request(self, request):
+        # A Transport without a usable client_port is refused with 461,
+        # leaving the sink free to try another SETUP.
+        transport = request.headers.get("Transport", "")
+        ports = client_ports(transport)
+        if ports is None:
+            return self.UNSUPPORTED_TRANSPORT_RESPONSE_TEMPLATE
+        self.sink_rtp_port, rtcp_port = ports
+        transport += self.stream_setup(self.sink_rtp_port, rtcp_port)
+        if self.session_id is None:
+            self.session_id = wfd_session.new_session_id()
+        self.state = PAUSE
+        session = "{0};timeout={1}".format(self.session_id,
+                                           self.session_timeout)
+        return RtspResponse(headers={"Session": session,
+                                     "Transport": transport})
+
+    def _play_request(self, request):
+        self.state = PLAY
+        self.stream_play()
+        return self.OK_RESPONSE_TEMPLATE
+
+    def _pause_request(self, request):
+        self.state = PAUSE
+        self.stream_pause()
+        return self.OK_RESPONSE_TEMPLATE
+
+    def _set_parameter_request(self, request):
+        # Sinks ask for an IDR frame with wfd_idr_request after losses. The
+        # stream is a file that cannot be re-encoded, so it is only
+        # acknowledged.
+        return self.OK_RESPONSE_TEMPLATE
+
+    def _teardown_request(self, request):
+        self.stream_stop()
+        self.state = CLOSED
+        self.closing = True
+        return self.OK_RESPONSE_TEMPLATE
+
+
+def sink_script(play_pause_cycles=1, think_time=0):
+    # What a scripted sink does once established; see SinkCore.
+    for cycle in range(play_pause_cycles):
+        yield SinkCore.PLAY_TEMPLATE
+        yield think_time
+        yield SinkCore.PAUSE_TEMPLATE
+        yield think_time
+    yield SinkCore.TEARDOWN_TEMPLATE
+
+
+class SinkCore(WfdCore):
+    # Sink side: answers M1 and M3-M5 and sends M2 and SETUP. Once SETUP is
+    # answered the script runs: a request is sent and its response awaited,
+    # a number of seconds becomes delay for the frontend to wait out.
+    # established() and completed(method) are hooks for frontends.
+
+    GET_PARAMETER = ("wfd_audio_codecs: LPCM 00000003 00\r\n"
+                     "wfd_client_rtp_ports: RTP/AVP/UDP;unicast {0} 0 mode=play\r\n"
+                     "wfd_content_protection: none\r\n"
+                     "wfd_uibc_capability: input_category_list=GENERIC;generic_cap_list=Mouse, SingleTouch;hidc_cap_list=none;port=none\r\n"
+                     "wfd_video_formats: 00 00 01 01 00000021 00000000 00000000 00 0000 0000 00 none none\r\n")
+    SET_PARAMETER = ("wfd_video_formats: 00 00 01 01 00000020 00000000 00000000 00 0000 0000 00 none none\r\n"
+                     "wfd_audio_codecs: LPCM 00000002 00\r\n"
+                     "wfd_presentation_URL: rtsp://172.16.222.110/wfd1.0/streamid=0 none\r\n"
+                     "wfd_client_rtp_ports: RTP/AVP/UDP;unicast {0} 0 mode=play\r\n")
+    TRANSPORT = "RTP/AVP/UDP;unicast;client_port={0}"
+    URL = "rtsp://localhost/wfd1.0"
+
+    OPTIONS_REQUEST_TEMPLATE = RtspTemplate(RtspRequest("OPTIONS", headers={"Require": "org.wfa.wfd1.0"}))
+    PLAY_TEMPLATE = RtspTemplate(RtspRequest("PLAY"))
+    PAUSE_TEMPLATE = RtspTemplate(RtspRequest("PAUSE"))
+    TEARDOWN_TEMPLATE = RtspTemplate(RtspRequest("TEARDOWN"))
+    OPTIONS_RESPONSE_TEMPLATE = RtspTemplate(RtspResponse(200, headers={"Public": "org.wfa.wfd1.0, GET_PARAMETER, SET_PARAMETER"}))
+    SET_PARAMETER_RESPONSE_TEMPLATE = RtspTemplate(RtspResponse(content=RtspContent("text/parameters", SET_PARAMETER)))
+
+    REQUEST_HANDLERS = {
+        (INITIAL, 'OPTIONS'): '_options_request',
+        (OPTIONS, 'GET_PARAMETER'): '_get_parameter_request',
+        (GET_PARAMETERS, 'GET_PARAMETER'): '_get_parameter_request',
+        (SET_PARAMETERS, 'SET_PARAMETER'): '_set_parameter_request',
+        (SETUP, 'GET_PARAMETER'): '_keepalive_request',
+        (PAUSE, 'GET_PARAMETER'): '_keepalive_request',
+        (PLAY, 'GET_PARAMETER'): '_keepalive_request',
+        (PAUSE, 'SET_PARAMETER'): '_trigger_request',
+        (PLAY, 'SET_PARAMETER'): '_trigger_request',
+    }
+    RESPONSE_HANDLERS = {
+        (OPTIONS, 'OPTIONS'): '_options_response',
+        (GET_PARAMETERS, 'OPTIONS'): '_options_response',
+        (SET_PARAMETERS, 'OPTIONS'): '_options_response',
+        (SETUP, 'SETUP'): '_setup_response',
+        (PAUSE, 'PLAY'): '_play_response',
+        (PLAY, 'PLAY'): '_play_response',
+        (PLAY, 'PAUSE'): '_pause_response',
+        (PAUSE, 'PAUSE'): '_pause_response',
+        (PAUSE, 'TEARDOWN'): '_teardown_response',
+        (PLAY, 'TEARDOWN'): '_teardown_response',
+    }
+
+    def __init__(self, rtp_port=1028, script=(), clock=time.monotonic):
+        super(SinkCore, self).__init__(clock)
+        self.rtp_port = rtp_port
+        self.script = iter(script)
+        self.negotiated_parameters = None
+
+    def established(self):
+        pass
+
+    def completed(self, method):
+        pass
+
+    def resume(self):
+        super(SinkCore, self).resume()
+        self._advance()
+
+    def _advance(self):
+        while self.delay is None:
+            try:
+                action = next(self.script)
+            except StopIteration:
+                return
+            if isinstance(action, (int, float)):
+                if action > 0:
+                    self.delay = action
+            else:
+                self.send_request(action)
+                return
+
+    def _options_request(self, request):
+        self._respond(request, self.OPTIONS_RESPONSE_TEMPLATE)
+        self.state = OPTIONS
+        self.send_request(self.OPTIONS_REQUEST_TEMPLATE)
+
+    def _options_response(self, response):
+        if self._state == OPTIONS:
+            self.state = GET_PARAMETERS
+
+    def _get_parameter_request(self, request):
+        self.state = SET_PARAMETERS
+        return cached_template((self.GET_PARAMETER, self.rtp_port),
+                               lambda: RtspResponse(200, content=RtspContent("text/parameters", self.GET_PARAMETER.format(self.rtp_port))))
+
+    def _set_parameter_request(self, request):
+        content = request.content or ""
+        if "wfd_trigger_method" not in content:
+            self.negotiated_parameters = wfd_params.parse_parameters(content)
+            return self.SET_PARAMETER_RESPONSE_TEMPLATE
+        if content.split(":", 1)[1].strip() != "SETUP":
+            return self.OK_RESPONSE_TEMPLATE
+        self._respond(request, self.OK_RESPONSE_TEMPLATE)
+        self.state = SETUP
+        self.send_request(self._setup_template(self.rtp_port))
+
+    def _setup_template(self, rtp_port):
+        return cached_template((self.TRANSPORT, rtp_port),
+                               lambda: RtspRequest("SETUP", headers={"Transport": self.TRANSPORT.format(rtp_port)}))
+
+    def _keepalive_request(self, request):
+        return self.OK_RESPONSE_TEMPLATE
+
+    def _trigger_request(self, request):
+        # Triggers after SETUP are acknowledged and otherwise ignored.
+        return self.OK_RESPONSE_TEMPLATE
+
+    def _setup_response(self, response):
+        self.state = PAUSE
+        self.established()
+        self._advance()
+
+    def _play_response(self, response):
+        self.state = PLAY
+        self._scripted("PLAY")
+
+    def _pause_response(self, response):
+        self.state = PAUSE
+        self._scripted("PAUSE")
+
+    def _teardown_response(self, response):
+        self.state = CLOSED
+        self.closing = True
+        self._scripted("TEARDOWN")
+
+    def _scripted(self, method):
+        self.completed(method)
+        self._advance()
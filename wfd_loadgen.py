@@ -0,0 +1,122 @@
+import argparse
+import collections
+import json
+import sys
+import time
+import rtsp
+import wfd_loop
+from wfd_client import WfdClient
+
+
+class LoadClient(WfdClient):
+  # Times every request the sink sends, "sink.X", and how long it waits for
+  # every request of the source, "source.X", from its own last message.
+
+  def __init__(self, rtp_port, stats, uibc_events=0):
+    WfdClient.__init__(self, rtp_port, uibc_events)
+    self.stats = stats
+    self.last_sent = time.monotonic()
+
+  def established(self):
+    self.stats.handshake_done()
+
+  def _process_request(self, request):
+    self.stats.record("source." + request.method, time.monotonic() - self.last_sent)
+    WfdClient._process_request(self, request)
+
+  def _process_response(self, response):
+    pending = self.pending.get(response.cseq)
+    WfdClient._process_response(self, response)
+    if pending is not None:
+      self.stats.record("sink." + pending.method, time.monotonic() - pending.sent)
+
+  def _send(self, message, **fields):
+    WfdClient._send(self, message, **fields)
+    self.last_sent = time.monotonic()
+
+
+class LoadStats(object):
+
+  def __init__(self):
+    self.latencies = collections.defaultdict(list)
+    self.handshakes = 0
+    self.failures = 0
+    self.errors = collections.Counter()
+
+  def record(self, method, latency):
+    self.latencies[method].append(latency)
+
+  def handshake_done(self):
+    self.handshakes += 1
+
+  def failed(self, error):
+    self.failures += 1
+    self.errors[str(error)] += 1
+
+  def summary(self, sinks, duration):
+    return {
+      "sinks": sinks,
+      "handshakes": self.handshakes,
+      "failures": self.failures,
+      "errors": dict(self.errors),
+      "duration": duration,
+      "handshakes_per_second": self.handshakes / duration if duration else 0.0,
+      "latency_ms": {method: _percentiles(values) for method, values in self.latencies.items()},
+    }
+
+
+def _percentiles(values):
+  values = sorted(values)
+  def percentile(p):
+    return 1000.0 * values[min(len(values) - 1, int(p * len(values)))]
+  return {"count": len(values), "p50": percentile(0.50), "p90": percentile(0.90),
+          "p99": percentile(0.99), "max": 1000.0 * values[-1]}
+
+
+def run(address, port, sinks, ramp_rate, think_time, cycles, base_rtp_port, uibc_events=0):
+  # Every sink runs on one selectors loop in this thread.
+  stats = LoadStats()
+  loop = wfd_loop.EventLoop()
+  running = [sinks]
+
+  def finished(client, error):
+    if error is not None:
+      stats.failed(error)
+    running[0] -= 1
+
+  def start_sink(index):
+    client = LoadClient(base_rtp_port + 2 * index, stats, uibc_events)
+    try:
+      client.start(loop, address, port, cycles, think_time, finished)
+    except Exception as e:
+      finished(None, e)
+
+  started = time.monotonic()
+  for index in range(sinks):
+    loop.call_later(index / ramp_rate if ramp_rate else 0, start_sink, index)
+  loop.run(until=lambda: not running[0])
+  loop.close()
+  return stats.summary(sinks, time.monotonic() - started)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="WFD sink load generator")
+  parser.add_argument("address", nargs="?", default="127.0.0.1")
+  parser.add_argument("port", type=int, nargs="?", default=rtsp.DEFAULT_SERVER_PORT)
+  parser.add_argument("--sinks", type=int, default=10)
+  parser.add_argument("--ramp-rate", type=float, default=0, help="sinks started per second, 0 for all at once")
+  parser.add_argument("--think-time", type=float, default=0, help="seconds between PLAY/PAUSE requests")
+  parser.add_argument("--cycles", type=int, default=1, help="PLAY/PAUSE cycles per sink")
+  parser.add_argument("--base-rtp-port", type=int, default=1028)
+  parser.add_argument("--uibc-events", type=int, default=0,
+                      help="input events each sink sends after PLAY when UIBC is offered")
+  args = parser.parse_args()
+
+  summary = run(args.address, args.port, args.sinks, args.ramp_rate,
+                args.think_time, args.cycles, args.base_rtp_port, args.uibc_events)
+  json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+  main()
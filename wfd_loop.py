@@ -0,0 +1,381 @@
+import heapq
+import itertools
+import selectors
+import socket
+import time
+import rtsp
+
+
+READ_SIZE = 65536
+DEFAULT_BACKLOG = 128
+ACCEPT_BACKOFF = 0.1
+
+
+class Timer(object):
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    # Single-threaded selectors loop for the stdlib tools. Sockets are
+    # non-blocking and every callback runs on the thread calling run().
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.stopped = False
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.clock() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.sequence), timer))
+        return timer
+
+    def register(self, sock, events, callback):
+        self.selector.register(sock, events, callback)
+
+    def modify(self, sock, events, callback):
+        self.selector.modify(sock, events, callback)
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+
+    # asyncio's names, for code that takes either loop.
+
+    def add_reader(self, sock, callback):
+        self.register(sock, selectors.EVENT_READ, lambda events: callback())
+
+    def remove_reader(self, sock):
+        self.unregister(sock)
+
+    def run_once(self, timeout=None):
+        if self.timers:
+            delay = max(0.0, self.timers[0][0] - self.clock())
+            timeout = delay if timeout is None else min(timeout, delay)
+        for key, events in self.selector.select(timeout):
+            key.data(events)
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def run(self, until=None):
+        # Runs until stop() is called or until() returns true.
+        self.stopped = False
+        while not self.stopped and not (until is not None and until()):
+            self.run_once()
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        self.selector.close()
+
+
+class Connection(object):
+    # A non-blocking socket on an EventLoop. Writes made during one loop turn
+    # are coalesced into a single send once the socket is writable. While
+    # data is expected, a peer silent for read_timeout closes the connection,
+    # as does output that cannot be flushed within write_timeout.
+
+    def __init__(self, loop, sock, protocol, read_timeout=None,
+                 write_timeout=None):
+        sock.setblocking(False)
+        self.loop = loop
+        self.socket = sock
+        self.protocol = protocol
+        self.read_timeout = None
+        self.write_timeout = write_timeout
+        self.output = []
+        self.closing = False
+        self.closed = False
+        self.last_read = loop.clock()
+        self.read_timer = None
+        self.write_timer = None
+        loop.register(sock, selectors.EVENT_READ, self._ready)
+        self.expect_data(read_timeout)
+
+    def write(self, data):
+        if self.closed:
+            return
+        if not self.output:
+            self.loop.modify(self.socket,
+                             selectors.EVENT_READ | selectors.EVENT_WRITE,
+                             self._ready)
+            if self.write_timeout:
+                self.write_timer = self.loop.call_later(self.write_timeout,
+                                                        self._write_expired)
+        self.output.append(data)
+
+    def expect_data(self, timeout):
+        # Starts, restarts or, with None, stops the read deadline.
+        self.read_timeout = timeout
+        self.last_read = self.loop.clock()
+        if self.read_timer is not None:
+            self.read_timer.cancel()
+            self.read_timer = None
+        if timeout:
+            self.read_timer = self.loop.call_later(timeout, self._read_expired)
+
+    def close(self, error=None):
+        # Without an error, pending output is flushed first.
+        if self.closed:
+            return
+        if error is None and self.output:
+            self.closing = True
+            return
+        self.closed = True
+        for timer in (self.read_timer, self.write_timer):
+            if timer is not None:
+                timer.cancel()
+        self.loop.unregister(self.socket)
+        self.socket.close()
+        self.protocol.connection_lost(error)
+
+    def _ready(self, events):
+        if events & selectors.EVENT_WRITE:
+            self._flush()
+        if events & selectors.EVENT_READ and not self.closed:
+            self._read()
+
+    def _read(self):
+        try:
+            data = self.socket.recv(READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.close(e)
+            return
+        if not data:
+            self.close(Exception('Connection closed by peer'))
+            return
+        self.last_read = self.loop.clock()
+        try:
+            self.protocol.data_received(data)
+        except Exception as e:
+            self.close(e)
+
+    def _flush(self):
+        data = b''.join(self.output)
+        try:
+            sent = self.socket.send(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.close(e)
+            return
+        if sent < len(data):
+            self.output = [data[sent:]]
+            return
+        self.output = []
+        if self.write_timer is not None:
+            self.write_timer.cancel()
+            self.write_timer = None
+        if self.closing:
+            self.close()
+        else:
+            self.loop.modify(self.socket, selectors.EVENT_READ, self._ready)
+
+    def _read_expired(self):
+        # Reads only stamp last_read; the timer re-arms for the remainder.
+        self.read_timer = None
+        idle = self.loop.clock() - self.last_read
+        if idle < self.read_timeout:
+            self.read_timer = self.loop.call_later(self.read_timeout - idle,
+                                                   self._read_expired)
+        else:
+            self.close(rtsp.RtspTimeout('Read timed out'))
+
+    def _write_expired(self):
+        self.write_timer = None
+        self.close(rtsp.RtspTimeout('Write timed out'))
+
+
+class CoreConnection(object):
+    # Drives a wfd_core session over a Connection: incoming bytes go to the
+    # core and whatever it queues is written back in the same turn. Its
+    # request deadline and script delays become loop timers; no data is
+    # expected while a delay runs. activity() is called on every read.
+
+    def __init__(self, loop, sock, core, read_timeout=None,
+                 write_timeout=None, activity=None):
+        self.loop = loop
+        self.core = core
+        self.read_timeout = read_timeout
+        self.activity = activity
+        self.connection = Connection(loop, sock, self, read_timeout,
+                                     write_timeout)
+        self.on_done = None
+        self.done = False
+        self.delay = None
+        self.deadline = None
+
+    def start(self, on_done=None):
+        # on_done(core, error) runs once the session is over.
+        self.on_done = on_done
+        self.drive(self.core.connection_made)
+
+    def drive(self, step, *args):
+        # Runs a step of the core, such as send_keepalive, and writes out
+        # what it queued; an exception closes the connection with it.
+        try:
+            step(*args)
+            self._flush()
+        except Exception as e:
+            self.connection.close(e)
+
+    def close(self, error=None):
+        self.connection.close(error)
+
+    def data_received(self, data):
+        if self.activity is not None:
+            self.activity()
+        self.core.receive_data(data)
+        self._flush()
+
+    def connection_lost(self, error):
+        self._finish(error)
+
+    def _flush(self):
+        core = self.core
+        data = core.data_to_send()
+        if data:
+            self.connection.write(data)
+        if core.closing:
+            self.connection.close()
+            return
+        if core.delay is not None and self.delay is None:
+            self.connection.expect_data(None)
+            self.delay = self.loop.call_later(core.delay, self._resume)
+        self._arm_deadline()
+
+    def _resume(self):
+        self.delay = None
+        self.connection.expect_data(self.read_timeout)
+        self.drive(self.core.resume)
+
+    def _arm_deadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        deadline = self.core.next_deadline()
+        if deadline is not None and not self.done:
+            self.deadline = self.loop.call_later(
+                max(0.0, deadline - self.loop.clock()), self._deadline_passed)
+
+    def _deadline_passed(self):
+        self.deadline = None
+        self.drive(self.core.expire)
+
+    def _finish(self, error):
+        if self.done:
+            return
+        self.done = True
+        for timer in (self.delay, self.deadline):
+            if timer is not None:
+                timer.cancel()
+        self.core.close()
+        if self.on_done is not None:
+            self.on_done(self.core, error)
+
+
+class RtspEndpoint(object):
+    # Drives a wfd_core session over a blocking socket, for scripts and
+    # tests that want one request at a time. start() calls
+    # connection_made(); step() reads once and answers whatever the peer
+    # asked, and run_until() steps until a condition holds. request()
+    # returns a future for the response and wait() steps until it is done.
+    # Overdue requests fail their futures.
+
+    def __init__(self, sock, core):
+        self.socket = sock
+        self.core = core
+
+    def start(self):
+        self.core.connection_made()
+        self._flush()
+
+    def request(self, request, timeout=None, notify=True, **fields):
+        future = self.core.request(request, timeout, notify, **fields)
+        self._flush()
+        return future
+
+    def wait(self, future):
+        self.run_until(future.done)
+        return future.result()
+
+    def send_request(self, request, **fields):
+        return self.wait(self.request(request, **fields))
+
+    def teardown(self):
+        self.core.close()
+        self.socket.close()
+
+    def run_until(self, predicate):
+        while not predicate():
+            self.step()
+
+    def step(self):
+        deadline = self.core.next_deadline()
+        self.socket.settimeout(None if deadline is None else
+                               max(0.001, deadline - self.core.clock()))
+        try:
+            data = self.socket.recv(READ_SIZE)
+        except socket.timeout:
+            data = None
+        if data == b'':
+            raise ConnectionError('Connection closed by peer')
+        if data:
+            self.core.receive_data(data)
+        self.core.expire()
+        self._flush()
+
+    def _flush(self):
+        data = self.core.data_to_send()
+        if data:
+            self.socket.sendall(data)
+
+
+def listen(loop, port, accept, host='', backlog=DEFAULT_BACKLOG):
+    # Calls accept(socket, address) for every incoming connection.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    listener.setblocking(False)
+
+    def ready(events):
+        while True:
+            try:
+                client, address = listener.accept()
+            except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+                return
+            except OSError:
+                # Out of descriptors or buffers: the pending connection stays
+                # readable, so stop watching it for a while rather than spin.
+                loop.unregister(listener)
+                loop.call_later(ACCEPT_BACKOFF, loop.register, listener,
+                                selectors.EVENT_READ, ready)
+                return
+            accept(client, address)
+
+    loop.register(listener, selectors.EVENT_READ, ready)
+    return listener
+
+
+def connect(address, port):
+    # Starts a non-blocking connect; failures surface on the first read.
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.setblocking(False)
+    client.connect_ex((address, port))
+    return client
@@ -0,0 +1,565 @@
+import array
+import bisect
+import mmap
+import random
+import socket
+import struct
+import time
+import wfd_rtcp
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+TS_PACKETS_PER_RTP = 7
+RTP_PAYLOAD_SIZE = TS_PACKET_SIZE * TS_PACKETS_PER_RTP
+RTP_VERSION = 0x80
+RTP_MP2T_PAYLOAD_TYPE = 33
+RTP_CLOCK_RATE = 90000
+RTP_HEADER = struct.Struct('!BBHII')
+RTP_HEADER_DTYPE = numpy.dtype([
+    ('flags', 'u1'), ('payload_type', 'u1'), ('sequence', '>u2'),
+    ('timestamp', '>u4'), ('ssrc', '>u4')]) if numpy else None
+
+DEFAULT_BATCH_INTERVAL = 0.004
+DEFAULT_HEADER_BLOCK = 64
+DEFAULT_VECTORIZE_THRESHOLD = 24
+
+
+def is_random_access(packet, offset=0):
+    return (packet[offset + 3] & 0x20 != 0 and packet[offset + 4] > 0 and
+            packet[offset + 5] & 0x40 != 0)
+
+
+def read_pcr(packet, offset=0):
+    # Returns the PCR of a TS packet in seconds, or None.
+    if packet[offset] != TS_SYNC_BYTE or not packet[offset + 3] & 0x20:
+        return None
+    if packet[offset + 4] < 7 or not packet[offset + 5] & 0x10:
+        return None
+    b = packet[offset + 6:offset + 12]
+    base = (b[0] << 25) | (b[1] << 17) | (b[2] << 9) | (b[3] << 1) | (b[4] >> 7)
+    extension = ((b[4] & 0x01) << 8) | b[5]
+    return base / 90000.0 + extension / 27000000.0
+
+
+class TsFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.chunks = len(self.map) // RTP_PAYLOAD_SIZE
+        self.times = None
+        self.rtp_times = None
+        self.access_points = bytearray(self.chunks)
+        self._scan()
+        self.duration = 2 * self.times[-1] - self.times[-2]
+
+    def payload(self, index):
+        start = index * RTP_PAYLOAD_SIZE
+        return self.view[start:start + RTP_PAYLOAD_SIZE]
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+    def _scan(self):
+        # Send time of every RTP payload, interpolated between PCRs by
+        # byte position. Payloads carrying a random access indicator are
+        # access points; streams without any fall back to PCR payloads.
+        points = []
+        for index in range(self.chunks):
+            start = index * RTP_PAYLOAD_SIZE
+            pcr = None
+            for offset in range(start, start + RTP_PAYLOAD_SIZE, TS_PACKET_SIZE):
+                if is_random_access(self.map, offset):
+                    self.access_points[index] = 1
+                if pcr is None:
+                    pcr = read_pcr(self.map, offset)
+            if pcr is not None:
+                points.append((index, pcr))
+        if len(points) < 2:
+            raise Exception('{0}: not enough PCRs to pace'.format(self.path))
+        if not any(self.access_points):
+            for index, pcr in points:
+                self.access_points[index] = 1
+
+        times = array.array('d', bytes(8 * self.chunks))
+        segments = list(zip(points, points[1:]))
+        for (first, first_pcr), (last, last_pcr) in segments:
+            rate = (last_pcr - first_pcr) / (last - first)
+            for index in range(first, last):
+                times[index] = first_pcr + rate * (index - first)
+        (first, first_pcr), _ = segments[0]
+        for index in range(first):
+            times[index] = first_pcr
+        for index in range(last, self.chunks):
+            times[index] = last_pcr + rate * (index - last)
+        origin = times[0]
+        for index in range(self.chunks):
+            times[index] -= origin
+        self.times = times
+        self.rtp_times = array.array(
+            'q', (int(t * RTP_CLOCK_RATE) for t in times))
+
+
+class RtpHeaderBlock(object):
+    # Preallocated headers for a block of packets sharing one SSRC, filled
+    # in one go: with NumPy through a structured view of the buffer,
+    # otherwise with struct. NumPy's per-call overhead only pays off from
+    # about two dozen packets, so smaller blocks always use struct.
+    # headers[i] is a memoryview ready to be the first buffer of a
+    # sendmsg() call.
+
+    def __init__(self, capacity=DEFAULT_HEADER_BLOCK,
+                 payload_type=RTP_MP2T_PAYLOAD_TYPE, vectorized=None,
+                 threshold=DEFAULT_VECTORIZE_THRESHOLD):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.payload_type = payload_type
+        self.buffer = bytearray(capacity * RTP_HEADER.size)
+        view = memoryview(self.buffer)
+        self.headers = [view[i:i + RTP_HEADER.size]
+                        for i in range(0, len(self.buffer), RTP_HEADER.size)]
+        self.vectorized = numpy is not None if vectorized is None else vectorized
+        if self.vectorized:
+            self.array = numpy.frombuffer(self.buffer, dtype=RTP_HEADER_DTYPE)
+            self.array['flags'] = RTP_VERSION
+            self.array['payload_type'] = payload_type
+            self.offsets = numpy.arange(capacity, dtype=numpy.int64)
+
+    def fill(self, ssrc, sequence, timestamps, timestamp_offset=0):
+        # timestamps is an array('q') in RTP clock units, at most capacity
+        # of them.
+        count = len(timestamps)
+        if self.vectorized and count >= self.threshold:
+            block = self.array[:count]
+            block['sequence'] = (self.offsets[:count] + sequence) & 0xFFFF
+            block['timestamp'] = (numpy.frombuffer(timestamps, dtype=numpy.int64)
+                                  + timestamp_offset) & 0xFFFFFFFF
+            block['ssrc'] = ssrc
+        else:
+            for i in range(count):
+                RTP_HEADER.pack_into(
+                    self.buffer, i * RTP_HEADER.size, RTP_VERSION,
+                    self.payload_type, (sequence + i) & 0xFFFF,
+                    (timestamps[i] + timestamp_offset) & 0xFFFFFFFF, ssrc)
+        return self.headers[:count]
+
+
+class RtpTsSender(object):
+    # With an RtcpSession attached, every pump also exchanges RTCP and a
+    # rate controller below 1.0 thins the payloads sent, keeping access
+    # points.
+
+    def __init__(self, ts_file, address, sock=None, ssrc=None,
+                 batch_interval=DEFAULT_BATCH_INTERVAL, rtcp=None):
+        self.ts_file = ts_file
+        self.address = address
+        self.socket = sock or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.ssrc = random.getrandbits(32) if ssrc is None else ssrc
+        self.sequence = random.getrandbits(16)
+        self.batch_interval = batch_interval
+        self.headers = RtpHeaderBlock()
+        self.position = 0
+        self.origin = None
+        self.packets = 0
+        self.bytes = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.rtcp = rtcp
+        self.credit = 0.0
+        self.thinned = 0
+
+    @property
+    def playing(self):
+        return self.origin is not None
+
+    def play(self, now):
+        if self.position < self.ts_file.chunks:
+            self.origin = now - self.ts_file.times[self.position]
+
+    def pause(self):
+        self.origin = None
+
+    def close(self):
+        self.origin = None
+        self.socket.close()
+        if self.rtcp is not None:
+            self.rtcp.close()
+
+    def pump(self, now):
+        # Sends every payload due within the batch window and returns the
+        # delay until the next one, or None when paused or finished.
+        if self.origin is None:
+            return None
+        times = self.ts_file.times
+        end = bisect.bisect_right(times, now - self.origin + self.batch_interval,
+                                  self.position)
+        while self.position < end:
+            count = min(end - self.position, self.headers.capacity)
+            self._send(self.position, count, now)
+            self.position += count
+        if self.rtcp is not None:
+            self.rtcp.poll(now, int((now - self.origin) * RTP_CLOCK_RATE),
+                           self.packets, self.bytes)
+        if self.position >= self.ts_file.chunks:
+            self.origin = None
+            return None
+        return max(0.0, times[self.position] - (now - self.origin))
+
+    def report(self):
+        report = {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'mbit_per_second': self._bitrate(),
+            'mean_jitter_ms': 1000.0 * self.jitter_total / self.packets if self.packets else 0.0,
+            'max_jitter_ms': 1000.0 * self.jitter_max,
+            'thinned': self.thinned,
+        }
+        if self.rtcp is not None:
+            report.update(self.rtcp.stats.report())
+        return report
+
+    def _bitrate(self):
+        times = self.ts_file.times
+        duration = times[max(0, self.position - 1)] - times[0]
+        return 8 * self.bytes / duration / 1e6 if duration > 0 else 0.0
+
+    def _rate(self):
+        if self.rtcp is None or self.rtcp.controller is None:
+            return 1.0
+        return self.rtcp.controller.rate
+
+    def _thin(self, first, count, rate):
+        # Keeps about rate of the payloads, and every access point.
+        kept = []
+        access_points = self.ts_file.access_points
+        for index in range(first, first + count):
+            self.credit += rate
+            if self.credit >= 1.0 or access_points[index]:
+                self.credit = max(0.0, self.credit - 1.0)
+                kept.append(index)
+        self.thinned += count - len(kept)
+        return kept
+
+    def _send(self, first, count, now):
+        rate = self._rate()
+        if rate < 1.0:
+            indices = self._thin(first, count, rate)
+            timestamps = array.array(
+                'q', (self.ts_file.rtp_times[index] for index in indices))
+            count = len(indices)
+        else:
+            indices = range(first, first + count)
+            timestamps = self.ts_file.rtp_times[first:first + count]
+        headers = self.headers.fill(self.ssrc, self.sequence, timestamps)
+        times = self.ts_file.times
+        for index, header in zip(indices, headers):
+            payload = self.ts_file.payload(index)
+            try:
+                self.socket.sendmsg([header, payload], (), 0, self.address)
+            except (BlockingIOError, ConnectionRefusedError):
+                pass
+            finally:
+                payload.release()
+            jitter = abs(now - (self.origin + times[index]))
+            self.jitter_total += jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+        self.sequence = (self.sequence + count) & 0xFFFF
+        self.packets += count
+        self.bytes += count * RTP_PAYLOAD_SIZE
+
+
+def format_report(report):
+    text = '{0} RTP packets, {1:.2f} Mbit/s, jitter {2:.3f} ms mean / {3:.3f} ms max'.format(
+        report['packets'], report['mbit_per_second'],
+        report['mean_jitter_ms'], report['max_jitter_ms'])
+    if report.get('thinned'):
+        text += ', {0} thinned'.format(report['thinned'])
+    if report.get('rtcp_reports'):
+        text += ', sink reports {0:.1%} lost ({1} total), jitter {2:.3f} ms'.format(
+            report['fraction_lost'], report['cumulative_lost'],
+            report['rtcp_jitter_ms'])
+        if report['rtt_ms'] is not None:
+            text += ', RTT {0:.3f} ms'.format(report['rtt_ms'])
+    if report.get('dropped'):
+        text += ', dropped for falling behind'
+    return text
+
+
+class MediaStream(object):
+    # Drives an RtpTsSender from any call_later(delay, callable) scheduler
+    # whose handles have cancel(): reactor.callLater or loop.call_later,
+    # on the thread handling the session's requests.
+
+    def __init__(self, sender, call_later, clock=time.monotonic):
+        self.sender = sender
+        self.call_later = call_later
+        self.clock = clock
+        self.call = None
+
+    @property
+    def port(self):
+        return self.sender.socket.getsockname()[1]
+
+    @property
+    def rtcp(self):
+        return self.sender.rtcp
+
+    def play(self):
+        if not self.sender.playing:
+            self.sender.play(self.clock())
+            self._schedule(0)
+
+    def pause(self):
+        self._cancel()
+        self.sender.pause()
+
+    def stop(self):
+        self._cancel()
+        self.sender.close()
+        return self.sender.report()
+
+    def _run(self):
+        self.call = None
+        delay = self.sender.pump(self.clock())
+        if delay is not None:
+            self._schedule(delay)
+
+    def _schedule(self, delay):
+        self.call = self.call_later(delay, self._run)
+
+    def _cancel(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+
+def _open_rtcp(rtcp_address, ssrc, rate_controller, readers):
+    # The RTP socket goes out from an even port so the sink finds RTCP on
+    # the next one.
+    sock, rtcp_socket = wfd_rtcp.bind_pair()
+    controller = rate_controller() if rate_controller is not None else None
+    return sock, wfd_rtcp.RtcpSession(rtcp_socket, rtcp_address, ssrc,
+                                      controller, readers=readers)
+
+
+class UnicastSource(object):
+    # Every sink gets its own sender reading the file from the start.
+    # rate_controller builds a wfd_rtcp.RateController for each of them;
+    # readers, if given, reads their RTCP sockets (see RtcpSession).
+
+    def __init__(self, ts_file, call_later, rate_controller=None,
+                 readers=None):
+        self.ts_file = ts_file
+        self.call_later = call_later
+        self.rate_controller = rate_controller
+        self.readers = readers
+
+    def open(self, address, rtcp_address=None):
+        if rtcp_address is None:
+            return MediaStream(RtpTsSender(self.ts_file, address),
+                               self.call_later)
+        ssrc = random.getrandbits(32)
+        sock, rtcp = _open_rtcp(rtcp_address, ssrc, self.rate_controller,
+                                self.readers)
+        return MediaStream(RtpTsSender(self.ts_file, address, sock, ssrc,
+                                       rtcp=rtcp), self.call_later)
+
+
+class BroadcastSubscriber(object):
+    # A sink of a Broadcast: its own socket, RTP header fields and a cursor
+    # into the shared ring. play() joins at the next access point, pause()
+    # leaves. The shared ring is never thinned, so RTCP here only collects
+    # the sink's reports.
+
+    def __init__(self, broadcast, address, rtcp_address=None):
+        self.broadcast = broadcast
+        self.address = address
+        self.ssrc = random.getrandbits(32)
+        self.rtcp = None
+        if rtcp_address is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.socket, self.rtcp = _open_rtcp(rtcp_address, self.ssrc, None,
+                                                broadcast.readers)
+        self.socket.setblocking(False)
+        self.sequence = random.getrandbits(16)
+        self.timestamp_offset = random.getrandbits(32)
+        self.headers = RtpHeaderBlock()
+        self.cursor = None
+        self.dropped = False
+        self.packets = 0
+        self.bytes = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.first_time = None
+        self.last_time = None
+
+    def play(self):
+        if not self.dropped:
+            self.broadcast.join(self)
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def pause(self):
+        self.broadcast.leave(self)
+
+    def stop(self):
+        self.broadcast.leave(self)
+        self.socket.close()
+        if self.rtcp is not None:
+            self.rtcp.close()
+        return self.report()
+
+    def report(self):
+        duration = (self.last_time - self.first_time) if self.packets else 0.0
+        report = {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'mbit_per_second': 8 * self.bytes / duration / 1e6 if duration > 0 else 0.0,
+            'mean_jitter_ms': 1000.0 * self.jitter_total / self.packets if self.packets else 0.0,
+            'max_jitter_ms': 1000.0 * self.jitter_max,
+            'dropped': self.dropped,
+        }
+        if self.rtcp is not None:
+            report.update(self.rtcp.stats.report())
+        return report
+
+    def drain(self, now):
+        # Sends everything between the cursor and the ring head; returns
+        # False once the sink has fallen a whole ring behind.
+        ring = self.broadcast
+        if ring.head - self.cursor > ring.size:
+            return False
+        if self.rtcp is not None:
+            self.rtcp.poll(now, self.timestamp_offset + int(
+                (now - ring.origin) * RTP_CLOCK_RATE), self.packets, self.bytes)
+        while self.cursor < ring.head:
+            first = self.cursor % ring.size
+            count = min(ring.head - self.cursor, ring.size - first,
+                        self.headers.capacity)
+            headers = self.headers.fill(
+                self.ssrc, self.sequence,
+                ring.rtp_times[first:first + count], self.timestamp_offset)
+            for slot, header in enumerate(headers, first):
+                try:
+                    self.socket.sendmsg([header, ring.payloads[slot]],
+                                        (), 0, self.address)
+                except BlockingIOError:
+                    return True
+                except ConnectionRefusedError:
+                    pass
+                self._sent(ring.times[slot], now)
+        return True
+
+    def _sent(self, media_time, now):
+        self.cursor += 1
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.packets += 1
+        self.bytes += RTP_PAYLOAD_SIZE
+        if self.first_time is None:
+            self.first_time = media_time
+        self.last_time = media_time
+        jitter = abs(now - (self.broadcast.origin + media_time))
+        self.jitter_total += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+
+
+class Broadcast(object):
+    # One reader paces the file, looping it, into a ring of payload views
+    # shared by every subscriber. A subscriber that falls a whole ring
+    # behind is dropped instead of holding the others back.
+
+    DEFAULT_RING_SIZE = 1024
+
+    def __init__(self, ts_file, call_later, ring_size=DEFAULT_RING_SIZE,
+                 batch_interval=DEFAULT_BATCH_INTERVAL, clock=time.monotonic,
+                 readers=None):
+        self.ts_file = ts_file
+        self.call_later = call_later
+        self.readers = readers
+        self.size = ring_size
+        self.batch_interval = batch_interval
+        self.clock = clock
+        self.payloads = [None] * ring_size
+        self.times = array.array('d', bytes(8 * ring_size))
+        self.rtp_times = array.array('q', bytes(8 * ring_size))
+        self.head = 0
+        self.position = 0
+        self.loops = 0
+        self.origin = None
+        self.subscribers = set()
+        self.joining = set()
+        self.call = None
+
+    def open(self, address, rtcp_address=None):
+        return BroadcastSubscriber(self, address, rtcp_address)
+
+    def join(self, subscriber):
+        if subscriber in self.subscribers or subscriber in self.joining:
+            return
+        subscriber.cursor = None
+        self.joining.add(subscriber)
+        if self.call is None:
+            self.origin = self.clock() - self._media_time()
+            self._schedule(0)
+
+    def leave(self, subscriber):
+        self.subscribers.discard(subscriber)
+        self.joining.discard(subscriber)
+        if not self.subscribers and not self.joining and self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+    def _media_time(self):
+        return self.ts_file.times[self.position] + self.loops * self.ts_file.duration
+
+    def _produce(self):
+        slot = self.head % self.size
+        self.payloads[slot] = self.ts_file.payload(self.position)
+        self.times[slot] = self._media_time()
+        self.rtp_times[slot] = int(self.times[slot] * RTP_CLOCK_RATE)
+        if self.joining and self.ts_file.access_points[self.position]:
+            for subscriber in self.joining:
+                subscriber.cursor = self.head
+            self.subscribers.update(self.joining)
+            self.joining.clear()
+        self.head += 1
+        self.position += 1
+        if self.position == self.ts_file.chunks:
+            self.position = 0
+            self.loops += 1
+
+    def _run(self):
+        self.call = None
+        now = self.clock()
+        horizon = now - self.origin + self.batch_interval
+        while self._media_time() <= horizon:
+            self._produce()
+        for subscriber in list(self.subscribers):
+            if not subscriber.drain(now):
+                subscriber.dropped = True
+                self.subscribers.discard(subscriber)
+        if self.subscribers or self.joining:
+            self._schedule(max(0.0, self._media_time() - (now - self.origin)))
+
+    def _schedule(self, delay):
+        self.call = self.call_later(delay, self._run)
+
+
+def open_source(ts_file, call_later, broadcast=False, rate_controller=None,
+                readers=None):
+    if broadcast:
+        return Broadcast(ts_file, call_later, readers=readers)
+    return UnicastSource(ts_file, call_later, rate_controller, readers)
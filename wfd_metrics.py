@@ -0,0 +1,227 @@
+import bisect
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value)
+                          for name, value in zip(names, values)) + '}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+        for key, value in sorted(list(self.values.items())):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['{0}{1} {2}'.format(self.name, _labels(self.labels, key), value)]
+
+    def add(self, total, value):
+        return (total or 0) + value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def add(self, total, value):
+        if total is None:
+            return [value[0][:], value[1]]
+        return [[a + b for a, b in zip(total[0], value[0])], total[1] + value[1]]
+
+    def _render_value(self, key, value):
+        counts, total = value[0][:], value[1]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('{0}_bucket{1} {2}'.format(
+                self.name, _labels(self.labels + ('le',), key + (bound,)),
+                cumulative))
+        labels = _labels(self.labels, key)
+        lines.append('{0}_sum{1} {2}'.format(self.name, labels, total))
+        lines.append('{0}_count{1} {2}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: dict(metric.values) for metric in self.metrics}
+
+    def combine(self, snapshots, gauges=True):
+        combined = {}
+        for metric in self.metrics:
+            if metric.type == 'gauge' and not gauges:
+                continue
+            values = combined[metric.name] = {}
+            for snapshot in snapshots:
+                for key, value in snapshot.get(metric.name, {}).items():
+                    values[key] = metric.add(values.get(key), value)
+        return combined
+
+    def load(self, snapshot):
+        for metric in self.metrics:
+            metric.values = dict(snapshot.get(metric.name, {}))
+
+
+REGISTRY = Registry()
+ACTIVE_SESSIONS = REGISTRY.register(Gauge(
+    'wfd_active_sessions', 'Number of connected sinks.'))
+BYTES_RECEIVED = REGISTRY.register(Counter(
+    'wfd_received_bytes_total', 'RTSP bytes received from sinks.'))
+BYTES_SENT = REGISTRY.register(Counter(
+    'wfd_sent_bytes_total', 'RTSP bytes sent to sinks.'))
+PARSE_ERRORS = REGISTRY.register(Counter(
+    'wfd_parse_errors_total', 'RTSP messages that failed to parse.'))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'wfd_request_seconds', 'Round trip of source requests by method.',
+    labels=('method',)))
+STATE_SECONDS = REGISTRY.register(Histogram(
+    'wfd_state_seconds', 'Time spent in a session state before leaving it.',
+    labels=('state',)))
+HANDSHAKE_SECONDS = REGISTRY.register(Histogram(
+    'wfd_handshake_seconds', 'Time from connection to a completed SETUP.'))
+UIBC_EVENTS = REGISTRY.register(Counter(
+    'wfd_uibc_events_total', 'UIBC input events received by type.',
+    labels=('type',)))
+UIBC_LATENCY_SECONDS = REGISTRY.register(Histogram(
+    'wfd_uibc_latency_seconds',
+    'Time from a UIBC event timestamp at the sink to its dispatch.',
+    labels=('type',)))
+RTCP_REPORTS = REGISTRY.register(Counter(
+    'wfd_rtcp_reports_total', 'RTCP report blocks received from sinks.'))
+RTCP_FRACTION_LOST = REGISTRY.register(Histogram(
+    'wfd_rtcp_fraction_lost', 'Fraction of RTP packets lost per sink report.',
+    buckets=(0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)))
+RTCP_RTT_SECONDS = REGISTRY.register(Histogram(
+    'wfd_rtcp_rtt_seconds', 'Round trip time from RTCP receiver reports.'))
+CAPABILITY_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'wfd_capability_cache_lookups_total',
+    'Sink capability cache lookups by result.', labels=('result',)))
+CAPABILITY_CACHE_SAVED_SECONDS = REGISTRY.register(Counter(
+    'wfd_capability_cache_saved_seconds_total',
+    'Handshake time saved by sink capability cache hits.'))
+
+
+class SessionMetrics(object):
+    HANDSHAKE_DONE = 'Pause'
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.state = None
+        self.entered = self.started
+        self.handshake_completed = False
+        self.closed = False
+        ACTIVE_SESSIONS.inc()
+
+    def transition(self, state):
+        now = time.monotonic()
+        if self.state is not None:
+            STATE_SECONDS.observe(now - self.entered, self.state)
+        if state == self.HANDSHAKE_DONE and not self.handshake_completed:
+            self.handshake_completed = True
+            HANDSHAKE_SECONDS.observe(now - self.started)
+        self.state = state
+        self.entered = now
+
+    def request_completed(self, method, seconds):
+        REQUEST_SECONDS.observe(seconds, method)
+
+    def data_received(self, size):
+        BYTES_RECEIVED.inc(size)
+
+    def data_sent(self, size):
+        BYTES_SENT.inc(size)
+
+    def parse_error(self):
+        PARSE_ERRORS.inc()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.state is not None:
+                STATE_SECONDS.observe(time.monotonic() - self.entered, self.state)
+            ACTIVE_SESSIONS.dec()
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host='127.0.0.1', registry=REGISTRY):
+    def application(environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'']
+        body = registry.render().encode('ascii')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    server = make_server(host, port, application, handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
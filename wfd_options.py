@@ -0,0 +1,54 @@
+import rtsp
+import wfd_capcache
+import wfd_profile
+import wfd_session
+import wfd_trace
+
+
+# Command line options every source server takes. With workers, the file
+# options say that each worker process writes FILE.N.
+
+
+def add_server_arguments(parser, workers=False):
+    per_worker = ', FILE.N for worker N' if workers else ''
+    parser.add_argument('port', type=int, nargs='?',
+                        default=rtsp.DEFAULT_SERVER_PORT)
+    parser.add_argument('--session-timeout', type=int,
+                        default=wfd_session.DEFAULT_TIMEOUT)
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on localhost')
+    parser.add_argument('--trace', type=int, metavar='EVENTS', nargs='?',
+                        const=wfd_trace.DEFAULT_RING_SIZE,
+                        help='keep the last EVENTS messages per session, '
+                             'dumped on error or SIGUSR1')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='append every RTSP message to a capture file'
+                             + per_worker)
+    parser.add_argument('--media', metavar='FILE',
+                        help='stream an MPEG-TS file to each sink while playing')
+    parser.add_argument('--broadcast', action='store_true',
+                        help='share one paced --media stream between the '
+                             'sinks of a process')
+    parser.add_argument('--rate-control', action='store_true',
+                        help='thin each --media stream on RTCP reported loss')
+    parser.add_argument('--uibc-port', type=int,
+                        help='offer UIBC and accept input events on this port')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='trigger SETUP without waiting for the M4 response')
+    parser.add_argument('--capability-cache', type=int, metavar='SINKS',
+                        nargs='?', const=wfd_capcache.DEFAULT_SIZE,
+                        help='remember the capabilities of SINKS sinks to '
+                             'shorten their reconnects')
+    parser.add_argument('--capability-ttl', type=float,
+                        default=wfd_capcache.DEFAULT_TTL,
+                        help='seconds a cached sink stays valid')
+    parser.add_argument('--capability-file', metavar='FILE',
+                        help='keep the capability cache in FILE across '
+                             'restarts' + per_worker)
+    parser.add_argument('--profile', metavar='FILE',
+                        help='trace allocations per session and message '
+                             'type, report them to FILE' + per_worker +
+                             ' and toggle cProfile on SIGUSR2')
+    parser.add_argument('--profile-interval', type=float,
+                        default=wfd_profile.DEFAULT_INTERVAL,
+                        help='seconds between --profile reports')
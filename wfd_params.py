@@ -0,0 +1,351 @@
+import collections
+import functools
+import types
+
+
+VideoFormats = collections.namedtuple(
+    'VideoFormats', 'native preferred_display_mode codecs')
+H264Codec = collections.namedtuple(
+    'H264Codec', 'profile level cea vesa hh latency min_slice_size '
+                 'slice_enc_params frame_rate_control max_hres max_vres')
+AudioCodec = collections.namedtuple('AudioCodec', 'format modes latency')
+ClientRtpPorts = collections.namedtuple(
+    'ClientRtpPorts', 'profile port0 port1 mode')
+UibcCapability = collections.namedtuple(
+    'UibcCapability', 'input_categories generic hidc port')
+
+# Resolution/refresh rate tables, indexed by bit position (WFD 1.0, 5.1.3).
+CEA_RESOLUTIONS = (
+    (640, 480, 60), (720, 480, 60), (720, 480, 60), (720, 576, 50),
+    (720, 576, 50), (1280, 720, 30), (1280, 720, 60), (1920, 1080, 30),
+    (1920, 1080, 60), (1920, 1080, 60), (1280, 720, 25), (1280, 720, 50),
+    (1920, 1080, 25), (1920, 1080, 50), (1920, 1080, 50), (1280, 720, 24),
+    (1920, 1080, 24))
+VESA_RESOLUTIONS = (
+    (800, 600, 30), (800, 600, 60), (1024, 768, 30), (1024, 768, 60),
+    (1152, 864, 30), (1152, 864, 60), (1280, 768, 30), (1280, 768, 60),
+    (1280, 800, 30), (1280, 800, 60), (1360, 768, 30), (1360, 768, 60),
+    (1366, 768, 30), (1366, 768, 60), (1280, 1024, 30), (1280, 1024, 60),
+    (1400, 1050, 30), (1400, 1050, 60), (1440, 900, 30), (1440, 900, 60),
+    (1600, 900, 30), (1600, 900, 60), (1600, 1200, 30), (1600, 1200, 60),
+    (1680, 1024, 30), (1680, 1024, 60), (1680, 1050, 30), (1680, 1050, 60),
+    (1920, 1200, 30))
+HH_RESOLUTIONS = (
+    (800, 480, 30), (800, 480, 60), (854, 480, 30), (854, 480, 60),
+    (864, 480, 30), (864, 480, 60), (640, 360, 30), (640, 360, 60),
+    (960, 540, 30), (960, 540, 60), (848, 480, 30), (848, 480, 60))
+
+# Frame size in macroblocks and macroblocks per second an H.264 level
+# allows, by wfd_video_formats level bit: 3.1, 3.2, 4, 4.1 and 4.2.
+H264_LEVEL_LIMITS = {
+    0x01: (3600, 108000),
+    0x02: (5120, 216000),
+    0x04: (8192, 245760),
+    0x08: (8192, 245760),
+    0x10: (8704, 522240),
+}
+
+LPCM_44_1_KHZ = 0x1
+LPCM_48_KHZ = 0x2
+
+SOURCE_VIDEO_FORMATS = VideoFormats(0, 0, (
+    H264Codec(profile=0x01, level=0x1F, cea=0x0001FFFF, vesa=0x1FFFFFFF,
+              hh=0x00000FFF, latency=0, min_slice_size=0,
+              slice_enc_params=0, frame_rate_control=0,
+              max_hres=None, max_vres=None),))
+SOURCE_AUDIO_CODECS = (
+    AudioCodec('LPCM', LPCM_44_1_KHZ | LPCM_48_KHZ, 0),
+    AudioCodec('AAC', 0x0000000F, 0),
+    AudioCodec('AC3', 0x00000007, 0),
+)
+SOURCE_UIBC_CAPABILITY = UibcCapability(
+    ('GENERIC',), ('Keyboard', 'Mouse', 'SingleTouch', 'MultiTouch'), (),
+    None)
+
+
+class WfdProtocolError(Exception):
+    # A sink or source broke the WFD protocol: bad parameters, a request
+    # in the wrong state, no common format.
+    pass
+
+
+def _hex(value, width):
+    return 'none' if value is None else '{0:0{1}X}'.format(value, width)
+
+
+def _int(field):
+    return None if field == 'none' else int(field, 16)
+
+
+def parse_video_formats(value):
+    if value.strip() == 'none':
+        return None
+    native, preferred, rest = value.split(None, 2)
+    codecs = []
+    for codec in rest.split(','):
+        fields = codec.split()
+        codecs.append(H264Codec(*[_int(field) for field in fields[:11]]))
+    return VideoFormats(int(native, 16), int(preferred, 16), tuple(codecs))
+
+
+def format_video_formats(formats):
+    if formats is None:
+        return 'none'
+    codecs = ', '.join(' '.join((
+        _hex(codec.profile, 2), _hex(codec.level, 2),
+        _hex(codec.cea, 8), _hex(codec.vesa, 8), _hex(codec.hh, 8),
+        _hex(codec.latency, 2), _hex(codec.min_slice_size, 4),
+        _hex(codec.slice_enc_params, 4), _hex(codec.frame_rate_control, 2),
+        _hex(codec.max_hres, 4), _hex(codec.max_vres, 4)))
+        for codec in formats.codecs)
+    return '{0} {1} {2}'.format(_hex(formats.native, 2),
+                                _hex(formats.preferred_display_mode, 2),
+                                codecs)
+
+
+def parse_audio_codecs(value):
+    if value.strip() == 'none':
+        return ()
+    codecs = []
+    for codec in value.split(','):
+        name, modes, latency = codec.split()
+        codecs.append(AudioCodec(name, int(modes, 16), int(latency, 16)))
+    return tuple(codecs)
+
+
+def format_audio_codecs(codecs):
+    if not codecs:
+        return 'none'
+    return ', '.join('{0} {1} {2}'.format(codec.format, _hex(codec.modes, 8),
+                                          _hex(codec.latency, 2))
+                     for codec in codecs)
+
+
+def parse_client_rtp_ports(value):
+    profile, port0, port1, mode = value.split()
+    return ClientRtpPorts(profile, int(port0), int(port1), mode.split('=')[1])
+
+
+def format_client_rtp_ports(ports):
+    return '{0} {1} {2} mode={3}'.format(ports.profile, ports.port0,
+                                         ports.port1, ports.mode)
+
+
+def _list(value):
+    if value.strip() == 'none':
+        return ()
+    return tuple(item.strip() for item in value.split(','))
+
+
+def _format_list(items):
+    return ', '.join(items) if items else 'none'
+
+
+def parse_uibc_capability(value):
+    # input_category_list=GENERIC;generic_cap_list=Mouse, Keyboard;
+    # hidc_cap_list=none;port=none (WFD 1.0, 6.1.12)
+    if value.strip() == 'none':
+        return None
+    fields = dict(field.strip().partition('=')[::2]
+                  for field in value.split(';') if field.strip())
+    port = fields.get('port', 'none').strip()
+    return UibcCapability(_list(fields.get('input_category_list', 'none')),
+                          _list(fields.get('generic_cap_list', 'none')),
+                          _list(fields.get('hidc_cap_list', 'none')),
+                          None if port == 'none' else int(port))
+
+
+def format_uibc_capability(capability):
+    if capability is None:
+        return 'none'
+    return ('input_category_list={0};generic_cap_list={1};'
+            'hidc_cap_list={2};port={3}'.format(
+                _format_list(capability.input_categories),
+                _format_list(capability.generic),
+                _format_list(capability.hidc),
+                'none' if capability.port is None else capability.port))
+
+
+PARSERS = {
+    'wfd_video_formats': parse_video_formats,
+    'wfd_audio_codecs': parse_audio_codecs,
+    'wfd_client_rtp_ports': parse_client_rtp_ports,
+    'wfd_uibc_capability': parse_uibc_capability,
+}
+FORMATTERS = {
+    'wfd_video_formats': format_video_formats,
+    'wfd_audio_codecs': format_audio_codecs,
+    'wfd_client_rtp_ports': format_client_rtp_ports,
+    'wfd_uibc_capability': format_uibc_capability,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_parameters(body):
+    if isinstance(body, bytes):
+        body = body.decode('ascii')
+    parameters = {}
+    for line in body.split('\r\n'):
+        name, sep, value = line.partition(':')
+        if not sep:
+            continue
+        name = name.strip()
+        value = value.strip()
+        parser = PARSERS.get(name)
+        try:
+            parameters[name] = parser(value) if parser else value
+        except (ValueError, IndexError, TypeError):
+            raise WfdProtocolError('Bad {0}: {1}'.format(name, value))
+    return types.MappingProxyType(parameters)
+
+
+def format_parameters(parameters):
+    lines = []
+    for name, value in parameters.items():
+        formatter = FORMATTERS.get(name)
+        lines.append('{0}: {1}\r\n'.format(
+            name, formatter(value) if formatter else value))
+    return ''.join(lines)
+
+
+RESOLUTION_TABLES = (('cea', CEA_RESOLUTIONS), ('vesa', VESA_RESOLUTIONS),
+                     ('hh', HH_RESOLUTIONS))
+
+
+def video_resolution(formats):
+    # (width, height, refresh rate) of a negotiated, single mode format.
+    codec = formats.codecs[0]
+    for table, resolutions in RESOLUTION_TABLES:
+        mode = getattr(codec, table)
+        if mode:
+            return resolutions[mode.bit_length() - 1]
+    return None
+
+
+def lower_video_mode(negotiated, sink, source=SOURCE_VIDEO_FORMATS):
+    # The mode with the next lower pixel rate in the negotiated mode's table
+    # that both sides support, or None when there is none.
+    codec = negotiated.codecs[0]
+    for table, resolutions in RESOLUTION_TABLES:
+        if getattr(codec, table):
+            break
+    else:
+        return None
+    width, height, rate = video_resolution(negotiated)
+    current = width * height * rate
+    common = 0
+    for sink_codec in sink.codecs:
+        if sink_codec.profile & codec.profile:
+            for source_codec in source.codecs:
+                common |= getattr(source_codec, table) & getattr(sink_codec, table)
+    best = None
+    for bit, (width, height, rate) in enumerate(resolutions):
+        pixels = width * height * rate
+        if common >> bit & 1 and pixels < current and (
+                best is None or pixels > best[0]):
+            best = (pixels, bit)
+    if best is None:
+        return None
+    return negotiated._replace(
+        codecs=(codec._replace(**{table: 1 << best[1]}),))
+
+
+def best_mode(mask):
+    # Highest bit; profiles, levels and audio modes rise with their bits.
+    return 1 << (mask.bit_length() - 1) if mask else 0
+
+
+def _fits_level(resolution, level):
+    width, height, rate = resolution
+    frame = ((width + 15) // 16) * ((height + 15) // 16)
+    max_frame, max_rate = H264_LEVEL_LIMITS[level]
+    return frame <= max_frame and frame * rate <= max_rate
+
+
+def _preferred_modes(resolutions, level=None):
+    # Mode bits by falling pixel rate, as lower_video_mode() ranks them,
+    # leaving out those beyond the level.
+    bits = sorted(range(len(resolutions)), key=lambda bit: (
+        -resolutions[bit][0] * resolutions[bit][1] * resolutions[bit][2], bit))
+    return tuple(bit for bit in bits if level is None or
+                 _fits_level(resolutions[bit], level))
+
+
+# (table, level) -> mode bits in order of preference; (table, None) for
+# levels without known limits.
+PREFERRED_MODES = {}
+for _table, _resolutions in RESOLUTION_TABLES:
+    PREFERRED_MODES[_table, None] = _preferred_modes(_resolutions)
+    for _level in H264_LEVEL_LIMITS:
+        PREFERRED_MODES[_table, _level] = _preferred_modes(_resolutions, _level)
+
+
+def preferred_mode(table, mask, level=None):
+    # The best mode of mask the level can carry, 0 if none.
+    for bit in PREFERRED_MODES.get((table, level), PREFERRED_MODES[table, None]):
+        if mask >> bit & 1:
+            return 1 << bit
+    return 0
+
+
+def negotiate_video(source, sink):
+    for sink_codec in sink.codecs:
+        for codec in source.codecs:
+            profile = best_mode(codec.profile & sink_codec.profile)
+            level = best_mode(codec.level & sink_codec.level)
+            if not profile or not level:
+                continue
+            for table, _ in RESOLUTION_TABLES:
+                mode = preferred_mode(
+                    table, getattr(codec, table) & getattr(sink_codec, table),
+                    level)
+                if mode:
+                    modes = dict(cea=0, vesa=0, hh=0)
+                    modes[table] = mode
+                    return VideoFormats(0, 0, (codec._replace(
+                        profile=profile, level=level, **modes),))
+    raise WfdProtocolError('No common video mode')
+
+
+def negotiate_audio(source, sink):
+    sink_modes = {codec.format: codec.modes for codec in sink}
+    for codec in source:
+        mode = best_mode(codec.modes & sink_modes.get(codec.format, 0))
+        if mode:
+            return (codec._replace(modes=mode),)
+    raise WfdProtocolError('No common audio codec')
+
+
+def negotiate_uibc(source, sink, port):
+    # Only the generic category is implemented; None disables UIBC.
+    generic = tuple(name for name in source.generic if name in sink.generic)
+    if 'GENERIC' not in sink.input_categories or not generic:
+        return None
+    return UibcCapability(('GENERIC',), generic, (), port)
+
+
+@functools.lru_cache(maxsize=1024)
+def negotiate(sink_body, presentation_url, uibc_port=None,
+              source_video=SOURCE_VIDEO_FORMATS,
+              source_audio=SOURCE_AUDIO_CODECS,
+              source_uibc=SOURCE_UIBC_CAPABILITY):
+    sink = parse_parameters(sink_body)
+    parameters = collections.OrderedDict()
+    if sink.get('wfd_video_formats'):
+        parameters['wfd_video_formats'] = negotiate_video(
+            source_video, sink['wfd_video_formats'])
+    if sink.get('wfd_audio_codecs'):
+        parameters['wfd_audio_codecs'] = negotiate_audio(
+            source_audio, sink['wfd_audio_codecs'])
+    parameters['wfd_presentation_URL'] = presentation_url
+    ports = sink.get('wfd_client_rtp_ports')
+    if ports is None:
+        raise WfdProtocolError('Sink did not report wfd_client_rtp_ports')
+    parameters['wfd_client_rtp_ports'] = ports
+    if uibc_port is not None and sink.get('wfd_uibc_capability'):
+        uibc = negotiate_uibc(source_uibc, sink['wfd_uibc_capability'],
+                              uibc_port)
+        if uibc is not None:
+            parameters['wfd_uibc_capability'] = uibc
+            parameters['wfd_uibc_setting'] = 'enable'
+    return format_parameters(parameters)
@@ -0,0 +1,186 @@
+import cProfile
+import collections
+import os
+import pstats
+import signal
+import sys
+import time
+import tracemalloc
+import weakref
+
+
+# Opt-in profiling for the servers. While enabled, tracemalloc runs and the
+# traced memory each session step leaves behind is charged to the session
+# and, per message, to the message type; report() writes that with the top
+# allocation sites and their growth since the last report. A signal starts
+# and stops cProfile, each run saved as FILE.N.pstats. Steps are measured
+# on the global traced total, so only one session may step at a time, as on
+# every server's event loop; media threads add a little noise.
+DEFAULT_INTERVAL = 60.0
+DEFAULT_FRAMES = 1
+TOP_SITES = 15
+TOP_SESSIONS = 10
+TOP_FUNCTIONS = 25
+
+enabled = False
+interval = DEFAULT_INTERVAL
+_path = None
+_sessions = weakref.WeakSet()
+# Message type -> [messages, bytes retained].
+_messages = collections.defaultdict(lambda: [0, 0])
+_baseline = None
+_profiler = None
+_runs = 0
+
+
+def traced():
+    return tracemalloc.get_traced_memory()[0]
+
+
+class NullProfile(object):
+    enabled = False
+
+    def begin(self):
+        pass
+
+    def end(self):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+class SessionProfile(object):
+    # begin() and end() bracket a step of the session; nested steps, a
+    # request sent while handling one received, count once.
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.retained = 0
+        self.depth = 0
+        self.started = 0
+
+    def begin(self):
+        if not self.depth:
+            self.started = traced()
+        self.depth += 1
+
+    def end(self):
+        self.depth -= 1
+        if not self.depth:
+            self.retained += traced() - self.started
+
+    def message(self, name, started):
+        counts = _messages[name]
+        counts[0] += 1
+        counts[1] += traced() - started
+
+    def close(self):
+        _sessions.discard(self)
+
+
+def enable(path, report_interval=DEFAULT_INTERVAL, frames=DEFAULT_FRAMES):
+    # Reports go to path, or stderr when it is None.
+    global enabled, interval, _path, _baseline
+    enabled = True
+    interval = report_interval
+    _path = path
+    tracemalloc.start(frames)
+    _baseline = _snapshot()
+
+
+def session_profile(name):
+    if not enabled:
+        return NULL_PROFILE
+    profile = SessionProfile(name)
+    _sessions.add(profile)
+    return profile
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ))
+
+
+def _write(text):
+    if _path is None:
+        sys.stderr.write(text)
+        sys.stderr.flush()
+        return
+    with open(_path, 'a') as f:
+        f.write(text)
+
+
+def report():
+    global _baseline
+    if not enabled:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    sessions = sorted(_sessions, key=lambda profile: -profile.retained)
+    retained = sum(profile.retained for profile in sessions)
+    lines = ['== profile {0} pid {1}'.format(
+                 time.strftime('%Y-%m-%d %H:%M:%S'), os.getpid()),
+             'traced {0} bytes, peak {1}'.format(current, peak),
+             '{0} live sessions retain {1} bytes, {2:.0f} per session'.format(
+                 len(sessions), retained,
+                 retained / float(len(sessions)) if sessions else 0.0)]
+    for profile in sessions[:TOP_SESSIONS]:
+        lines.append('  {0:>10}  {1}'.format(profile.retained, profile.name))
+    lines.append('retained by message type:')
+    for name, (count, size) in sorted(_messages.items(),
+                                      key=lambda item: -item[1][1]):
+        lines.append('  {0:>10}  {1:>8} messages  {2:>8.1f} per message  '
+                     '{3}'.format(size, count, size / float(count), name))
+    snapshot = _snapshot()
+    lines.append('top allocation sites, growth since the last report:')
+    for stat in snapshot.compare_to(_baseline, 'lineno')[:TOP_SITES]:
+        lines.append('  {0}'.format(stat))
+    _baseline = snapshot
+    _write('\n'.join(lines) + '\n')
+
+
+def schedule_reports(call_later):
+    # Reports every interval on the frontend's timers.
+    if not enabled:
+        return
+
+    def tick():
+        report()
+        call_later(interval, tick)
+    call_later(interval, tick)
+
+
+def toggle_cprofile():
+    # Starts cProfile or, when running, stops it and saves the run.
+    global _profiler, _runs
+    if _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+        _write('== cProfile started pid {0}\n'.format(os.getpid()))
+        return
+    _profiler.disable()
+    profiler, _profiler = _profiler, None
+    _runs += 1
+    stats = pstats.Stats(profiler)
+    if _path is not None:
+        stats.dump_stats('{0}.{1}.pstats'.format(_path, _runs))
+    _write('== cProfile run {0} stopped pid {1}\n'.format(_runs, os.getpid()))
+    stream = sys.stderr if _path is None else open(_path, 'a')
+    try:
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    finally:
+        if stream is not sys.stderr:
+            stream.close()
+
+
+def install_signal_handler(signum=getattr(signal, 'SIGUSR2', None)):
+    if signum is not None:
+        signal.signal(signum, lambda signum, frame: toggle_cprofile())
@@ -0,0 +1,230 @@
+import argparse
+import collections
+import json
+import socket
+import sys
+import threading
+import time
+import rtsp
+import wfd_capture
+
+
+# Headers whose values legitimately differ between runs.
+VOLATILE_HEADERS = ('Session', 'Date')
+MAX_EXAMPLES = 20
+
+
+def parse_frame(frame):
+    for message in rtsp.RtspParser().feed(frame):
+        return message
+    raise Exception('Truncated message in capture')
+
+
+def describe(message):
+    if isinstance(message, rtsp.RtspRequest):
+        return '{0} CSeq {1}'.format(message.method, message.headers.get('CSeq'))
+    return '{0} CSeq {1}'.format(message.status, message.headers.get('CSeq'))
+
+
+def session_id(message):
+    value = message.headers.get('Session')
+    return value.split(';')[0].strip() if value else None
+
+
+class ReplayStats(object):
+
+    def __init__(self):
+        self.sessions = 0
+        self.failures = 0
+        self.sent = 0
+        self.received = 0
+        self.divergences = collections.Counter()
+        self.examples = []
+        self.errors = collections.Counter()
+        self.lock = threading.Lock()
+
+    def diverged(self, session, kind, expected, actual):
+        with self.lock:
+            self.divergences[kind] += 1
+            if len(self.examples) < MAX_EXAMPLES:
+                self.examples.append({'session': session, 'kind': kind,
+                                      'expected': expected, 'actual': actual})
+
+    def finished(self, sent, received, error=None):
+        with self.lock:
+            self.sessions += 1
+            self.sent += sent
+            self.received += received
+            if error is not None:
+                self.failures += 1
+                self.errors[str(error)] += 1
+
+    def summary(self, duration):
+        return {
+            'sessions': self.sessions,
+            'failures': self.failures,
+            'errors': dict(self.errors),
+            'messages_sent': self.sent,
+            'messages_received': self.received,
+            'divergences': dict(self.divergences),
+            'divergence_examples': self.examples,
+            'duration': duration,
+            'messages_per_second': (self.sent + self.received) / duration if duration else 0.0,
+        }
+
+
+class Replayer(object):
+    # Plays the sink side of one captured session: RECEIVED records are
+    # sent as recorded, SENT records are awaited and compared.
+
+    def __init__(self, session, address, port, realtime, timeout, stats):
+        self.session = session
+        self.name = '{0}#{1}'.format(session.name, session.key[1:])
+        self.address = address
+        self.port = port
+        self.realtime = realtime
+        self.timeout = timeout
+        self.stats = stats
+        self.socket = None
+        self.parser = rtsp.RtspParser()
+        self.messages = collections.deque()
+        self.session_ids = {}
+        self.skipped = set()
+        self.sent = 0
+        self.received = 0
+
+    def run(self):
+        error = None
+        try:
+            self.socket = socket.create_connection((self.address, self.port),
+                                                   self.timeout)
+            started = time.monotonic()
+            for offset, kind, frame in self.session.records:
+                if kind == wfd_capture.RECEIVED:
+                    if self.realtime:
+                        time.sleep(max(0.0, started + offset - time.monotonic()))
+                    self._send(frame)
+                elif kind == wfd_capture.SENT:
+                    self._expect(parse_frame(frame))
+        except Exception as e:
+            error = e
+        finally:
+            if self.socket is not None:
+                self.socket.close()
+        self.stats.finished(self.sent, self.received, error)
+
+    def _send(self, frame):
+        message = parse_frame(frame)
+        if isinstance(message, rtsp.RtspResponse) and message.cseq in self.skipped:
+            return
+        for recorded, live in self.session_ids.items():
+            frame = frame.replace(recorded.encode('ascii'), live.encode('ascii'))
+        self.socket.sendall(frame)
+        self.sent += 1
+
+    def _expect(self, expected):
+        while True:
+            try:
+                actual = self._next_message()
+            except socket.timeout:
+                self.stats.diverged(self.name, 'missing', describe(expected), None)
+                if isinstance(expected, rtsp.RtspRequest):
+                    self.skipped.add(expected.cseq)
+                    return
+                raise Exception('Timed out waiting for {0}'.format(describe(expected)))
+            if (isinstance(actual, rtsp.RtspRequest) and
+                    not (isinstance(expected, rtsp.RtspRequest) and
+                         actual.method == expected.method)):
+                # An extra request from the server, a keepalive most likely.
+                self.stats.diverged(self.name, 'unexpected', describe(expected),
+                                    describe(actual))
+                self.socket.sendall(rtsp.RtspResponse().to_bytes(
+                    CSeq=actual.headers.get('CSeq')))
+                continue
+            self._compare(expected, actual)
+            return
+
+    def _compare(self, expected, actual):
+        if type(expected) is not type(actual):
+            kind = 'type'
+        elif isinstance(expected, rtsp.RtspResponse) and expected.status != actual.status:
+            kind = 'status'
+        elif self._headers(expected) != self._headers(actual):
+            kind = 'headers'
+        elif expected.content != actual.content:
+            kind = 'content'
+        else:
+            kind = None
+        if kind is not None:
+            self.stats.diverged(self.name, kind, str(expected), str(actual))
+
+        recorded, live = session_id(expected), session_id(actual)
+        if recorded and live and recorded != live:
+            self.session_ids.setdefault(recorded, live)
+
+    def _headers(self, message):
+        headers = {name: value for name, value in message.headers.items()
+                   if name not in VOLATILE_HEADERS}
+        if 'Transport' in headers:
+            # server_port is whatever RTP/RTCP pair the source bound.
+            headers['Transport'] = ';'.join(
+                param for param in headers['Transport'].split(';')
+                if not param.startswith('server_port='))
+        return headers
+
+    def _next_message(self):
+        while not self.messages:
+            data = self.socket.recv(4096)
+            if not data:
+                raise Exception('Connection closed by peer')
+            self.messages.extend(self.parser.feed(data))
+        self.received += 1
+        return self.messages.popleft()
+
+
+def run(captures, address, port, copies, realtime, timeout, session_filter=None):
+    sessions = []
+    for path in captures:
+        sessions.extend(wfd_capture.read_sessions(path))
+    if session_filter is not None:
+        sessions = [session for session in sessions
+                    if session_filter in session.name]
+    stats = ReplayStats()
+
+    started = time.monotonic()
+    threads = []
+    for copy in range(copies):
+        for session in sessions:
+            replayer = Replayer(session, address, port, realtime, timeout, stats)
+            thread = threading.Thread(target=replayer.run)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return stats.summary(time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured WFD sinks against a server')
+    parser.add_argument('captures', nargs='+', metavar='CAPTURE')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=rtsp.DEFAULT_SERVER_PORT)
+    parser.add_argument('--copies', type=int, default=1,
+                        help='parallel replays of every captured session')
+    parser.add_argument('--mode', choices=('realtime', 'asap'), default='asap',
+                        help='keep the recorded pacing or send as soon as possible')
+    parser.add_argument('--session', metavar='PEER',
+                        help='only replay sessions whose peer name contains PEER')
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='seconds to wait for each recorded server message')
+    args = parser.parse_args()
+
+    summary = run(args.captures, args.address, args.port, args.copies,
+                  args.mode == 'realtime', args.timeout, args.session)
+    json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
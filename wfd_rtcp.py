@@ -0,0 +1,278 @@
+import socket
+import struct
+import time
+import wfd_metrics
+
+
+# RTCP (RFC 3550, 6.4). The source sends sender reports so that the sink's
+# receiver reports can echo them, which yields the round trip time.
+RTCP_VERSION = 0x80
+RTCP_SR = 200
+RTCP_RR = 201
+RTP_CLOCK_RATE = 90000
+NTP_EPOCH_OFFSET = 2208988800
+
+HEADER = struct.Struct('!BBH')
+SSRC = struct.Struct('!I')
+SENDER_INFO = struct.Struct('!IIIII')
+REPORT_BLOCK = struct.Struct('!IIIIII')
+
+DEFAULT_INTERVAL = 1.0
+
+
+class ReportBlock(object):
+    __slots__ = ('ssrc', 'fraction_lost', 'cumulative_lost', 'highest_sequence',
+                 'jitter', 'last_sr', 'delay_since_last_sr')
+
+    def __init__(self, ssrc, fraction_lost, cumulative_lost, highest_sequence,
+                 jitter, last_sr, delay_since_last_sr):
+        self.ssrc = ssrc
+        self.fraction_lost = fraction_lost
+        self.cumulative_lost = cumulative_lost
+        self.highest_sequence = highest_sequence
+        self.jitter = jitter
+        self.last_sr = last_sr
+        self.delay_since_last_sr = delay_since_last_sr
+
+
+def ntp_time(wallclock):
+    seconds = wallclock + NTP_EPOCH_OFFSET
+    return int(seconds) & 0xFFFFFFFF, int((seconds % 1.0) * (1 << 32))
+
+
+def ntp_middle(wallclock):
+    # The middle 32 bits of the NTP timestamp, as echoed in last_sr.
+    msw, lsw = ntp_time(wallclock)
+    return ((msw & 0xFFFF) << 16) | (lsw >> 16)
+
+
+def build_sender_report(ssrc, wallclock, rtp_timestamp, packets, octets):
+    msw, lsw = ntp_time(wallclock)
+    return (HEADER.pack(RTCP_VERSION, RTCP_SR, 6) + SSRC.pack(ssrc) +
+            SENDER_INFO.pack(msw, lsw, rtp_timestamp & 0xFFFFFFFF,
+                             packets & 0xFFFFFFFF, octets & 0xFFFFFFFF))
+
+
+def build_receiver_report(ssrc, blocks):
+    data = [HEADER.pack(RTCP_VERSION | len(blocks), RTCP_RR,
+                        1 + len(blocks) * REPORT_BLOCK.size // 4),
+            SSRC.pack(ssrc)]
+    for block in blocks:
+        data.append(REPORT_BLOCK.pack(
+            block.ssrc,
+            (int(block.fraction_lost * 256) & 0xFF) << 24 |
+            (block.cumulative_lost & 0xFFFFFF),
+            block.highest_sequence, block.jitter, block.last_sr,
+            block.delay_since_last_sr))
+    return b''.join(data)
+
+
+def parse_report_blocks(data):
+    # Returns the report blocks of every SR and RR in a compound packet;
+    # other packet types are skipped. fraction_lost is 0.0 to 1.0.
+    blocks = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        flags, packet_type, length = HEADER.unpack_from(data, offset)
+        end = offset + 4 * (length + 1)
+        if flags & 0xC0 != RTCP_VERSION or end > len(data):
+            raise ValueError('Malformed RTCP packet')
+        position = offset + HEADER.size + SSRC.size
+        if packet_type == RTCP_SR:
+            position += SENDER_INFO.size
+        if packet_type in (RTCP_SR, RTCP_RR):
+            for _ in range(flags & 0x1F):
+                if position + REPORT_BLOCK.size > end:
+                    raise ValueError('Truncated RTCP report block')
+                ssrc, lost, highest, jitter, last_sr, delay = \
+                    REPORT_BLOCK.unpack_from(data, position)
+                cumulative = lost & 0xFFFFFF
+                if cumulative & 0x800000:
+                    cumulative -= 0x1000000
+                blocks.append(ReportBlock(ssrc, (lost >> 24) / 256.0,
+                                          cumulative, highest, jitter,
+                                          last_sr, delay))
+                position += REPORT_BLOCK.size
+        offset = end
+    return blocks
+
+
+class RtcpStats(object):
+    # What the sink last reported about one RTP stream.
+
+    def __init__(self):
+        self.reports = 0
+        self.fraction_lost = 0.0
+        self.cumulative_lost = 0
+        self.jitter = 0.0
+        self.rtt = None
+        self.last_report = None
+
+    def update(self, block, wallclock):
+        self.reports += 1
+        self.fraction_lost = block.fraction_lost
+        self.cumulative_lost = block.cumulative_lost
+        self.jitter = block.jitter / float(RTP_CLOCK_RATE)
+        self.last_report = wallclock
+        if block.last_sr:
+            delay = (ntp_middle(wallclock) - block.last_sr -
+                     block.delay_since_last_sr) & 0xFFFFFFFF
+            self.rtt = delay / 65536.0
+        wfd_metrics.RTCP_REPORTS.inc()
+        wfd_metrics.RTCP_FRACTION_LOST.observe(self.fraction_lost)
+        if self.rtt is not None:
+            wfd_metrics.RTCP_RTT_SECONDS.observe(self.rtt)
+
+    def report(self):
+        return {
+            'rtcp_reports': self.reports,
+            'fraction_lost': self.fraction_lost,
+            'cumulative_lost': self.cumulative_lost,
+            'rtcp_jitter_ms': 1000.0 * self.jitter,
+            'rtt_ms': None if self.rtt is None else 1000.0 * self.rtt,
+        }
+
+
+class RateController(object):
+    # Decides which share of a stream's packets goes out, from the receiver
+    # reports. The sender reads rate before every batch; lower_mode asks the
+    # session for a lower video mode. This one never throttles.
+
+    def __init__(self):
+        self.rate = 1.0
+        self.lower_mode = False
+
+    def update(self, stats):
+        pass
+
+
+class LossRateController(RateController):
+    # Multiplicative decrease on heavy loss, additive increase once the link
+    # is clean; asks for a lower video mode while pinned at the floor.
+
+    def __init__(self, high_loss=0.10, low_loss=0.02, decrease=0.75,
+                 increase=0.05, floor=0.25):
+        super(LossRateController, self).__init__()
+        self.high_loss = high_loss
+        self.low_loss = low_loss
+        self.decrease = decrease
+        self.increase = increase
+        self.floor = floor
+
+    def update(self, stats):
+        if stats.fraction_lost > self.high_loss:
+            self.lower_mode = self.rate <= self.floor
+            self.rate = max(self.floor, self.rate * self.decrease)
+        elif stats.fraction_lost < self.low_loss:
+            self.lower_mode = False
+            self.rate = min(1.0, self.rate + self.increase)
+
+
+def bind_pair(host=''):
+    # An even RTP port and the RTCP port right above it, both non-blocking.
+    for _ in range(64):
+        rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rtp.setblocking(False)
+        rtp.bind((host, 0))
+        port = rtp.getsockname()[1]
+        if port % 2 == 0 and port < 65535:
+            rtcp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            rtcp.setblocking(False)
+            try:
+                rtcp.bind((host, port + 1))
+                return rtp, rtcp
+            except OSError:
+                rtcp.close()
+        rtp.close()
+    raise Exception('No free RTP/RTCP port pair')
+
+
+class RtcpSession(object):
+    # RTCP for one RTP stream. The sender's pump calls poll() to send a
+    # sender report every interval. Receiver reports are read as they
+    # arrive when readers, anything with asyncio's add_reader() and
+    # remove_reader(), is given, and otherwise drained by poll().
+    # Reports count only if they come from the sink's host, are about this
+    # stream's SSRC and are sent by the SSRC that reported first.
+
+    def __init__(self, sock, address, ssrc, controller=None,
+                 interval=DEFAULT_INTERVAL, wallclock=time.time,
+                 readers=None):
+        sock.setblocking(False)
+        self.socket = sock
+        self.address = address
+        self.ssrc = ssrc
+        self.controller = controller
+        self.interval = interval
+        self.wallclock = wallclock
+        self.readers = readers
+        self.stats = RtcpStats()
+        self.next_report = 0.0
+        self.sink_ssrc = None
+        self.bad_packets = 0
+        self.foreign_packets = 0
+        # Called without arguments when the controller starts asking for a
+        # lower video mode.
+        self.on_lower_mode = None
+        if readers is not None:
+            readers.add_reader(sock, self.receive)
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def poll(self, now, rtp_timestamp, packets, octets):
+        if self.readers is None:
+            self.receive()
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            try:
+                self.socket.sendto(build_sender_report(
+                    self.ssrc, self.wallclock(), rtp_timestamp, packets,
+                    octets), self.address)
+            except (BlockingIOError, ConnectionRefusedError):
+                pass
+
+    def receive(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+            if address[0] != self.address[0]:
+                self.foreign_packets += 1
+                continue
+            try:
+                blocks = [block for block in parse_report_blocks(data)
+                          if block.ssrc == self.ssrc]
+            except (ValueError, struct.error):
+                self.bad_packets += 1
+                continue
+            if not blocks:
+                continue
+            # A compound packet starts with the reporter's SR or RR.
+            reporter = SSRC.unpack_from(data, HEADER.size)[0]
+            if self.sink_ssrc is None:
+                self.sink_ssrc = reporter
+            elif reporter != self.sink_ssrc:
+                self.foreign_packets += 1
+                continue
+            for block in blocks:
+                self._update(block)
+
+    def _update(self, block):
+        self.stats.update(block, self.wallclock())
+        if self.controller is None:
+            return
+        lower_mode = self.controller.lower_mode
+        self.controller.update(self.stats)
+        if (self.controller.lower_mode and not lower_mode and
+                self.on_lower_mode is not None):
+            self.on_lower_mode()
+
+    def close(self):
+        if self.readers is not None:
+            self.readers.remove_reader(self.socket)
+        self.socket.close()
@@ -1,121 +1,136 @@
-import socket
-import sys
+import argparse
+import wfd_capcache
+import wfd_capture
+import wfd_core
+import wfd_loop
+import wfd_media
+import wfd_metrics
+import wfd_options
+import wfd_profile
+import wfd_rtcp
+import wfd_session
+import wfd_trace
+import wfd_uibc
 from rtsp import *
 
 
-class WfdServer:
-    OPTIONS_RESPONSE_PUBLIC = "org.wfa.wfd1.0, GET_PARAMETER, SET_PARAMETER"
-    OPTIONS_REQUEST_REQUIRE = "org.wfa.wfd1.0"
-    GET_PARAMETER = (
-        "wfd_video_formats\r\n"
-        "wfd_audio_codecs\r\n"
-        "wfd_client_rtp_ports\r\n"
-        "wfd_content_protection\r\n"
-        "wfd_uibc_capability\r\n")
-    SET_PARAMETER = (
-        "wfd_video_formats: "
-        "00 00 01 01 00000020 00000000 00000000 00 0000 0000 00 none none\r\n"
-        "wfd_audio_codecs: LPCM 00000002 00\r\n"
-        "wfd_presentation_URL: rtsp://172.16.222.110/wfd1.0/streamid=0 none\r\n"
-        "wfd_client_rtp_ports: RTP/AVP/UDP;unicast {0} 0 mode=play\r\n")
-    TRIGGER_SETUP = "wfd_trigger_method: SETUP\r\n"
-    TRIGGER_PLAY = "wfd_trigger_method: PLAY\r\n"
-    TRIGGER_PAUSE = "wfd_trigger_method: PAUSE\r\n"
-    TRIGGER_TEARDOWN = "wfd_trigger_method: TEARDOWN\r\n"
-    URL = "rtsp://localhost/wfd1.0"
+class WfdServer(wfd_core.SourceCore):
+    WRITE_TIMEOUT = 10
 
     def __init__(self):
-        self.sink_rtp_port = 1028
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        super(WfdServer, self).__init__()
+        self.uibc = wfd_uibc.UibcDispatcher()
+        # The --media file and how to stream it; serve_port() opens the
+        # source on its loop.
+        self.ts_file = None
+        self.broadcast = False
+        self.rate_controller = None
 
     def serve_port(self, port):
-        self.socket.bind(('', port))
+        # Every sink gets its own WfdServer session; this one only listens
+        # and holds the shared settings.
+        loop = wfd_loop.EventLoop()
+        wfd_profile.schedule_reports(loop.call_later)
+        if self.ts_file is not None:
+            self.media = wfd_media.open_source(
+                self.ts_file, loop.call_later, self.broadcast,
+                self.rate_controller, loop)
+        self.sessions = wfd_session.SessionManager(self.session_timeout)
+
+        def tick():
+            self.sessions.tick()
+            loop.call_later(self.sessions.wheel.tick, tick)
+        loop.call_later(self.sessions.wheel.tick, tick)
+        self.socket = wfd_loop.listen(
+            loop, port, lambda client_socket, address:
+                self._serve_client(loop, client_socket, address, port))
         print("Listening on port {0}.".format(port))
-        self.socket.listen(1)
-
-        while True:
-            print("Waiting for a client...")
-            client_socket, address = self.socket.accept()
-            print("Serving client {0} on port {1}.".format(address, port))
-            try:
-                self._serve_endpoint(RtspEndpoint(client_socket, self))
-            except Exception as e:
-                print("ERROR: {0}".format(e))
-                client_socket.close()
+        if self.uibc_port is not None:
+            wfd_uibc.listen(loop, self.uibc_port, self.uibc)
+            print("UIBC on port {0}.".format(self.uibc_port))
+        loop.run()
+
+    def _serve_client(self, loop, client_socket, address, port):
+        print("Serving client {0} on port {1}.".format(address, port))
+        session = WfdServer()
+        session.session_timeout = self.session_timeout
+        session.media = self.media
+        session.uibc_port = self.uibc_port
+        session.pipeline = self.pipeline
+        session.capabilities = self.capabilities
+        session.peer = address[0]
+        session.metrics = wfd_metrics.SessionMetrics()
+        session.trace = wfd_trace.session_trace(address)
+        session.capture = wfd_capture.session_capture(address)
+        session.profile = wfd_profile.session_profile(address)
+        # No read deadline: the session manager expires idle sinks and keeps
+        # playing ones alive with M16 keepalives.
+        connection = wfd_loop.CoreConnection(
+            loop, client_socket, session, None, self.WRITE_TIMEOUT,
+            lambda: self.sessions.touch(session.session_id))
+
+        def keepalive(session_id):
+            connection.drive(session.send_keepalive, session_id)
+
+        def expire(session_id):
+            connection.close(RtspTimeout(
+                "Session {0} timed out".format(session_id)))
+
+        session.session_id = self.sessions.open(keepalive, expire)
+
+        def finished(session, error):
+            self.sessions.close(session.session_id)
+            session.stream_stop()
+            session.metrics.close()
+            if error is not None:
+                print("ERROR: {0}".format(error))
+                session.trace.dump()
             print("{0} disconnected.".format(address))
 
-    def process_request(self, request):
-        if request.method == "OPTIONS":
-            return RtspResponse(headers={"Public": self.OPTIONS_RESPONSE_PUBLIC})
-        elif request.method == "SETUP":
-            return self._process_transport(request.headers["Transport"])
-        elif request.method == "PLAY":
-            return self._process_play()
-        elif request.method == "PAUSE":
-            return self._process_pause()
-        elif request.method == "TEARDOWN":
-            return self._process_teardown()
-        raise Exception("Unexpected request!")
-
-    def process_response(self, response, method):
-        if response.status != 200:
-            raise Exception("Reponse has error code {0}".format(response.status))
-
-    def _serve_endpoint(self, endpoint):
-        self.disconnecting = False
-
-        endpoint.send_request(RtspRequest(
-            "OPTIONS",
-            headers={"Require": self.OPTIONS_REQUEST_REQUIRE}))
-        endpoint.wait_for_request()
-        endpoint.send_request(RtspRequest(
-            "GET_PARAMETER",
-            url=self.URL,
-            content=RtspContent("text/parameters",
-                                self.GET_PARAMETER)))
-        endpoint.send_request(RtspRequest(
-            "SET_PARAMETER",
-            url=self.URL,
-            content=RtspContent("text/parameters",
-                                self.SET_PARAMETER.format(self.sink_rtp_port))))
-        endpoint.send_request(RtspRequest(
-            "SET_PARAMETER",
-            url=self.URL,
-            content=RtspContent("text/parameters",
-                                self.TRIGGER_SETUP)))
-        endpoint.wait_for_request()
-
-        while not self.disconnecting:
-            endpoint.wait_for_request()
-
-        endpoint.teardown()
-
-    def _process_transport(self, transport):
-        params = transport.split(";")
-        for param in params:
-            if "client_port=" in param:
-                return RtspResponse(headers={"Session": "01234567;timeout=30",
-                                             "Transport": transport})
-        raise Exception("Bad transport!")
-
-    def _process_play(self):
-        return RtspResponse()
-
-    def _process_pause(self):
-        return RtspResponse()
-
-    def _process_teardown(self):
-        self.disconnecting = True
-        return RtspResponse()
+        connection.start(finished)
+
+    def log(self, message):
+        print(message)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="WFD test server")
+    wfd_options.add_server_arguments(parser)
+    args = parser.parse_args()
+
     print("WFD test server v0.1")
     server = WfdServer()
-    rtsp_port = int(sys.argv[1]) if len(sys.argv) == 2 else 7236
+    rtsp_port = args.port
     print('RTSP server port ' + str(rtsp_port))
-    server.serve_port(rtsp_port)
+    if args.metrics_port:
+        wfd_metrics.serve_metrics(args.metrics_port)
+    if args.trace:
+        wfd_trace.enable(args.trace)
+        wfd_trace.install_signal_handler()
+    if args.capture:
+        wfd_capture.enable(args.capture)
+    if args.profile:
+        wfd_profile.enable(args.profile, args.profile_interval)
+        wfd_profile.install_signal_handler()
+    if args.media:
+        server.ts_file = wfd_media.TsFile(args.media)
+        server.broadcast = args.broadcast
+        if args.rate_control:
+            server.rate_controller = wfd_rtcp.LossRateController
+    server.session_timeout = args.session_timeout
+    server.pipeline = args.pipeline
+    server.uibc_port = args.uibc_port
+    if args.capability_cache:
+        server.capabilities = wfd_capcache.CapabilityCache(
+            args.capability_cache, args.capability_ttl, args.capability_file)
+        print("{0} cached sinks loaded.".format(server.capabilities.load()))
+    try:
+        server.serve_port(rtsp_port)
+    finally:
+        if server.capabilities is not None:
+            server.capabilities.save()
+            print("Capability cache: {0}".format(
+                wfd_capcache.format_report(server.capabilities.report())))
 
 
 if __name__ == "__main__":
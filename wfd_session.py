@@ -0,0 +1,139 @@
+import itertools
+import random
+import time
+
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_TICK = 0.5
+
+_session_ids = itertools.count(random.randrange(1 << 31))
+
+
+def new_session_id():
+    return '{0:08X}'.format(next(_session_ids) & 0xFFFFFFFF)
+
+
+class Timer(object):
+    __slots__ = ('rounds', 'callback', 'slot')
+
+    def __init__(self, rounds, callback, slot):
+        self.rounds = rounds
+        self.callback = callback
+        self.slot = slot
+
+
+class TimerWheel(object):
+    # Hashed timing wheel: schedule and cancel are O(1), and a tick only
+    # visits the timers hashed into the current slot.
+
+    def __init__(self, tick=DEFAULT_TICK, slots=512, now=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.time = time.monotonic() if now is None else now
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, delay, callback):
+        # The slot is next visited ticks % len(slots) ticks from now, or a
+        # full revolution from now when that is 0; rounds counts the visits
+        # to skip after it.
+        ticks = max(1, int(round(delay / self.tick)))
+        rounds = (ticks - 1) // len(self.slots)
+        slot = self.slots[(self.position + ticks) % len(self.slots)]
+        timer = Timer(rounds, callback, slot)
+        slot.add(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+
+    def advance(self, now):
+        expired = []
+        while self.time + self.tick <= now:
+            self.time += self.tick
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            for timer in list(slot):
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    slot.discard(timer)
+                    timer.slot = None
+                    expired.append(timer.callback)
+        for callback in expired:
+            callback()
+        return len(expired)
+
+
+class Session(object):
+    __slots__ = ('id', 'keepalive', 'expire', 'last_activity',
+                 'keepalive_timer', 'timeout_timer')
+
+    def __init__(self, id, keepalive, expire, now):
+        self.id = id
+        self.keepalive = keepalive
+        self.expire = expire
+        self.last_activity = now
+        self.keepalive_timer = None
+        self.timeout_timer = None
+
+
+class SessionManager(object):
+    # Activity only stamps last_activity; an expiring timeout timer checks
+    # the stamp and re-arms itself for the remainder, so traffic never
+    # touches the wheel.
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, keepalive_interval=None,
+                 tick=DEFAULT_TICK, clock=time.monotonic):
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval or timeout / 2.0
+        self.clock = clock
+        self.wheel = TimerWheel(tick, now=clock())
+        self.sessions = {}
+
+    def open(self, keepalive, expire):
+        session = Session(new_session_id(), keepalive, expire, self.clock())
+        self.sessions[session.id] = session
+        self._arm_keepalive(session)
+        self._arm_timeout(session, self.timeout)
+        return session.id
+
+    def touch(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.last_activity = self.clock()
+
+    def close(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.wheel.cancel(session.keepalive_timer)
+            self.wheel.cancel(session.timeout_timer)
+
+    def tick(self):
+        return self.wheel.advance(self.clock())
+
+    def _arm_keepalive(self, session):
+        def fire():
+            if session.id not in self.sessions:
+                return
+            self._arm_keepalive(session)
+            if self.clock() - session.last_activity < self.timeout:
+                session.keepalive(session.id)
+        session.keepalive_timer = self.wheel.schedule(
+            self.keepalive_interval, fire)
+
+    def _arm_timeout(self, session, delay):
+        def fire():
+            if session.id not in self.sessions:
+                return
+            idle = self.clock() - session.last_activity
+            if idle < self.timeout:
+                self._arm_timeout(session, self.timeout - idle)
+            else:
+                self.close(session.id)
+                session.expire(session.id)
+        session.timeout_timer = self.wheel.schedule(delay, fire)
@@ -0,0 +1,234 @@
+import argparse
+import collections
+import json
+import sys
+import time
+import wfd_capcache
+import wfd_core
+
+
+# Runs source and sink sessions against each other in memory: no sockets,
+# no event loop, so what is measured is the protocol cost alone. Time is
+# virtual; think time and request timeouts never pass.
+
+
+class SimClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SimPair(object):
+    # One source and one sink wired back to back. step() moves whatever
+    # either side has to send to the other, chunk bytes at a time if set.
+
+    def __init__(self, clock, cycles=1, pipeline=False, chunk=0, rtp_port=1028,
+                 capabilities=None):
+        self.source = wfd_core.SourceCore(clock)
+        self.source.pipeline = pipeline
+        self.source.capabilities = capabilities
+        self.source.peer = 'sim'
+        self.sink = wfd_core.SinkCore(rtp_port,
+                                      wfd_core.sink_script(cycles), clock)
+        self.chunk = chunk
+        self.bytes = 0
+
+    def start(self):
+        self.source.connection_made()
+        self.sink.connection_made()
+
+    def step(self):
+        moved = self._deliver(self.source, self.sink)
+        moved += self._deliver(self.sink, self.source)
+        if self.sink.delay is not None:
+            self.sink.resume()
+            moved += 1
+        return moved
+
+    @property
+    def done(self):
+        return self.source.closing and self.sink.closing
+
+    @property
+    def requests(self):
+        return self.source.cseq + self.sink.cseq
+
+    def close(self):
+        # Hands over output left when either side closed.
+        self.step()
+        self.source.close()
+        self.sink.close()
+
+    def _deliver(self, sender, receiver):
+        data = sender.data_to_send()
+        if not data:
+            return 0
+        self.bytes += len(data)
+        if self.chunk:
+            for offset in range(0, len(data), self.chunk):
+                receiver.receive_data(data[offset:offset + self.chunk])
+        else:
+            receiver.receive_data(data)
+        return len(data)
+
+
+def expected_requests(cycles):
+    # Source: M1, M3, M4 and the SETUP trigger. Sink: M2, SETUP, a PLAY
+    # and a PAUSE per cycle and TEARDOWN.
+    return 4 + 3 + 2 * cycles
+
+
+def check(pair, cycles):
+    # Returns why the finished pair does not conform, None if it does.
+    source, sink = pair.source, pair.sink
+    if source.state != wfd_core.CLOSED or sink.state != wfd_core.CLOSED:
+        return 'final state {0}/{1}'.format(source.state, sink.state)
+    if source.pending or sink.pending:
+        return 'unanswered requests'
+    if pair.requests != expected_requests(cycles):
+        return '{0} requests, expected {1}'.format(pair.requests,
+                                                  expected_requests(cycles))
+    if source.sink_rtp_port != sink.rtp_port:
+        return 'RTP port {0}, expected {1}'.format(source.sink_rtp_port,
+                                                   sink.rtp_port)
+    return None
+
+
+def simulate_session(cycles=1, pipeline=False, chunk=0):
+    # One complete session, start to TEARDOWN; for benchmarks.
+    pair = SimPair(SimClock(), cycles, pipeline, chunk)
+    pair.start()
+    while not pair.done:
+        if not pair.step():
+            raise Exception('Stalled at {0}/{1}'.format(pair.source.state,
+                                                        pair.sink.state))
+    pair.close()
+    return pair
+
+
+class SimStats(object):
+
+    def __init__(self):
+        self.sessions = 0
+        self.failures = 0
+        self.errors = collections.Counter()
+        self.nonconformant = collections.Counter()
+        self.final_states = collections.Counter()
+        self.requests = 0
+        self.bytes = 0
+
+    def finished(self, pair, cycles, error=None):
+        self.sessions += 1
+        self.requests += pair.requests
+        self.bytes += pair.bytes
+        self.final_states['{0}/{1}'.format(pair.source.state,
+                                           pair.sink.state)] += 1
+        if error is None:
+            error = check(pair, cycles)
+            if error is not None:
+                self.nonconformant[error] += 1
+        else:
+            self.errors[str(error)] += 1
+        if error is not None:
+            self.failures += 1
+
+    def summary(self, duration, cpu):
+        # Every request is answered, so messages are twice the requests.
+        return {
+            'sessions': self.sessions,
+            'failures': self.failures,
+            'errors': dict(self.errors),
+            'nonconformant': dict(self.nonconformant),
+            'final_states': dict(self.final_states),
+            'messages': 2 * self.requests,
+            'bytes': self.bytes,
+            'duration': duration,
+            'cpu_seconds': cpu,
+            'sessions_per_second': self.sessions / duration if duration else 0.0,
+            'cpu_us_per_session': 1e6 * cpu / self.sessions if self.sessions else 0.0,
+            'cpu_us_per_message': 1e6 * cpu / (2 * self.requests) if self.requests else 0.0,
+        }
+
+
+def run(sessions, concurrency=1000, cycles=1, pipeline=False, chunk=0,
+        sinks=30000, capabilities=None):
+    # Keeps up to concurrency pairs interleaved, one step each per round,
+    # so every session's state is live at once as in a busy source. Sinks
+    # differ by RTP port; with more sessions than sinks they reconnect.
+    clock = SimClock()
+    stats = SimStats()
+    active = []
+    started = 0
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    while started < sessions or active:
+        while started < sessions and len(active) < concurrency:
+            pair = SimPair(clock, cycles, pipeline, chunk,
+                           1028 + 2 * (started % sinks), capabilities)
+            started += 1
+            try:
+                pair.start()
+            except Exception as e:
+                stats.finished(pair, cycles, e)
+                continue
+            active.append(pair)
+
+        running = []
+        for pair in active:
+            try:
+                moved = pair.step()
+            except Exception as e:
+                stats.finished(pair, cycles, e)
+                continue
+            if pair.done:
+                pair.close()
+                stats.finished(pair, cycles)
+            elif not moved:
+                stats.finished(pair, cycles, 'Stalled at {0}/{1}'.format(
+                    pair.source.state, pair.sink.state))
+            else:
+                running.append(pair)
+        active = running
+
+    summary = stats.summary(time.perf_counter() - wall,
+                            time.process_time() - cpu)
+    if capabilities is not None:
+        summary['capability_cache'] = capabilities.report()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='in-memory WFD session simulator')
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--concurrency', type=int, default=1000,
+                        help='sessions in flight at once')
+    parser.add_argument('--cycles', type=int, default=1,
+                        help='PLAY/PAUSE cycles per session')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='trigger SETUP without waiting for the M4 response')
+    parser.add_argument('--chunk', type=int, default=0, metavar='BYTES',
+                        help='deliver data BYTES at a time to exercise framing')
+    parser.add_argument('--sinks', type=int, default=30000,
+                        help='distinct sinks, reconnecting once all are used')
+    parser.add_argument('--capability-cache', type=int, metavar='SINKS',
+                        nargs='?', const=wfd_capcache.DEFAULT_SIZE,
+                        help='cache the capabilities of SINKS sinks')
+    args = parser.parse_args()
+
+    capabilities = None
+    if args.capability_cache:
+        capabilities = wfd_capcache.CapabilityCache(args.capability_cache)
+    summary = run(args.sessions, args.concurrency, args.cycles,
+                  args.pipeline, args.chunk, args.sinks, capabilities)
+    json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if summary['failures']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
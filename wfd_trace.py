@@ -0,0 +1,69 @@
+import collections
+import signal
+import sys
+import time
+import weakref
+
+
+DEFAULT_RING_SIZE = 256
+
+enabled = False
+ring_size = DEFAULT_RING_SIZE
+_sessions = weakref.WeakSet()
+
+
+class NullTrace(object):
+    enabled = False
+
+    def event(self, kind, data=None):
+        pass
+
+    def dump(self, file=None):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class SessionTrace(object):
+    enabled = True
+
+    def __init__(self, name, size=DEFAULT_RING_SIZE):
+        self.name = name
+        self.ring = collections.deque(maxlen=size)
+
+    def event(self, kind, data=None):
+        self.ring.append((time.monotonic(), kind, data))
+
+    def dump(self, file=None):
+        file = file or sys.stderr
+        for timestamp, kind, data in list(self.ring):
+            if isinstance(data, (bytes, bytearray)):
+                data = data.decode('ascii', 'replace')
+            file.write('{0:.6f}\t[{1}]\t{2}\t{3!r}\n'.format(
+                timestamp, self.name, kind, data))
+        file.flush()
+
+
+def enable(size=DEFAULT_RING_SIZE):
+    global enabled, ring_size
+    enabled = True
+    ring_size = size
+
+
+def session_trace(name):
+    if not enabled:
+        return NULL_TRACE
+    trace = SessionTrace(name, ring_size)
+    _sessions.add(trace)
+    return trace
+
+
+def dump_all(file=None):
+    for trace in list(_sessions):
+        trace.dump(file)
+
+
+def install_signal_handler(signum=getattr(signal, 'SIGUSR1', None)):
+    if signum is not None:
+        signal.signal(signum, lambda signum, frame: dump_all())
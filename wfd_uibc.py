@@ -0,0 +1,223 @@
+import collections
+import socket
+import struct
+import time
+import wfd_loop
+import wfd_metrics
+
+
+# User Input Back Channel, generic input category (WFD 1.0, 4.11). Every
+# packet is a header (version:3, timestamp flag:1, reserved:8, input
+# category:4, length:16), an optional 16-bit timestamp and one generic
+# input body: IE id, length and the type specific description.
+GENERIC = 0
+HIDC = 1
+VERSION_MASK = 0xE000
+TIMESTAMP_FLAG = 0x1000
+CATEGORY_MASK = 0x000F
+TIMESTAMP_RATE = 90000
+
+(TOUCH_DOWN, TOUCH_UP, TOUCH_MOVE, KEY_DOWN, KEY_UP, ZOOM, VERTICAL_SCROLL,
+ HORIZONTAL_SCROLL, ROTATE) = range(9)
+EVENT_NAMES = ('touch_down', 'touch_up', 'touch_move', 'key_down', 'key_up',
+               'zoom', 'vertical_scroll', 'horizontal_scroll', 'rotate')
+
+HEADER = struct.Struct('!HH')
+TIMESTAMP = struct.Struct('!H')
+GENERIC_HEADER = struct.Struct('!BH')
+POINTER = struct.Struct('!BHH')
+KEYS = struct.Struct('!xHH')
+ZOOM_BODY = struct.Struct('!HHBB')
+SCROLL_BODY = struct.Struct('!h')
+ROTATE_BODY = struct.Struct('!bB')
+
+# value is ((pointer id, x, y), ...) for touch events, (key code 1, key
+# code 2) for keys, (x, y, integer, fraction) for zoom, the signed amount
+# for scrolls and (integer, fraction) for rotation.
+InputEvent = collections.namedtuple('InputEvent', 'type value timestamp')
+
+
+class UibcError(Exception):
+    pass
+
+
+def timestamp(clock=time.monotonic):
+    # 16 bits of the 90 kHz media clock, wrapping every 0.73 s. Latency is
+    # only meaningful when both ends read the same clock.
+    return int(clock() * TIMESTAMP_RATE) & 0xFFFF
+
+
+def timestamp_age(stamp, clock=time.monotonic):
+    return ((timestamp(clock) - stamp) & 0xFFFF) / float(TIMESTAMP_RATE)
+
+
+def event_name(event_type):
+    if event_type < len(EVENT_NAMES):
+        return EVENT_NAMES[event_type]
+    return 'unknown'
+
+
+def encode_event(event):
+    kind = event.type
+    if kind <= TOUCH_MOVE:
+        body = bytes((len(event.value),)) + b''.join(
+            POINTER.pack(*pointer) for pointer in event.value)
+    elif kind <= KEY_UP:
+        body = KEYS.pack(*event.value)
+    elif kind == ZOOM:
+        body = ZOOM_BODY.pack(*event.value)
+    elif kind == ROTATE:
+        body = ROTATE_BODY.pack(*event.value)
+    else:
+        body = SCROLL_BODY.pack(event.value)
+    flags = GENERIC
+    stamp = b''
+    if event.timestamp is not None:
+        flags |= TIMESTAMP_FLAG
+        stamp = TIMESTAMP.pack(event.timestamp)
+    length = HEADER.size + len(stamp) + GENERIC_HEADER.size + len(body)
+    return (HEADER.pack(flags, length) + stamp +
+            GENERIC_HEADER.pack(kind, len(body)) + body)
+
+
+def encode_events(events):
+    return b''.join(encode_event(event) for event in events)
+
+
+def _decode_body(kind, data, offset, size):
+    if kind <= TOUCH_MOVE:
+        count = data[offset]
+        if 1 + count * POINTER.size > size:
+            raise UibcError('Truncated pointer list')
+        return tuple(POINTER.unpack_from(data, offset + 1 + i * POINTER.size)
+                     for i in range(count))
+    if kind <= KEY_UP:
+        return KEYS.unpack_from(data, offset)
+    if kind == ZOOM:
+        return ZOOM_BODY.unpack_from(data, offset)
+    if kind == ROTATE:
+        return ROTATE_BODY.unpack_from(data, offset)
+    if kind <= HORIZONTAL_SCROLL:
+        return SCROLL_BODY.unpack_from(data, offset)[0]
+    return bytes(data[offset:offset + size])
+
+
+def decode_events(data, offset=0):
+    # Decodes every complete packet from offset on and returns the events
+    # with the offset of the first incomplete packet. HIDC packets are
+    # skipped.
+    events = []
+    end = len(data)
+    while offset + HEADER.size <= end:
+        flags, length = HEADER.unpack_from(data, offset)
+        if flags & VERSION_MASK:
+            raise UibcError('Unsupported UIBC version {0}'.format(flags >> 13))
+        if length < HEADER.size + GENERIC_HEADER.size:
+            raise UibcError('Bad UIBC packet length {0}'.format(length))
+        if offset + length > end:
+            break
+        position = offset + HEADER.size
+        stamp = None
+        if flags & TIMESTAMP_FLAG:
+            stamp = TIMESTAMP.unpack_from(data, position)[0]
+            position += TIMESTAMP.size
+        if flags & CATEGORY_MASK == GENERIC:
+            kind, size = GENERIC_HEADER.unpack_from(data, position)
+            position += GENERIC_HEADER.size
+            if position + size > offset + length:
+                raise UibcError('Generic input body exceeds its packet')
+            try:
+                value = _decode_body(kind, data, position, size)
+            except struct.error:
+                raise UibcError('Truncated {0} event'.format(event_name(kind)))
+            events.append(InputEvent(kind, value, stamp))
+        offset += length
+    return events, offset
+
+
+class UibcDecoder(object):
+    # Buffers one channel's stream and decodes every complete packet per read.
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        if self.buffer:
+            data = self.buffer + data
+        events, consumed = decode_events(data)
+        self.buffer = bytes(data[consumed:])
+        return events
+
+
+class UibcDispatcher(object):
+    # Hands decoded events to subscribers, callback(event, peer), after
+    # recording how long each timestamped event took to arrive.
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def dispatch(self, events, peer):
+        for event in events:
+            name = event_name(event.type)
+            wfd_metrics.UIBC_EVENTS.inc(1, name)
+            if event.timestamp is not None:
+                wfd_metrics.UIBC_LATENCY_SECONDS.observe(
+                    timestamp_age(event.timestamp, self.clock), name)
+            for callback in self.subscribers:
+                callback(event, peer)
+
+
+def set_nodelay(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class UibcChannel(object):
+    # wfd_loop protocol for the source side of one sink's channel.
+
+    def __init__(self, dispatcher, peer):
+        self.dispatcher = dispatcher
+        self.peer = peer
+        self.decoder = UibcDecoder()
+
+    def data_received(self, data):
+        self.dispatcher.dispatch(self.decoder.feed(data), self.peer)
+
+    def connection_lost(self, error):
+        pass
+
+
+def listen(loop, port, dispatcher, host=''):
+    def accept(client, address):
+        set_nodelay(client)
+        wfd_loop.Connection(loop, client, UibcChannel(dispatcher, address[0]))
+    return wfd_loop.listen(loop, port, accept, host)
+
+
+class UibcSender(object):
+    # Sink side of the channel; the events of one send() leave in one write.
+
+    def __init__(self, loop, address, port):
+        client = wfd_loop.connect(address, port)
+        set_nodelay(client)
+        self.connection = wfd_loop.Connection(loop, client, self)
+        self.error = None
+
+    def send(self, events):
+        self.connection.write(encode_events(events))
+
+    def close(self):
+        self.connection.close()
+
+    def data_received(self, data):
+        pass
+
+    def connection_lost(self, error):
+        self.error = error